@@ -15,17 +15,22 @@
 # limitations under the License.
 
 """Defines the routing for the app's admin request handlers
-(those that require administrative access)."""
-
-from admin_handlers import *
+(those that require administrative access).  As in main.py, handlers are given
+by name, and imported when first used."""
 
 import webapp2
 
+import stats
+
 application = webapp2.WSGIApplication(
     [
-        ('/admin/manage', AdminHandler),
-        ('/admin/create_product', CreateProductHandler),
-        ('/admin/delete_product', DeleteProductHandler)
+        ('/admin/manage', 'admin_handlers.AdminHandler'),
+        ('/admin/create_product', 'admin_handlers.CreateProductHandler'),
+        ('/admin/delete_product', 'admin_handlers.DeleteProductHandler'),
+        ('/admin/cache_stats', 'admin_handlers.CacheStatsHandler'),
+        ('/admin/warmup_stats', 'admin_handlers.WarmupStatsHandler'),
+        ('/admin/stats', 'admin_handlers.StatsHandler'),
+        ('/admin/reinit_status', 'admin_handlers.ReinitStatusHandler')
     ],
     debug=True)
-
+application = stats.StatsMiddleware(application, 'admin')
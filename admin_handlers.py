@@ -15,7 +15,8 @@
 # limitations under the License.
 
 """ Contains the admin request handlers for the app (those that require
-administrative access).
+administrative access).  As in handlers.py, the modules that only some of
+them use are imported by the code that uses them (see main.py).
 """
 
 import csv
@@ -30,7 +31,6 @@ import config
 import docs
 import errors
 import models
-import stores
 import utils
 
 from google.appengine.api import users
@@ -39,25 +39,35 @@ from google.appengine.ext import ndb
 from google.appengine.api import search
 
 
+# The columns of the sample data files, for the two example product types
+# ('smartphones' and 'Laptops')-- see categories.py
+SMARTPHONE_FIELDS = ['pid', 'name', 'category', 'price', 'brand',
+                     'description']
+LAPTOP_FIELDS = ['pid', 'name', 'category', 'price', 'size', 'brand',
+                 'laptop_type', 'description']
+
+
 def reinitAll(sample_data=True):
   """
-  Deletes all product entities and documents, essentially resetting the app
-  state, then loads in static sample data if requested. Hardwired for the
-  expected product types in the sample data.
+  Resets the app's products to the static sample data, if requested.
+  Hardwired for the expected product types in the sample data.
+  The products are indexed into a new product index, which replaces the live
+  one once it's complete (see docs.Product.startRebuild), so that searches
+  are served meanwhile.  Their entities are updated in place, and those of
+  products no longer in the data are deleted after the switch (see
+  docs.Product.switchToIndex).
   (Re)loads store location data from stores.py as well.
   This function is intended to be run 'offline' (e.g., via a Task Queue task).
   As an extension to this functionality, the channel ID could be used to notify
   when done."""
 
-  # delete all the product and review entities
-  #review_keys = models.Review.query().fetch(keys_only=True)
-  #ndb.delete_multi(review_keys)
-  prod_keys = models.Product.query().fetch(keys_only=True)
-  ndb.delete_multi(prod_keys)
-  # delete all the associated product documents in the doc and
-  # store indexes
-  docs.Product.deleteAllInProductIndex()
-  docs.Store.deleteAllInIndex()
+  index_name = docs.Product.startRebuild()
+  # delete any documents left in the new product index by an unfinished
+  # rebuild.  The live index, and the entities and store documents it is
+  # served with, are left in place.
+  docs.Product.deleteAllInIndex(index_name=index_name)
+  # the number of products imported, which the new index is checked against
+  imported = 0
   # load in sample data if indicated
   if sample_data:
     logging.info('Loading product sample data')
@@ -67,29 +77,29 @@ def reinitAll(sample_data=True):
     # categories.py
     datafile = os.path.join('data', config.SAMPLE_DATA_SMARTPHONE)
     # Smartphones
-    reader = csv.DictReader(
-        open(datafile, 'r'),
-        ['pid', 'name', 'category', 'price',
-         'brand','despriction'])
-    importData(reader)
+    reader = csv.DictReader(open(datafile, 'r'), SMARTPHONE_FIELDS)
+    counts = importData(reader, index_name=index_name)
+    imported += counts['written'] + counts['skipped']
     datafile = os.path.join('data', config.SAMPLE_DATA_LAPTOP)
     # Laptops
-    reader = csv.DictReader(
-        open(datafile, 'r'),
-        ['pid', 'name', 'category', 'price',
-         'size', 'brand', 'laptop_type',
-         'description'])
-    importData(reader)
+    reader = csv.DictReader(open(datafile, 'r'), LAPTOP_FIELDS)
+    counts = importData(reader, index_name=index_name)
+    imported += counts['written'] + counts['skipped']
 
     # next create docs from store location info
     loadStoreLocationData()
 
+  error = docs.Product.switchToIndex(index_name, imported)
+  if error:
+    logging.error('The product index was not replaced: %s', error)
   logging.info('Re-initialization complete.')
 
 def loadStoreLocationData():
     # create documents from store location info
     # currently logs but otherwise swallows search errors.
+    import stores
     slocs = stores.stores
+    store_docs = []
     for s in slocs:
       logging.info("s: %s", s)
       geopoint = search.GeoPoint(s[3][0], s[3][1])
@@ -97,31 +107,47 @@ def loadStoreLocationData():
                 search.TextField(name=docs.Store.STORE_ADDRESS, value=s[2]),
                 search.GeoField(name=docs.Store.STORE_LOCATION, value=geopoint)
               ]
-      d = search.Document(doc_id=s[0], fields=fields)
-      try:
-        add_result = search.Index(config.STORE_INDEX_NAME).put(d)
-      except search.Error:
-        logging.exception("Error adding document:")
-
-
-def importData(reader):
+      store_docs.append(search.Document(doc_id=s[0], fields=fields))
+    # add() bumps the store index generation, making other instances'
+    # snapshots of the store locations stale; rebuild this instance's.
+    if docs.Store.add(store_docs) is not None:
+      # the documents are replaced in place; delete those of stores that are
+      # no longer listed.
+      docs.Store.deleteAllInIndex(keep=set(s[0] for s in slocs))
+      docs.Store.setSnapshot(
+          [(s[0], s[1], s[2], s[3][0], s[3][1]) for s in slocs],
+          docs.Store.getGeneration())
+
+
+def importData(reader, upsert=False, index_name=None):
   """Import via the csv reader iterator using the specified batch size as set in
   the config file.  We want to ensure the batch is not too large-- we allow 100
-  rows/products max per batch."""
+  rows/products max per batch.  If upsert is set, the rows may update
+  existing products (see docs.Product.upsertProductBatch); otherwise they must
+  be new products.  Rows for products that are unchanged since they were last
+  built are skipped.  The products are indexed into the given product index
+  (by default, the live one).  Returns the import counts (see
+  docs.Product.newImportCounts)."""
   MAX_BATCH_SIZE = 100
-  rows = []
   # index in batches
   # ensure the batch size in the config file is not over the max or < 1.
   batchsize = utils.intClamp(config.IMPORT_BATCH_SIZE, 1, MAX_BATCH_SIZE)
   logging.debug('batchsize: %s', batchsize)
-  for row in reader:
-    if len(rows) == batchsize:
-      docs.Product.buildProductBatch(rows)
-      rows = [row]
-    else:
-      rows.append(row)
-  if rows:
-    docs.Product.buildProductBatch(rows)
+  batches = utils.iterBatches(reader, batchsize)
+  if not upsert and config.IMPORT_PIPELINED:
+    # overlap the parsing, indexing and datastore writes of successive
+    # batches.
+    counts = docs.Product.buildProductBatches(batches, index_name)
+  else:
+    build = (docs.Product.upsertProductBatch if upsert
+             else docs.Product.buildProductBatch)
+    counts = docs.Product.newImportCounts()
+    for rows in batches:
+      for key, n in build(rows, index_name).iteritems():
+        counts[key] += n
+  logging.info('Imported products: %(written)d written, %(skipped)d '
+               'unchanged, %(failed)d failed', counts)
+  return counts
 
 
 class AdminHandler(BaseHandler):
@@ -129,13 +155,15 @@ class AdminHandler(BaseHandler):
 
   def buildAdminPage(self, notification=None):
     # If necessary, build the app's product categories now.  This is done only
-    # if there are no Category entities in the datastore.
-    models.Category.buildAllCategories()
+    # if there are no Category entities in the datastore, and the category
+    # tree is not already cached.
+    models.Category.getCategoryTree()
     tdict = {
-        'sampleb': config.SAMPLE_DATA_SMARTPHONES,
-        'samplet': config.SAMPLE_DATA_LAPTOPS,
+        'sampleb': config.SAMPLE_DATA_SMARTPHONE,
+        'samplet': config.SAMPLE_DATA_LAPTOP,
         'update_sample1': config.UPDATE_PHONE_DATA,
         'update_sample2':config.UPDATE_LAPTOP_DATA
+        }
     if notification:
       tdict['notification'] = notification
     self.render_template('admin.html', tdict)
@@ -145,8 +173,17 @@ class AdminHandler(BaseHandler):
     action = self.request.get('action')
     if action == 'reinit':
       # reinitialise the app data to the sample data
-      defer(reinitAll)
+      if config.REINIT_SHARDED:
+        import reinit
+        reinit.start()
+      else:
+        defer(reinitAll)
       self.buildAdminPage(notification="Reinitialization performed.")
+    elif action == 'reinit_resume':
+      # rerun the unfinished shards of the latest sharded reinitialization
+      import reinit
+      reinit.resume()
+      self.buildAdminPage(notification="Reinitialization resumed.")
     elif action == 'demo_update':
       # update the sample data, from (hardwired) book update
       # data. Demonstrates updating some existing products, and adding some new
@@ -154,43 +191,59 @@ class AdminHandler(BaseHandler):
       logging.info('Loading product sample update data')
       # The following is hardwired to the known format of the sample data file
       datafile = os.path.join('data', config.UPDATE_PHONE_DATA)
-      reader = csv.DictReader(
-          open(datafile, 'r'),
-          ['pid', 'name', 'category', 'price','brand'
-           'description'])
-      for row in reader:
-        docs.Product.buildProduct(row)
-      self.buildAdminPage(notification="update performed.")
-        
-        datafile = os.path.join('data', config.UPDATE_LAPTOP_DATA)
-      reader = csv.DictReader(
-          open(datafile, 'r'),
-          ['pid', 'name', 'category', 'price',
-         'size', 'brand', 'laptop_type',
-         'description'])
-      for row in reader:
-        docs.Product.buildProduct(row)
-      self.buildAdminPage(notification="update performed.")
-
-   """elif action == 'update_ratings':
-      self.update_ratings()
-      self.buildAdminPage(notification="Ratings update performed.")"""
-      
+      reader = csv.DictReader(open(datafile, 'r'), SMARTPHONE_FIELDS)
+      counts = importData(reader, upsert=True)
+      datafile = os.path.join('data', config.UPDATE_LAPTOP_DATA)
+      reader = csv.DictReader(open(datafile, 'r'), LAPTOP_FIELDS)
+      for key, n in importData(reader, upsert=True).iteritems():
+        counts[key] += n
+      self.buildAdminPage(notification=(
+          'update performed: %(written)d products written, %(skipped)d '
+          'unchanged, %(failed)d failed.' % counts))
     else:
       self.buildAdminPage()
 
-  """def update_ratings(self):
-    """Find the products that have had an average ratings change, and need their
-    associated documents updated (re-indexed) to reflect that change; and
-    re-index those docs in batch. There will only
-    be such products if config.BATCH_RATINGS_UPDATE is True; otherwise the
-    associated documents will be updated right away."""
-    # get the pids of the products that need review info updated in their
-    # associated documents.
-    pkeys = models.Product.query(
-        models.Product.needs_review_reindex == True).fetch(keys_only=True)
-    # re-index these docs in batch
-    models.Product.updateProdDocsWithNewRating(pkeys)"""
+
+class CacheStatsHandler(BaseHandler):
+  """Reports the hit/miss/eviction counters of this instance's caches, as
+  JSON.  The counters are per-instance, so repeated requests may be served by
+  different instances."""
+
+  @BaseHandler.logged_in
+  def get(self):
+    import cache
+    self.render_json(cache.allStats())
+
+
+class WarmupStatsHandler(BaseHandler):
+  """Reports the timings of the most recent warmup requests (see warmup.run),
+  newest first, as JSON."""
+
+  @BaseHandler.logged_in
+  def get(self):
+    import warmup
+    self.render_json(warmup.getReports())
+
+
+class ReinitStatusHandler(BaseHandler):
+  """Reports the progress of the latest sharded reinitialization (see
+  reinit.getStatus), as JSON."""
+
+  @BaseHandler.logged_in
+  def get(self):
+    import reinit
+    self.render_json(reinit.getStatus())
+
+
+class StatsHandler(BaseHandler):
+  """Reports request timings, per route and per RPC type, and the slowest
+  recent requests, merged across instances (see stats.getSummary), as
+  JSON."""
+
+  @BaseHandler.logged_in
+  def get(self):
+    import stats
+    self.render_json(stats.getSummary())
 
 
 class DeleteProductHandler(BaseHandler):
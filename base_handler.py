@@ -18,13 +18,50 @@
 """
 
 
+import os
+import time
+
+from jinja2 import MemcachedBytecodeCache
 import webapp2
 from webapp2_extras import jinja2
 import json
 
+import config
+import stats
+
+from google.appengine.api import memcache
 from google.appengine.api import users
 
 
+def jinja2Config():
+  """Return the webapp2_extras.jinja2 config for the app's templates: the
+  ahead-of-time compiled templates (see compile_templates.py) if they exist
+  and this isn't the development server, so that templates are never parsed
+  or compiled on the request path.  Otherwise templates are loaded from
+  source, with a bytecode cache in memcache, so that each template is only
+  compiled by the first instance to render it."""
+  compiled = (os.path.isdir(config.COMPILED_TEMPLATE_PATH) and
+              not os.environ.get('SERVER_SOFTWARE', '').startswith(
+                  'Development'))
+  if compiled:
+    return {'template_path': config.TEMPLATE_PATH,
+            'compiled_path': config.COMPILED_TEMPLATE_PATH,
+            'force_compiled': True}
+  # bytecode is only valid for the python version that compiled it, and the
+  # template source is checksummed, so one prefix serves all app versions.
+  bytecode_cache = MemcachedBytecodeCache(
+      memcache.Client(), prefix='jinja2/bytecode/')
+  return {'template_path': config.TEMPLATE_PATH,
+          'compiled_path': None,
+          'environment_args': dict(
+              jinja2.default_config['environment_args'],
+              bytecode_cache=bytecode_cache)}
+
+
+def jinja2Factory(app):
+  return jinja2.Jinja2(app, config=jinja2Config())
+
+
 class BaseHandler(webapp2.RequestHandler):
   """The other handlers inherit from this class.  Provides some helper methods
   for rendering a template and generating template links."""
@@ -44,20 +81,59 @@ class BaseHandler(webapp2.RequestHandler):
 
   @webapp2.cached_property
   def jinja2(self):
-    return jinja2.get_jinja2(app=self.app)
+    return jinja2.get_jinja2(factory=jinja2Factory, app=self.app)
+
+  @webapp2.cached_property
+  def current_user(self):
+    """The logged-in user, or None, looked up once per request."""
+    return users.get_current_user()
+
+  @webapp2.cached_property
+  def sidebar_links(self):
+    """The sidebar links dict (see generateSidebarLinksDict), built once per
+    request.  Building it calls the user service, so a handler may build it
+    early, while its other RPCs are in flight."""
+    return self.generateSidebarLinksDict()
 
   def render_template(self, filename, template_args):
-    template_args.update(self.generateSidebarLinksDict())
+    template_args.update(self.sidebar_links)
+    start = time.time()
     self.response.write(self.jinja2.render_template(filename, **template_args))
+    stats.record('render:' + filename, (time.time() - start) * 1000)
 
   def render_json(self, response):
-    self.response.write("%s(%s);" % (self.request.GET['callback'],
-                                     json.dumps(response)))
+    """Write the response as JSONP if a callback was given, or as plain JSON
+    otherwise."""
+    callback = self.request.GET.get('callback')
+    if callback:
+      self.response.write("%s(%s);" % (callback, json.dumps(response)))
+    else:
+      self.response.headers['Content-Type'] = 'application/json'
+      self.response.write(json.dumps(response))
+
+  def notModified(self, etag, last_modified=None):
+    """Set the ETag, and optionally the Last-Modified (a naive UTC datetime),
+    of the response, and check them against the request's If-None-Match, or
+    if it has none, its If-Modified-Since.  If the client's copy is current,
+    the response is made a 304, and True is returned: the caller should then
+    return without writing a body."""
+    self.response.headers['ETag'] = '"%s"' % etag
+    if last_modified is not None:
+      self.response.last_modified = last_modified
+    if self.request.headers.get('If-None-Match'):
+      fresh = etag in self.request.if_none_match
+    else:
+      since = self.request.if_modified_since
+      fresh = (last_modified is not None and since is not None and
+               last_modified <= since.replace(tzinfo=None))
+    if fresh:
+      self.response.status = 304
+    return fresh
 
   def getLoginLink(self):
     """Generate login or logout link and text, depending upon the logged-in
     status of the client."""
-    if users.get_current_user():
+    if self.current_user:
       url = users.create_logout_url(self.request.uri)
       url_linktext = 'Logout'
     else:
@@ -67,14 +143,14 @@ class BaseHandler(webapp2.RequestHandler):
 
   def getAdminManageLink(self):
     """Build link to the admin management page, if the user is logged in."""
-    if users.get_current_user():
+    if self.current_user:
       admin_url = '/admin/manage'
       return (admin_url, 'Admin/Add sample data')
     else:
       return (None, None)
 
   def createProductAdminLink(self):
-    if users.get_current_user():
+    if self.current_user:
       admin_create_url = '/admin/create_product'
       return (admin_create_url, 'Create new product (admin)')
     else:
@@ -0,0 +1,374 @@
+#!/usr/bin/env python
+#
+# Copyright 2012 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Load-generation benchmark for the app's user-facing routes (/psearch,
+/product and /get_store_locations).
+
+The app's WSGI application is driven in-process, with the App Engine services
+replaced by the SDK's testbed stubs, by a pool of concurrent client threads
+replaying a weighted query mix.  Throughput and p50/p95/p99 latency are
+reported per route as JSON, so that runs can be compared across commits.
+
+Example:
+  python benchmark.py --sdk_path=/path/to/google_appengine \
+      --products=5000 --requests=2000 --concurrency=8 --output=bench.json
+
+With --index_only, the product documents are put straight into the search
+index, without their datastore entities, and the /psearch and /product
+requests are served straight from the index, as those routes would serve
+them, so that the search backend can be measured with millions of products:
+  python benchmark.py --backend=memory --index_only --products=2000000
+
+The query mix can be given as a JSON file with --mix; any keys it sets
+override those of DEFAULT_MIX:
+  {"routes": {"/psearch": 8, "/product": 3, "/get_store_locations": 1},
+   "queries": ["", "phone", "laptop 15"],
+   "categories": ["", "smartphones", "Laptops"],
+   "sorts": ["relevance", "price", "modified", "category", "name"],
+   "radii": [10000, 40000, 200000]}
+By default every sort key in docs.Product._SORT_OPTIONS is used.
+"""
+
+import argparse
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import threading
+import time
+import urllib
+import urlparse
+
+
+DEFAULT_MIX = {
+    'routes': {'/psearch': 8, '/product': 3, '/get_store_locations': 1},
+    'queries': ['', 'phone', 'laptop', 'black', 'pro 15', 'slim'],
+    'categories': None,  # all categories in categories.product_dict, and ''
+    'sorts': None,  # 'relevance' plus all of docs.Product._SORT_OPTIONS
+    'radii': [10000, 40000, 200000],
+}
+
+_BRANDS = ['Acme', 'Globex', 'Initech', 'Umbrella', 'Hooli', 'Vandelay']
+_WORDS = ['pro', 'slim', 'max', 'mini', 'plus', 'black', 'silver', 'ultra']
+_LAPTOP_TYPES = ['netbook', 'ultrabook', 'gaming', 'workstation']
+
+
+def setupSdk(sdk_path):
+  """Put the App Engine SDK and its bundled libraries on the path."""
+  if sdk_path:
+    sys.path.insert(0, sdk_path)
+  import dev_appserver
+  dev_appserver.fix_sys_path()
+  sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+
+def activateStubs():
+  """Activate the testbed stubs for the services the app uses."""
+  from google.appengine.ext import testbed
+  tb = testbed.Testbed()
+  tb.activate()
+  tb.setup_env(app_id='benchmark', overwrite=True)
+  tb.init_datastore_v3_stub()
+  tb.init_memcache_stub()
+  tb.init_search_stub()
+  tb.init_taskqueue_stub()
+  tb.init_user_stub()
+  return tb
+
+
+def syntheticRows(count, seed):
+  """Generate params dicts for count products, split between the sample
+  categories, in the format read from the sample data files."""
+  return list(iterSyntheticRows(count, seed))
+
+
+def iterSyntheticRows(count, seed):
+  """The generator form of syntheticRows."""
+  rnd = random.Random(seed)
+  for i in xrange(count):
+    brand = rnd.choice(_BRANDS)
+    words = ' '.join(rnd.sample(_WORDS, 2))
+    row = {'pid': 'bench%07d' % i, 'brand': brand,
+           'price': '%.2f' % rnd.uniform(50, 3000)}
+    if i % 2:
+      row.update({'category': 'smartphones',
+                  'name': '%s phone %s %d' % (brand, words, i),
+                  'description': 'A %s smartphone.' % words})
+    else:
+      row.update({'category': 'Laptops',
+                  'name': '%s laptop %s %d' % (brand, words, i),
+                  'description': 'A %s laptop.' % words,
+                  'size': str(rnd.choice([11, 13, 14, 15, 17])),
+                  'laptop_type': rnd.choice(_LAPTOP_TYPES)})
+    yield row
+
+
+def loadData(product_count, seed):
+  """Build the categories, the product documents and entities, and the store
+  documents.  Returns the list of product ids."""
+  import admin_handlers
+  import docs
+  import models
+  models.Category.buildAllCategories()
+  rows = syntheticRows(product_count, seed)
+  batchsize = 100
+  for i in xrange(0, len(rows), batchsize):
+    docs.Product.buildProductBatch(rows[i:i + batchsize])
+  admin_handlers.loadStoreLocationData()
+  return [row['pid'] for row in rows]
+
+
+def loadIndex(product_count, seed, batchsize=1000):
+  """Build the categories, and put the product documents straight into the
+  product index, in batches, without their datastore entities.  Returns the
+  list of product ids."""
+  import docs
+  import models
+  models.Category.buildAllCategories()
+  pids = []
+  batch = []
+  for row in iterSyntheticRows(product_count, seed):
+    params = docs.Product._normalizeParams(row)
+    batch.append(docs.Product._createDocument(**params))
+    pids.append(params['pid'])
+    if len(batch) >= batchsize:
+      docs.Product.add(batch)
+      batch = []
+  if batch:
+    docs.Product.add(batch)
+  return pids
+
+
+def buildMix(mix_file):
+  """Return the query mix, with the defaults filled in from the app's
+  categories and sort options."""
+  import categories
+  import docs
+  mix = dict(DEFAULT_MIX)
+  if mix_file:
+    with open(mix_file) as f:
+      mix.update(json.load(f))
+  if mix['categories'] is None:
+    mix['categories'] = [''] + sorted(categories.product_dict.keys())
+  if mix['sorts'] is None:
+    mix['sorts'] = ['relevance'] + [elt[0] for elt in
+                                    docs.Product._SORT_OPTIONS]
+  return mix
+
+
+def generateRequests(mix, pids, count, seed):
+  """Return a list of (route, url) pairs drawn from the query mix."""
+  import stores
+  rnd = random.Random(seed)
+  weighted = []
+  for route, weight in sorted(mix['routes'].items()):
+    weighted.extend([route] * int(weight))
+  reqs = []
+  for _ in xrange(count):
+    route = rnd.choice(weighted)
+    if route == '/psearch':
+      params = {'query': rnd.choice(mix['queries']),
+                'category': rnd.choice(mix['categories']),
+                'sort': rnd.choice(mix['sorts'])}
+    elif route == '/product':
+      params = {'pid': rnd.choice(pids)}
+    else:
+      lat, lon = rnd.choice(stores.stores)[3]
+      lat += rnd.uniform(-0.5, 0.5)
+      lon += rnd.uniform(-0.5, 0.5)
+      params = {
+          'location_query': (
+              'distance(store_location, geopoint(%s, %s)) < %s' %
+              (lat, lon, rnd.choice(mix['radii']))),
+          'latitude': lat, 'longitude': lon, 'callback': 'cb'}
+    reqs.append((route, '%s?%s' % (route, urllib.urlencode(params))))
+  return reqs
+
+
+def percentile(sorted_values, pct):
+  """Nearest-rank percentile of an already sorted list."""
+  if not sorted_values:
+    return None
+  rank = int(round(pct / 100.0 * len(sorted_values) + 0.5)) - 1
+  return sorted_values[min(max(rank, 0), len(sorted_values) - 1)]
+
+
+def appHandler(application):
+  """Return a function serving a (route, url) request with the WSGI
+  application, and returning its status."""
+  import webapp2
+
+  def handle(route, url):
+    return webapp2.Request.blank(url).get_response(application).status_int
+  return handle
+
+
+def indexRequest(route, url):
+  """Serve a /psearch or /product request straight from the product index:
+  run the search the search page would run, or read the document the
+  product page shows.  Returns the request's status."""
+  import config
+  import docs
+  import handlers
+  params = dict(urlparse.parse_qsl(urlparse.urlsplit(url).query))
+  if route == '/product':
+    return 200 if docs.Product.getDocFromPid(params['pid']) else 404
+  psearch = handlers.ProductSearchHandler
+  query = psearch._buildQuery(
+      psearch._buildQueryString(params), params['sort'],
+      docs.Product.getSortDict(), int(config.DOC_LIMIT), 0)
+  docs.Product.search(query, category=params.get('category') or None)
+  return 200
+
+
+def runLoad(handle, reqs, concurrency):
+  """Issue the requests from concurrency client threads, each request
+  served by calling handle(route, url) (see appHandler).  Returns a dict
+  mapping each route to a list of (latency_seconds, status) pairs, and the
+  wall-clock duration of the run."""
+  results = dict((route, []) for route, _ in reqs)
+  lock = threading.Lock()
+  queue = list(reversed(reqs))
+
+  def worker():
+    while True:
+      with lock:
+        if not queue:
+          return
+        route, url = queue.pop()
+      start = time.time()
+      try:
+        status = handle(route, url)
+      except Exception:  # report, rather than abort the run
+        status = 500
+      elapsed = time.time() - start
+      with lock:
+        results[route].append((elapsed, status))
+
+  threads = [threading.Thread(target=worker) for _ in xrange(concurrency)]
+  start = time.time()
+  for t in threads:
+    t.start()
+  for t in threads:
+    t.join()
+  return results, time.time() - start
+
+
+def summarize(results, duration):
+  """Build the per-route report."""
+  report = {}
+  for route, samples in sorted(results.items()):
+    latencies = sorted(s[0] * 1000 for s in samples)
+    errors = len([s for s in samples if s[1] >= 400])
+    report[route] = {
+        'requests': len(samples),
+        'errors': errors,
+        'throughput_rps': len(samples) / duration if duration else None,
+        'mean_ms': sum(latencies) / len(latencies) if latencies else None,
+        'p50_ms': percentile(latencies, 50),
+        'p95_ms': percentile(latencies, 95),
+        'p99_ms': percentile(latencies, 99),
+        'max_ms': latencies[-1] if latencies else None,
+    }
+  return report
+
+
+def gitRevision():
+  try:
+    return subprocess.check_output(
+        ['git', 'rev-parse', 'HEAD'],
+        cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+
+def main(argv):
+  parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+  parser.add_argument('--sdk_path', default=os.environ.get('APPENGINE_SDK'),
+                      help='path to the App Engine SDK')
+  parser.add_argument('--backend', choices=['appengine', 'memory'],
+                      default='appengine',
+                      help='search backend (see config.SEARCH_BACKEND)')
+  parser.add_argument('--index_only', action='store_true',
+                      help='load and query the product index only')
+  parser.add_argument('--products', type=int, default=2000)
+  parser.add_argument('--requests', type=int, default=1000)
+  parser.add_argument('--warmup', type=int, default=50,
+                      help='number of untimed requests issued first')
+  parser.add_argument('--concurrency', type=int, default=4)
+  parser.add_argument('--mix', help='JSON file overriding the query mix')
+  parser.add_argument('--seed', type=int, default=0)
+  parser.add_argument('--output', help='write the JSON report to this file')
+  args = parser.parse_args(argv)
+
+  setupSdk(args.sdk_path)
+  tb = activateStubs()
+  try:
+    import cache
+    import config
+    config.SEARCH_BACKEND = args.backend
+
+    load_start = time.time()
+    mix = buildMix(args.mix)
+    if args.index_only:
+      pids = loadIndex(args.products, args.seed)
+      # the store locator doesn't use the search index
+      mix['routes'] = dict((route, weight) for route, weight
+                           in mix['routes'].iteritems()
+                           if route != '/get_store_locations')
+      handle = indexRequest
+    else:
+      pids = loadData(args.products, args.seed)
+      import main as app_main
+      handle = appHandler(app_main.application)
+    load_secs = time.time() - load_start
+    if args.warmup:
+      runLoad(handle, generateRequests(mix, pids, args.warmup, args.seed + 1),
+              args.concurrency)
+    reqs = generateRequests(mix, pids, args.requests, args.seed)
+    results, duration = runLoad(handle, reqs, args.concurrency)
+    report = {
+        'revision': gitRevision(),
+        'backend': args.backend,
+        'index_only': args.index_only,
+        'products': args.products,
+        'concurrency': args.concurrency,
+        'load_secs': load_secs,
+        'load_products_per_sec': (args.products / load_secs
+                                  if load_secs else None),
+        # kilobytes on Linux
+        'max_rss_mb': resource.getrusage(
+            resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+        'duration_secs': duration,
+        'throughput_rps': len(reqs) / duration if duration else None,
+        'mix': mix,
+        'routes': summarize(results, duration),
+        'caches': cache.allStats(),
+    }
+  finally:
+    tb.deactivate()
+
+  out = json.dumps(report, indent=2, sort_keys=True)
+  if args.output:
+    with open(args.output, 'w') as f:
+      f.write(out + '\n')
+  print out
+
+
+if __name__ == '__main__':
+  main(sys.argv[1:])
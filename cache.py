@@ -0,0 +1,292 @@
+#!/usr/bin/env python
+#
+# Copyright 2012 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Contains the caching helpers used by the app.
+LRUCache is a size-bounded per-instance cache, and TwoTierCache puts an
+LRUCache in front of memcache, so that values are shared between instances but
+repeated lookups on the same instance don't cost a memcache round trip.
+"""
+
+import collections
+import hashlib
+import logging
+import threading
+import time
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+
+# All caches created in this module, by name, so that their counters can be
+# reported together (see allStats).
+_REGISTRY = {}
+
+_VERSION_NAMESPACE = 'version'
+
+
+def allStats():
+  """Return a dict mapping each registered cache name to its counters."""
+  return dict((name, c.stats()) for name, c in _REGISTRY.iteritems())
+
+
+def getVersion(name):
+  """Return the current value of the named version counter.  The counter is
+  bumped (see bumpVersion) whenever the data it versions changes, so it can be
+  made part of a cache key to invalidate everything cached from an earlier
+  state of that data."""
+  version = memcache.get(name, namespace=_VERSION_NAMESPACE)
+  if version is None:
+    # The counter is seeded from the clock, so that if memcache evicts it,
+    # the new value is (in practice) still larger than any earlier one.
+    memcache.add(name, int(time.time() * 1000), namespace=_VERSION_NAMESPACE)
+    version = memcache.get(name, namespace=_VERSION_NAMESPACE)
+  return version
+
+
+@ndb.tasklet
+def getVersionAsync(name):
+  """The asynchronous form of getVersion: returns a future.  The memcache
+  lookups of tasklets that run together are batched by ndb, so that several
+  counters (and other keys) can be read in one round trip."""
+  ctx = ndb.get_context()
+  version = yield ctx.memcache_get(name, namespace=_VERSION_NAMESPACE)
+  if version is None:
+    yield ctx.memcache_add(name, int(time.time() * 1000),
+                           namespace=_VERSION_NAMESPACE)
+    version = yield ctx.memcache_get(name, namespace=_VERSION_NAMESPACE)
+  raise ndb.Return(version)
+
+
+def bumpVersion(name):
+  """Increment the named version counter, and return its new value."""
+  return memcache.incr(name, initial_value=int(time.time() * 1000),
+                       namespace=_VERSION_NAMESPACE)
+
+
+class LRUCache(object):
+  """A thread-safe, size-bounded, least-recently-used cache.  The app is
+  configured as threadsafe, so a single instance may serve several requests
+  concurrently; all access to the underlying dict is done under a lock."""
+
+  def __init__(self, max_size):
+    self.max_size = max(int(max_size), 1)
+    self._data = collections.OrderedDict()
+    self._lock = threading.Lock()
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+
+  def get(self, key, default=None, fresh=None):
+    """Return the value cached for key, marking it as most recently used.  If
+    a fresh predicate is given, an entry whose value fails it has expired:
+    it is deleted, and the lookup counted as a miss."""
+    with self._lock:
+      try:
+        value = self._data.pop(key)
+      except KeyError:
+        self.misses += 1
+        return default
+      if fresh is not None and not fresh(value):
+        self.misses += 1
+        return default
+      self._data[key] = value
+      self.hits += 1
+      return value
+
+  def set(self, key, value):
+    """Cache value under key, evicting the least recently used entries if the
+    cache is full."""
+    with self._lock:
+      self._data.pop(key, None)
+      self._data[key] = value
+      while len(self._data) > self.max_size:
+        self._data.popitem(last=False)
+        self.evictions += 1
+
+  def delete(self, key):
+    with self._lock:
+      self._data.pop(key, None)
+
+  def clear(self):
+    with self._lock:
+      self._data.clear()
+
+  def __len__(self):
+    return len(self._data)
+
+  def stats(self):
+    """Return the cache counters as a dict."""
+    return {'size': len(self._data), 'max_size': self.max_size,
+            'hits': self.hits, 'misses': self.misses,
+            'evictions': self.evictions}
+
+
+class TwoTierCache(object):
+  """A per-instance LRUCache backed by memcache.  Lookups try the local cache
+  first, then memcache (populating the local cache on a memcache hit).
+  Keys may be any string; they are hashed before use, so that long query
+  strings don't run into the memcache key size limit.
+
+  Values set or deleted by one instance are not seen by the local caches of
+  the others.  That's fine for keys that are never reused for another value
+  (such as keys including a version); for others, local_time bounds how long
+  an instance may use its local copy before checking memcache again."""
+
+  def __init__(self, name, max_size, time=0, local_time=None):
+    """Args:
+      name: the cache name, also used as the memcache namespace.
+      max_size: the maximum number of entries held in the local cache.
+      time: the memcache expiration time, in seconds (0 for no expiry).
+      local_time: if given, the number of seconds a value is used from the
+        local cache, after which it is read from memcache again.
+    """
+    self.name = name
+    self.time = time
+    self.local_time = local_time
+    self.local = LRUCache(max_size)
+    self._lock = threading.Lock()
+    self.memcache_hits = 0
+    self.memcache_misses = 0
+    _REGISTRY[name] = self
+
+  @classmethod
+  def _hashKey(cls, key):
+    if isinstance(key, unicode):
+      key = key.encode('utf-8')
+    return hashlib.sha1(key).hexdigest()
+
+  def _getLocal(self, hkey):
+    if self.local_time is None:
+      return self.local.get(hkey)
+    now = time.time()
+    entry = self.local.get(hkey, fresh=lambda entry: now < entry[0])
+    return None if entry is None else entry[1]
+
+  def _setLocal(self, hkey, value):
+    if self.local_time is not None:
+      value = (time.time() + self.local_time, value)
+    self.local.set(hkey, value)
+
+  def _countMemcache(self, hits, misses):
+    """Add to the memcache counters, which concurrent requests update."""
+    with self._lock:
+      self.memcache_hits += hits
+      self.memcache_misses += misses
+
+  def get(self, key):
+    """Return the value cached for key, or None if there is none."""
+    hkey = self._hashKey(key)
+    value = self._getLocal(hkey)
+    if value is not None:
+      return value
+    value = memcache.get(hkey, namespace=self.name)
+    if value is None:
+      self._countMemcache(0, 1)
+      return None
+    self._countMemcache(1, 0)
+    self._setLocal(hkey, value)
+    return value
+
+  @ndb.tasklet
+  def getAsync(self, key):
+    """The asynchronous form of get: returns a future."""
+    hkey = self._hashKey(key)
+    value = self._getLocal(hkey)
+    if value is not None:
+      raise ndb.Return(value)
+    value = yield ndb.get_context().memcache_get(hkey, namespace=self.name)
+    if value is None:
+      self._countMemcache(0, 1)
+      raise ndb.Return(None)
+    self._countMemcache(1, 0)
+    self._setLocal(hkey, value)
+    raise ndb.Return(value)
+
+  def getMulti(self, keys):
+    """Return a dict mapping each of the keys that has a cached value to that
+    value.  The keys missing from the local cache are read from memcache with
+    a single call."""
+    res = {}
+    missing = {}
+    for key in keys:
+      hkey = self._hashKey(key)
+      value = self._getLocal(hkey)
+      if value is None:
+        missing[hkey] = key
+      else:
+        res[key] = value
+    if missing:
+      found = memcache.get_multi(missing.keys(), namespace=self.name)
+      self._countMemcache(len(found), len(missing) - len(found))
+      for hkey, value in found.iteritems():
+        self._setLocal(hkey, value)
+        res[missing[hkey]] = value
+    return res
+
+  def setMulti(self, mapping, add=False):
+    """Cache the values of a dict, keyed by their keys, in both tiers, with a
+    single memcache call.  If add is set, values are only added to memcache
+    for the keys that have none there, so that a value read from the source
+    doesn't overwrite a newer one set meanwhile; and only the values added
+    are cached locally, so that the local tier doesn't keep one memcache
+    rejected."""
+    hmapping = dict((self._hashKey(key), value)
+                    for key, value in mapping.iteritems())
+    if not hmapping:
+      return
+    if not add:
+      for hkey, value in hmapping.iteritems():
+        self._setLocal(hkey, value)
+    write = memcache.add_multi if add else memcache.set_multi
+    try:
+      failed = write(hmapping, time=self.time, namespace=self.name)
+    except ValueError:  # a value is too large for memcache
+      logging.warn('value too large to cache in memcache, cache %s',
+                   self.name)
+      return
+    if failed:
+      logging.debug('memcache %s failed for some keys of cache %s',
+                    'add' if add else 'set', self.name)
+    if add:
+      failed = set(failed)
+      for hkey, value in hmapping.iteritems():
+        if hkey not in failed:
+          self._setLocal(hkey, value)
+
+  def set(self, key, value):
+    """Cache value under key in both tiers.  Memcache errors are logged but
+    otherwise ignored, since the value is still cached locally."""
+    hkey = self._hashKey(key)
+    self._setLocal(hkey, value)
+    try:
+      if not memcache.set(hkey, value, time=self.time, namespace=self.name):
+        logging.debug('memcache set failed for cache %s', self.name)
+    except ValueError:  # the value is too large for memcache
+      logging.warn('value too large to cache in memcache, cache %s',
+                   self.name)
+
+  def delete(self, key):
+    hkey = self._hashKey(key)
+    self.local.delete(hkey)
+    memcache.delete(hkey, namespace=self.name)
+
+  def stats(self):
+    """Return the counters for both tiers as a dict."""
+    res = self.local.stats()
+    with self._lock:
+      res.update({'memcache_hits': self.memcache_hits,
+                  'memcache_misses': self.memcache_misses})
+    return res
@@ -29,7 +29,7 @@ ctree =  {'name': 'root', 'children': [smartphones, laptops]}
 # category, category name, and price]
 # Define the non-'core' (differing) product fields for each category
 # above, and their types.
-product_dict =  {'smartphones': {'brand': search.TextField,}
+product_dict =  {'smartphones': {'brand': search.TextField,},
                  'Laptops': {'size': search.NumberField,
                             'brand': search.TextField,
                             'laptop_type': search.TextField}
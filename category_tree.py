@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+#
+# Copyright 2012 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Contains CategoryTree, an immutable snapshot of the product category
+hierarchy (see models.Category.getCategoryTree).
+"""
+
+
+class CategoryTree(object):
+  """An immutable snapshot of the category hierarchy, with the parent,
+  children and ancestors of every category precomputed, for building menus
+  and filters.  The tree is built from a dict mapping each category name to
+  the name of its parent (None for the root), which is also the form in which
+  it is cached in memcache."""
+
+  __slots__ = ('root', '_parents', '_children', '_ancestors', '_names')
+
+  def __init__(self, parents, root='root'):
+    self.root = root
+    self._parents = dict(parents)
+    children = {}
+    for name, parent in self._parents.iteritems():
+      if parent is not None:
+        children.setdefault(parent, []).append(name)
+    self._children = dict(
+        (name, tuple(sorted(kids, key=lambda n: n.lower())))
+        for name, kids in children.iteritems())
+    # walk the tree depth-first from the root, recording each category's
+    # ancestors (root first) and the order of the categories.
+    self._ancestors = {root: ()}
+    names = []
+    stack = [root]
+    while stack:
+      name = stack.pop()
+      if name != root:
+        names.append(name)
+      for child in reversed(self._children.get(name, ())):
+        self._ancestors[child] = self._ancestors[name] + (name,)
+        stack.append(child)
+    self._names = tuple(names)
+
+  @classmethod
+  def fromNestedDict(cls, data):
+    """Build the tree from nested {'name': ..., 'children': [...]} dicts, as
+    in categories.ctree."""
+    parents = {}
+    stack = [(data, None)]
+    while stack:
+      node, parent = stack.pop()
+      parents[node['name']] = parent
+      for child in node.get('children') or []:
+        stack.append((child, node['name']))
+    return cls(parents, root=data['name'])
+
+  def __contains__(self, name):
+    return name in self._ancestors
+
+  @property
+  def parents(self):
+    """The dict mapping each category name to its parent's name."""
+    return dict(self._parents)
+
+  @property
+  def names(self):
+    """The names of all the categories except the root, depth first."""
+    return self._names
+
+  def parent(self, name):
+    return self._parents.get(name)
+
+  def children(self, name):
+    return self._children.get(name, ())
+
+  def ancestors(self, name):
+    """The names of the category's ancestors, root first."""
+    return self._ancestors.get(name, ())
+
+  def descendants(self, name):
+    """The names of all the categories below the given one, depth first."""
+    prefix = self.ancestors(name) + (name,)
+    return tuple(n for n in self._names
+                 if self._ancestors[n][:len(prefix)] == prefix)
+
+  def menuInfo(self):
+    """A list of category id/name correspondences, used to populate html
+    select menus."""
+    return [(name, name) for name in self._names]
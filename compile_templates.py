@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+#
+# Copyright 2012 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Ahead-of-time compiler for the app's jinja2 templates.
+
+Compiles every template in config.TEMPLATE_PATH to a python module in
+config.COMPILED_TEMPLATE_PATH, with the same environment settings the app
+uses, so that deployed instances load the templates as modules (see
+base_handler.jinja2Config) instead of parsing and compiling them on their
+first requests.  Run it before each deploy; templates edited without
+recompiling are served stale until it is rerun.
+
+Example:
+  python compile_templates.py --sdk_path=/path/to/google_appengine
+"""
+
+import argparse
+import os
+import shutil
+import sys
+
+import benchmark
+
+
+def main(argv):
+  parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+  parser.add_argument('--sdk_path', default=os.environ.get('APPENGINE_SDK'),
+                      help='path to the App Engine SDK')
+  args = parser.parse_args(argv)
+
+  benchmark.setupSdk(args.sdk_path)
+  import jinja2
+  from webapp2_extras import jinja2 as webapp2_jinja2
+  import config
+
+  # the template paths in config are relative to the app directory
+  os.chdir(os.path.dirname(os.path.abspath(__file__)))
+  env = jinja2.Environment(
+      loader=jinja2.FileSystemLoader(config.TEMPLATE_PATH),
+      **webapp2_jinja2.default_config['environment_args'])
+  # remove the modules of deleted or renamed templates
+  if os.path.isdir(config.COMPILED_TEMPLATE_PATH):
+    shutil.rmtree(config.COMPILED_TEMPLATE_PATH)
+  os.makedirs(config.COMPILED_TEMPLATE_PATH)
+  # python files rather than .pyc, which are not uploaded by appcfg.py
+  env.compile_templates(config.COMPILED_TEMPLATE_PATH, zip=None,
+                        log_function=lambda msg: sys.stdout.write(msg + '\n'))
+
+
+if __name__ == '__main__':
+  main(sys.argv[1:])
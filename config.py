@@ -18,18 +18,127 @@
 """
 
 
-PRODUCT_INDEX_NAME = 'productsearch1'  # The document index name.
+PRODUCT_INDEX_NAME = 'productsearch1'  # The document index (alias) name.
     # An index name must be a visible printable
     # ASCII string not starting with '!'. Whitespace characters are
     # excluded.
 
 STORE_INDEX_NAME = 'stores1'
 
+# how the product documents are split between several indexes: None keeps
+# them in one index; 'category' keeps each category's products in an index of
+# its own, so that a search within a category only searches its index; 'hash'
+# spreads them over PRODUCT_INDEX_HASH_SHARDS indexes by doc id.  Searches
+# over several indexes are run on all of them at once, and their results
+# merged (see scatter.py).  The product data must be reinitialized after this
+# setting is changed.
+PRODUCT_INDEX_SHARDING = None
+PRODUCT_INDEX_HASH_SHARDS = 4
+
+# PRODUCT_INDEX_NAME is an alias for the live product index, which a
+# reinitialization replaces with a newly built index (productsearch2,
+# productsearch3, ...; see docs.Product.getLiveIndexName).  The number of
+# seconds an instance uses the live index name before checking whether it has
+# changed:
+INDEX_ALIAS_CHECK_SECS = 5
+# The number of seconds the old product index is kept after a rebuild makes
+# the new one live, before it is purged: long enough for every instance to
+# see the switch, and for a request already searching the old index to finish
+# (requests are limited to 60 seconds).
+OLD_INDEX_PURGE_DELAY_SECS = INDEX_ALIAS_CHECK_SECS + 120
+
+# The search backend: 'appengine' for the App Engine search service, or
+# 'memory' for the in-process index in memsearch.py, which lets the app be
+# run and load-tested without the search service.
+SEARCH_BACKEND = 'appengine'
+
 
 
 # the number of search results to display per page
 DOC_LIMIT = 3
 
+# the maximum number of products that may be fetched in one /products request
+MAX_BATCH_PIDS = 100
+
+# the default and maximum number of results per page returned by /api/search
+API_SEARCH_DEFAULT_LIMIT = 20
+API_SEARCH_MAX_LIMIT = 100
+
+# the number of seconds browsers and the edge cache may keep a product page
+# shown to an anonymous user before revalidating it
+PRODUCT_PAGE_MAX_AGE = 300
+
+# the number of seconds an instance uses its autocomplete prefix index before
+# checking whether the product index has changed, and the maximum number of
+# suggestions returned.
+AUTOCOMPLETE_CHECK_SECS = 5
+AUTOCOMPLETE_MAX_RESULTS = 10
+
+# the product document cache (see docs.Product.getDocsFromPids): the maximum
+# number of documents cached per instance, the number of seconds they are kept
+# in memcache, and the number of seconds an instance uses its own copy of a
+# document before checking memcache for a newer one.
+PRODUCT_DOC_CACHE_SIZE = 1000
+PRODUCT_DOC_CACHE_TIME = 3600
+PRODUCT_DOC_CACHE_LOCAL_SECS = 5
+
+# the number of seconds an instance uses its copy of the category tree before
+# checking whether it has been edited.
+CATEGORY_TREE_CHECK_SECS = 5
+
+# the maximum number of search result pages cached per instance, and the
+# number of seconds they are kept in memcache.
+SEARCH_CACHE_SIZE = 500
+SEARCH_CACHE_TIME = 600
+
+# the facets whose counts are shown with search results: the maximum number of
+# category and brand values shown, and the price ranges, as (start, end) pairs
+# (start inclusive, end exclusive, None for an open end).
+FACET_VALUE_LIMIT = 10
+PRICE_FACET_RANGES = [(None, 100), (100, 250), (250, 500), (500, 1000),
+                      (1000, None)]
+
+# how search results are paged: 'offset' pages with a result offset, which
+# cannot go past 1000 results; 'cursor' pages with search cursors, at constant
+# cost per page and with no limit on depth.
+PAGINATION_MODE = 'offset'
+# the number of recent pages, and the number of seconds, for which the start
+# cursors are kept to build 'previous page' links in cursor mode.
+CURSOR_STACK_DEPTH = 50
+CURSOR_STACK_TIME = 1800
+
+# the number of products imported per batch (at most 100), whether the
+# parsing, indexing and datastore writes of successive batches are overlapped,
+# and how many batches may wait between those pipeline stages.
+IMPORT_BATCH_SIZE = 100
+IMPORT_PIPELINED = True
+IMPORT_PIPELINE_DEPTH = 2
+
+# whether the admin 'reinit' action runs as parallel shards (see reinit.py)
+# rather than as a single task, and the size in bytes of the part of a sample
+# data file imported by each shard.
+REINIT_SHARDED = True
+REINIT_SHARD_BYTES = 256 * 1024
+
+# the number of delete calls kept in flight at once when purging all the
+# documents of an index or all the entities of a model (see purge.py).
+PURGE_MAX_IN_FLIGHT = 4
+
+# request timing stats (see stats.py): the length in seconds of a stats
+# window, the number of windows kept per instance, and the number of slowest
+# requests kept per window.
+STATS_WINDOW_SECS = 60
+STATS_WINDOWS = 15
+STATS_SLOWEST = 20
+
+# the directory of the jinja2 templates, and that of the templates compiled
+# to python modules by compile_templates.py.  The compiled templates are used
+# when that directory exists, except on the development server; otherwise
+# templates are compiled on first use, and their bytecode shared between
+# instances via memcache.
+TEMPLATE_PATH = 'templates'
+COMPILED_TEMPLATE_PATH = 'compiled_templates'
+
 SAMPLE_DATA_SMARTPHONE = 'sample_data_smartphone.csv'
 SAMPLE_DATA_LAPTOP = 'sample_data_laptop.csv'
 UPDATE_PHONE_DATA = 'sample_data_phone_update.csv'
@@ -19,27 +19,68 @@ BaseDocumentManager provides some common utilities, and the Product subclass
 adds some Product-document-specific helper methods.
 """
 
-import collections
 import copy
+import cPickle as pickle
 import datetime
 import logging
 import re
 import string
-import urllib
+import threading
+import time
+import zlib
 
+import cache
 import categories
 import config
 import errors
 import models
+import utils
 
+from google.appengine.api import memcache
 from google.appengine.api import search
+from google.appengine.api import taskqueue
 from google.appengine.ext import ndb
+from google.appengine.ext.deferred import defer
+
+
+# index handles opened by BaseDocumentManager.openIndex, by (backend, name)
+_INDEX_HANDLES = {}
+# guards the import counts (see Product.newImportCounts)
+_IMPORT_COUNTS_LOCK = threading.Lock()
+# the minimum number of seconds between deferred refreshes of a snapshot (see
+# _deferRefresh)
+_REFRESH_RETRY_SECS = 300
+
+
+def _deferRefresh(func, name):
+  """Start a deferred call of func, which rebuilds a snapshot of an index
+  from its current generation, unless one has been started in the last
+  _REFRESH_RETRY_SECS.  The task is named after that period rather than the
+  generation, so that the instances finding their snapshot stale start only
+  one, however often the index changes meanwhile (as it does all through an
+  import).  If the snapshot is still stale in the next period (the index
+  changed after the refresh read it, or the snapshot it shared has been
+  evicted from memcache), another refresh is started then."""
+  name = '%s-%d' % (name, int(time.time() // _REFRESH_RETRY_SECS))
+  try:
+    defer(func, _name=name)
+  except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+    pass
 
 
 class BaseDocumentManager(object):
-  """Abstract class. Provides helper methods to manage search.Documents."""
+  """Abstract class. Provides helper methods to manage search.Documents.
+  Instances are lightweight views of a single document (such as a search
+  result): the field values are indexed by name once, when the view is
+  created, so each accessor is a dict lookup rather than a scan of the
+  document's field list."""
+
+  __slots__ = ('doc', '_fields', '_exprs')
 
   _INDEX_NAME = None
+  # marks a field name used by more than one field
+  _AMBIGUOUS = object()
+  _GENERATION_KEY_PREFIX = 'index_generation:'
   _VISIBLE_PRINTABLE_ASCII = frozenset(
     set(string.printable) - set(string.whitespace))
 
@@ -48,21 +89,54 @@ class BaseDocumentManager(object):
     efficient access.
     """
     self.doc = doc
-    fields = doc.fields
+    self._fields = self._indexFields(doc.fields)
+    self._exprs = None  # built on first use, as most callers don't need it
+
+  @classmethod
+  def _indexFields(cls, fields):
+    res = {}
+    for field in fields:
+      res[field.name] = cls._AMBIGUOUS if field.name in res else field.value
+    return res
 
   def getFieldVal(self, fname):
     """Get the value of the document field with the given name.  If there is
     more than one such field, the method returns None."""
-    try:
-      return self.doc.field(fname).value
-    except ValueError:
-      return None
+    value = self._fields.get(fname)
+    return None if value is self._AMBIGUOUS else value
+
+  def getExpressionVal(self, name):
+    """Get the value of the expression with the given name returned with a
+    search result (e.g. a snippet, or a computed field), or None if there is
+    no such expression."""
+    if self._exprs is None:
+      self._exprs = self._indexFields(getattr(self.doc, 'expressions', None)
+                                      or [])
+    value = self._exprs.get(name)
+    return None if value is self._AMBIGUOUS else value
+
+  def asDict(self):
+    """Return the document's fields as a dict of JSON-serializable values,
+    keyed by field name.  If there is more than one field with a name, the
+    first is used."""
+    res = {}
+    for field in self.doc.fields:
+      if field.name in res:
+        continue
+      value = field.value
+      if isinstance(value, (datetime.date, datetime.datetime)):
+        value = value.isoformat()
+      elif isinstance(value, search.GeoPoint):
+        value = {'lat': value.latitude, 'lon': value.longitude}
+      res[field.name] = value
+    return res
 
   def setFirstField(self, new_field):
     """Set the value of the (first) document field with the given name."""
     for i, field in enumerate(self.doc.fields):
       if field.name == new_field.name:
         self.doc.fields[i] = new_field
+        self._fields = self._indexFields(self.doc.fields)
         return True
     return False
 
@@ -78,68 +152,253 @@ class BaseDocumentManager(object):
 
   @classmethod
   def getIndex(cls):
-    return search.Index(name=cls._INDEX_NAME)
+    return cls.openIndex(cls._INDEX_NAME)
+
+  @classmethod
+  def getIndexes(cls, name=None):
+    """Return all the indexes holding this class's documents, or those of
+    the index with the given name.  (Only product documents may be split
+    between several indexes; see Product.getIndexes.)"""
+    return [cls.openIndex(name) if name else cls.getIndex()]
+
+  @classmethod
+  def _indexesForId(cls, doc_id, index_name=None):
+    """Return the indexes which may hold the document with the given id, of
+    the index with the given name (by default, the live one)."""
+    return cls.getIndexes(index_name)
+
+  @classmethod
+  def openIndex(cls, name):
+    """Return the index with the given name, from the search backend selected
+    in the config file."""
+    key = (config.SEARCH_BACKEND, name)
+    index = _INDEX_HANDLES.get(key)
+    if index is None:
+      # index handles hold no per-request state, so one handle per index is
+      # shared by all of the instance's requests.
+      if config.SEARCH_BACKEND == 'memory':
+        import memsearch  # only loaded when configured
+        index = memsearch.Index(name=name)
+      else:
+        index = search.Index(name=name)
+      _INDEX_HANDLES[key] = index
+    return index
+
+  @classmethod
+  def _generationKey(cls):
+    return cls._GENERATION_KEY_PREFIX + cls._INDEX_NAME
+
+  @classmethod
+  def getGeneration(cls):
+    """Return the generation counter for this index.  The counter is bumped
+    whenever documents are added to or removed from the index, so it can be
+    made part of a cache key to invalidate everything cached from an earlier
+    state of the index."""
+    return cache.getVersion(cls._generationKey())
+
+  @classmethod
+  def getGenerationAsync(cls):
+    """The asynchronous form of getGeneration: returns a future."""
+    return cache.getVersionAsync(cls._generationKey())
 
   @classmethod
-  def deleteAllInIndex(cls):
-    """Delete all the docs in the given index."""
-    docindex = cls.getIndex()
+  def bumpGeneration(cls):
+    """Increment the generation counter for this index."""
+    return cache.bumpVersion(cls._generationKey())
 
+  @classmethod
+  def deleteAllInIndex(cls, callback=None, index_name=None, keep=None):
+    """Delete all the docs in the index (by default, the live one), except
+    those whose ids are in keep, if given, with several delete calls in
+    flight at once (see purge.purgeIndex).  Returns the progress summary (for
+    several indexes, with the totals)."""
+    import purge  # only needed by the admin handlers
     try:
-      while True:
-        # until no more documents, get a list of documents,
-        # constraining the returned objects to contain only the doc ids,
-        # extract the doc ids, and delete the docs.
-        document_ids = [document.doc_id
-                        for document in docindex.get_range(ids_only=True)]
-        if not document_ids:
-          break
-        docindex.delete(document_ids)
-    except search.Error:
-      logging.exception("Error removing documents:")
+      summaries = [purge.purgeIndex(index, callback=callback, keep=keep)
+                   for index in cls.getIndexes(index_name)]
+    finally:
+      cls.bumpGeneration()
+    if len(summaries) == 1:
+      return summaries[0]
+    deleted = sum(summary['deleted'] for summary in summaries)
+    secs = sum(summary['secs'] for summary in summaries)
+    return {'name': index_name or cls._INDEX_NAME,
+            'deleted': deleted, 'secs': secs,
+            'per_sec': deleted / secs if secs > 0 else 0.0}
 
   @classmethod
   def getDoc(cls, doc_id):
     """Return the document with the given doc id. One way to do this is via
     the get_range method, as shown here.  If the doc id is not in the
     index, the first doc in the index will be returned instead, so we need
-    to check for that case."""
+    to check for that case.  If the doc could be in several index shards,
+    they are all read at once (see getDocs)."""
     if not doc_id:
       return None
-    try:
-      index = cls.getIndex()
-      response = index.get_range(
-          start_id=doc_id, limit=1, include_start_object=True)
+    return cls.getDocs([doc_id])[doc_id]
+
+  @classmethod
+  def getDocs(cls, doc_ids):
+    """Return a dict mapping each of the given doc ids to its document, or to
+    None if it is not in the index.  As with getDoc, each document is fetched
+    with get_range, but all the fetches are issued at once, so that fetching
+    many documents takes about as long as fetching one."""
+    res = {}
+    pending = []
+    for doc_id in set(doc_ids):
+      res[doc_id] = None
+      if not doc_id:
+        continue
+      try:
+        for index in cls._indexesForId(doc_id):
+          pending.append((doc_id, index.get_range_async(
+              start_id=doc_id, limit=1, include_start_object=True)))
+      except search.InvalidRequest: # catches ill-formed doc ids
+        pass
+    for doc_id, future in pending:
+      try:
+        response = future.get_result()
+      except search.InvalidRequest:
+        continue
       if response.results and response.results[0].doc_id == doc_id:
-        return response.results[0]
-      return None
-    except search.InvalidRequest: # catches ill-formed doc ids
-      return None
+        res[doc_id] = response.results[0]
+    return res
 
   @classmethod
-  def removeDocById(cls, doc_id):
-    """Remove the doc with the given doc id."""
+  def removeDocById(cls, doc_id, index_name=None):
+    """Remove the doc with the given doc id from the index (by default, the
+    live one).  Returns the index generation the removal bumped the counter
+    to, or None if it failed."""
+    removed = False
     try:
-      cls.getIndex().delete(doc_id)
+      removed = cls._deleteDoc(doc_id, index_name)
+    finally:
+      generation = cls.bumpGeneration()
+    return generation if removed else None
+
+  @classmethod
+  def _deleteDoc(cls, doc_id, index_name=None):
+    """Delete the doc with the given doc id from the index (by default, the
+    live one), without bumping the generation.  Returns whether it was
+    deleted; errors are logged."""
+    try:
+      pending = [index.delete_async(doc_id)
+                 for index in cls._indexesForId(doc_id, index_name)]
+      for future in pending:
+        future.get_result()
+      return True
     except search.Error:
       logging.exception("Error removing doc id %s.", doc_id)
+      return False
 
   @classmethod
-  def add(cls, documents):
-    """wrapper for search index add method; specifies the index name."""
+  def add(cls, documents, index_name=None, **put_args):
+    """wrapper for search index add method; specifies the index name (by
+    default, that of the live index).  Any other keyword args are passed to
+    _put."""
+    return cls._add(documents, index_name, **put_args)[0]
+
+  @classmethod
+  def _add(cls, documents, index_name=None, **put_args):
+    """Add the documents as add does, and return a (put results, generation)
+    pair: the results are None if the add failed, and the generation is the
+    one the add bumped the counter to."""
+    results = None
     try:
-      return cls.getIndex().put(documents)
+      results = cls._put(documents, index_name, **put_args)
     except search.Error:
       logging.exception("Error adding documents.")
+    finally:
+      generation = cls.bumpGeneration()
+    return results, generation
+
+  @classmethod
+  def _put(cls, documents, index_name=None):
+    return cls.getIndexes(index_name)[0].put(documents)
 
 
 class Store(BaseDocumentManager):
+  """Provides helper methods to manage store location documents, and an
+  in-memory snapshot of all the store locations, indexed with a
+  spatial.GeoGrid, so that store locator queries don't need a search request.
+  The snapshot is tagged with the store index generation it was built from,
+  and is stale once the index has changed.  The store locations are shared
+  in memcache by generation, so that an instance with a stale snapshot can
+  rebuild it without reading the index."""
+
+  __slots__ = ()
 
   _INDEX_NAME = config.STORE_INDEX_NAME
   STORE_NAME = 'store_name'
   STORE_LOCATION = 'store_location'
   STORE_ADDRESS = 'store_address'
 
+  _SNAPSHOT = None  # (generation, spatial.GeoGrid)
+  _SNAPSHOT_NAMESPACE = 'store_snapshot'
+
+  @classmethod
+  def setSnapshot(cls, stores, generation, share=True):
+    """Build the snapshot from a list of (doc_id, name, address, latitude,
+    longitude) tuples, for the given index generation, and unless share is
+    false, share the list with the other instances."""
+    if share:
+      memcache.set(str(generation), stores,
+                   namespace=cls._SNAPSHOT_NAMESPACE)
+    import spatial  # only needed by the store locator
+    grid = spatial.GeoGrid(
+        (lat, lon, {'addr': address, 'storename': name,
+                    'lat': lat, 'lon': lon})
+        for _, name, address, lat, lon in stores)
+    cls._SNAPSHOT = (generation, grid)
+    return grid
+
+  @classmethod
+  def getSnapshot(cls):
+    """Return the snapshot GeoGrid, or None if there is none or it is stale.
+    A stale snapshot is rebuilt from the store locations shared for the
+    current generation, if there are any."""
+    snapshot = cls._SNAPSHOT
+    generation = cls.getGeneration()
+    if snapshot and snapshot[0] == generation:
+      return snapshot[1]
+    stores = memcache.get(str(generation), namespace=cls._SNAPSHOT_NAMESPACE)
+    if stores is not None:
+      return cls.setSnapshot(stores, generation, share=False)
+    return None
+
+  @classmethod
+  def startSnapshotRefresh(cls):
+    """Rebuild the snapshot in a deferred task (see refreshSnapshot), so that
+    it can be shared with this and the other instances."""
+    _deferRefresh(cls.refreshSnapshot, 'store-snapshot')
+
+  @classmethod
+  def refreshSnapshot(cls):
+    """Rebuild the snapshot from the documents in the store index.  The
+    generation is read first, so that if the index changes while it is being
+    read, the snapshot will be stale."""
+    generation = cls.getGeneration()
+    index = cls.getIndex()
+    stores = []
+    start_id = None
+    try:
+      while True:
+        response = index.get_range(
+            start_id=start_id, include_start_object=False, limit=1000)
+        if not response.results:
+          break
+        for doc in response.results:
+          sdoc = cls(doc)
+          geopoint = sdoc.getFieldVal(cls.STORE_LOCATION)
+          stores.append((doc.doc_id, sdoc.getFieldVal(cls.STORE_NAME),
+                         sdoc.getFieldVal(cls.STORE_ADDRESS),
+                         geopoint.latitude, geopoint.longitude))
+        start_id = response.results[-1].doc_id
+    except search.Error:
+      logging.exception('Error reading the store locations:')
+      return None
+    return cls.setSnapshot(stores, generation)
+
 
 class Product(BaseDocumentManager):
   """Provides helper methods to manage Product documents.  All Product documents
@@ -151,6 +410,8 @@ class Product(BaseDocumentManager):
   reindexed given its product info, without having to fetch the
   existing document."""
 
+  __slots__ = ()
+
   _INDEX_NAME = config.PRODUCT_INDEX_NAME
 
   # 'core' product document field names
@@ -160,8 +421,13 @@ class Product(BaseDocumentManager):
   PRODUCT_NAME = 'name'
   PRICE = 'price'
   UPDATED = 'modified'
+  # computed field returned with search results (see
+  # handlers.ProductSearchHandler._buildQuery)
+  ADJUSTED_PRICE = 'adjusted_price'
+  # category-specific field shared by all the categories (see categories.py)
+  BRAND = 'brand'
 
-  _SORT_OPTIONS = [PRICE, 'price', search.SortExpression(
+  _SORT_OPTIONS = [[PRICE, 'price', search.SortExpression(
             # other examples:
             # expression='max(price, 14.99)'
             # If you access _score in your sort expressions,
@@ -185,10 +451,305 @@ class Product(BaseDocumentManager):
   _SORT_MENU = None
   _SORT_DICT = None
 
+  # the shard, in category sharding mode, of the products whose category has
+  # no field specification in categories.py
+  _OTHER_SHARD = 'other'
+
+  # (live index name, time it was checked); see getLiveIndexName
+  _LIVE_INDEX = None
+  _ALIAS_KEY_PREFIX = 'index_alias:'
+
+  # Pickled product documents, or _DOC_NOT_FOUND for pids with no document,
+  # keyed by the live index name, the cache version and the pid (see
+  # getDocsFromPids).  The version is bumped when the live index is purged,
+  # and is checked along with the index name every
+  # config.PRODUCT_DOC_CACHE_LOCAL_SECS.
+  _DOC_CACHE = cache.TwoTierCache(
+      'product_docs', config.PRODUCT_DOC_CACHE_SIZE,
+      config.PRODUCT_DOC_CACHE_TIME,
+      local_time=config.PRODUCT_DOC_CACHE_LOCAL_SECS)
+  _DOC_CACHE_VERSION = 'product_doc_cache'
+  _DOC_NOT_FOUND = 'not found'
+  # (key prefix, time it was checked)
+  _DOC_CACHE_PREFIX = None
+
+  # (generation, prefix_index.PrefixIndex, time the generation was checked).
+  # The generation and index are None until an index has been built.
+  _SUGGEST_SNAPSHOT = None
+  # The product names and brands the prefix indexes are built from are shared
+  # in memcache, by generation, in chunks that fit a memcache value.
+  _SUGGEST_NAMESPACE = 'suggest_products'
+  _SUGGEST_CHUNK_SIZE = 900000
 
   @classmethod
   def deleteAllInProductIndex(cls):
-    cls.deleteAllInIndex()
+    return cls.deleteAllInIndex()
+
+  @classmethod
+  def getIndex(cls):
+    return cls.openIndex(cls.getLiveIndexName())
+
+  @classmethod
+  def getLiveIndexName(cls):
+    """Return the name of the live product index.  The configured index name
+    is an alias, which a rebuild (see startRebuild) points at the new index
+    once it's complete, so that searches are served by the old index while
+    the new one is built.  The live index name is kept in a models.IndexAlias
+    entity and in memcache, and an instance checks it at most every
+    config.INDEX_ALIAS_CHECK_SECS."""
+    local = cls._LIVE_INDEX
+    now = time.time()
+    if local and now - local[1] < config.INDEX_ALIAS_CHECK_SECS:
+      return local[0]
+    key = cls._ALIAS_KEY_PREFIX + cls._INDEX_NAME
+    name = memcache.get(key)
+    if name is None:
+      alias = models.IndexAlias.get_by_id(cls._INDEX_NAME)
+      name = alias.live if alias and alias.live else cls._INDEX_NAME
+      # add rather than set, so as not to overwrite the name set by a
+      # concurrent switch with the one read before it.
+      memcache.add(key, name)
+    cls._LIVE_INDEX = (name, now)
+    return name
+
+  @classmethod
+  def _writeIndexNames(cls):
+    """Return the names of the live product index and of the index being
+    built to replace it (or None), for writing a product change.  While a
+    rebuild runs, a change is written to both, and the product's entity is
+    stamped with the new index, so that the change is neither lost at the
+    switch nor deleted as stale (see deleteStaleProducts).  The names are
+    read from the models.IndexAlias entity, rather than through
+    getLiveIndexName, which may be out of date just after a switch."""
+    alias = models.IndexAlias.get_by_id(cls._INDEX_NAME)
+    if not alias:
+      return cls._INDEX_NAME, None
+    return alias.live or cls._INDEX_NAME, alias.building
+
+  @classmethod
+  def _nextIndexName(cls, name):
+    """Return the name of the index that replaces the given one: the same
+    name, with its number incremented (productsearch1, productsearch2...)."""
+    m = re.match(r'(.*?)(\d*)$', name)
+    return '%s%d' % (m.group(1), int(m.group(2) or 0) + 1)
+
+  @classmethod
+  def startRebuild(cls):
+    """Start building a new product index to replace the live one, and return
+    its name.  The products are to be added to it by passing its name to the
+    import methods (see buildProductBatches), and it is made live by
+    switchToIndex.  If an earlier rebuild was not completed, its index is
+    reused; it may hold stale documents, so it should be purged first."""
+
+    @ndb.transactional
+    def txn():
+      alias = (models.IndexAlias.get_by_id(cls._INDEX_NAME) or
+               models.IndexAlias(id=cls._INDEX_NAME, live=cls._INDEX_NAME))
+      if not alias.building:
+        alias.building = cls._nextIndexName(alias.live)
+        alias.put()
+      return alias.building
+    return txn()
+
+  @classmethod
+  def countDocs(cls, index_name=None):
+    """Return the number of documents in the product index (by default, the
+    live one), counting all of its shards."""
+    count = 0
+    for index in cls.getIndexes(index_name):
+      start_id = None
+      while True:
+        response = index.get_range(
+            start_id=start_id, include_start_object=False, limit=1000,
+            ids_only=True)
+        if not response.results:
+          break
+        count += len(response.results)
+        start_id = response.results[-1].doc_id
+    return count
+
+  @classmethod
+  def switchToIndex(cls, index_name, expected):
+    """Make the index built since startRebuild the live product index, and
+    purge the old one in a deferred task, once no instance can still be
+    searching it (see config.OLD_INDEX_PURGE_DELAY_SECS).  The new index is
+    first verified to hold at least the expected number of documents: the
+    products the rebuild's import wrote to it or found already there (the
+    written and skipped import counts), rather than a count of the product
+    entities, which is slow, and only eventually consistent.  (Products
+    created while the rebuild ran add to the index; one deleted meanwhile
+    makes it fall short, and the switch is refused.)  The products that
+    neither the rebuild nor a change made while it ran wrote to the new index
+    are deleted along with the old index (see deleteStaleProducts).  Returns
+    None if the switch was made, or else a message saying why not, in which
+    case the old index stays live."""
+    found = cls.countDocs(index_name)
+    if found < expected:
+      return 'index %s has %d documents, but %d products were imported' % (
+          index_name, found, expected)
+
+    @ndb.transactional
+    def txn():
+      alias = models.IndexAlias.get_by_id(cls._INDEX_NAME)
+      if not alias or alias.building != index_name:
+        return None
+      old = alias.live
+      alias.live = index_name
+      alias.building = None
+      alias.put()
+      return old
+    old = txn()
+    if old is None:
+      return 'index %s is not being built' % index_name
+    memcache.set(cls._ALIAS_KEY_PREFIX + cls._INDEX_NAME, index_name)
+    cls._LIVE_INDEX = (index_name, time.time())
+    # invalidate everything cached from the old index
+    cls.bumpGeneration()
+    cls._DOC_CACHE_PREFIX = None
+    logging.info('Switched the product index from %s to %s', old, index_name)
+    # other instances may search the old index until they see the switch
+    defer(cls.deleteAllInIndex, index_name=old,
+          _countdown=config.OLD_INDEX_PURGE_DELAY_SECS)
+    defer(cls.deleteStaleProducts, index_name,
+          _countdown=config.OLD_INDEX_PURGE_DELAY_SECS)
+    return None
+
+  @classmethod
+  def deleteStaleProducts(cls, index_name):
+    """Delete the product entities whose documents are not in the given
+    index: after a rebuild, those of the products that are no longer in the
+    imported data.  Products created or changed while the rebuild ran were
+    written to the new index too (see _writeIndexNames), so they are
+    kept."""
+    import purge  # only needed by the admin handlers
+    return purge.purgeModel(
+        models.Product, where=lambda prod: prod.index_name != index_name)
+
+  @classmethod
+  def isSharded(cls):
+    return bool(config.PRODUCT_INDEX_SHARDING)
+
+  @classmethod
+  def _shardKeys(cls):
+    """Return the keys of all the product index shards."""
+    if config.PRODUCT_INDEX_SHARDING == 'category':
+      return sorted(categories.product_dict) + [cls._OTHER_SHARD]
+    return [str(i) for i in xrange(config.PRODUCT_INDEX_HASH_SHARDS)]
+
+  @classmethod
+  def _shardKey(cls, doc_id, category=None):
+    """Return the key of the shard holding the document with the given id
+    and category.  In hash sharding mode, the category is not needed."""
+    if config.PRODUCT_INDEX_SHARDING == 'category':
+      if category in categories.product_dict:
+        return category
+      return cls._OTHER_SHARD
+    if isinstance(doc_id, unicode):
+      doc_id = doc_id.encode('utf-8')
+    # (crc32 is stable across instances and releases, unlike hash())
+    return str((zlib.crc32(doc_id or '') & 0xffffffff) %
+               config.PRODUCT_INDEX_HASH_SHARDS)
+
+  @classmethod
+  def _shardIndex(cls, key, name=None):
+    name = name or cls.getLiveIndexName()
+    # index names can't contain whitespace
+    return cls.openIndex('%s-%s' % (name, re.sub(r'\s', '_', key)))
+
+  @classmethod
+  def getIndexes(cls, name=None):
+    """Return all the indexes holding the documents of the product index with
+    the given name (by default, the live one): the index, or if it is sharded
+    (see config.PRODUCT_INDEX_SHARDING), its shards."""
+    name = name or cls.getLiveIndexName()
+    if not cls.isSharded():
+      return [cls.openIndex(name)]
+    return [cls._shardIndex(key, name) for key in cls._shardKeys()]
+
+  @classmethod
+  def _indexesForId(cls, doc_id, index_name=None):
+    """In category sharding mode, the shard of a document can't be told from
+    its id, so all of the shards are returned."""
+    if config.PRODUCT_INDEX_SHARDING == 'hash':
+      return [cls._shardIndex(cls._shardKey(doc_id), index_name)]
+    return cls.getIndexes(index_name)
+
+  @classmethod
+  def getSearchIndexes(cls, category=None):
+    """Return the indexes to search for products, optionally in the given
+    category: in category sharding mode, that category's shard; otherwise all
+    of the product indexes."""
+    if config.PRODUCT_INDEX_SHARDING == 'category' and category:
+      return [cls._shardIndex(cls._shardKey(None, category))]
+    return cls.getIndexes()
+
+  @classmethod
+  def search(cls, query, category=None):
+    """Run the search.Query over the product index, and return the
+    search.SearchResults.  If the index is sharded, a query restricted to the
+    given category is only run on its shard, where there is one; other
+    queries are run on all the shards at once, and their results merged (see
+    scatter.py)."""
+    return cls.searchAsync(query, category).get_result()
+
+  @classmethod
+  def searchAsync(cls, query, category=None):
+    """Start the search (see search), and return an object whose get_result
+    method waits for it and returns the search.SearchResults."""
+    indexes = cls.getSearchIndexes(category)
+    if len(indexes) == 1:
+      return indexes[0].search_async(query)
+    import scatter  # only needed for sharded indexes
+    return scatter.searchShardsAsync(indexes, query)
+
+  @classmethod
+  def _put(cls, documents, index_name=None, old_categories=None):
+    """Put the documents into their shards, in parallel, and return the
+    put results in the order of the documents.  In category sharding mode,
+    a document whose product has moved to another category is removed from
+    its old shard.  old_categories maps doc ids to the categories their
+    products had before (from their entities), or to None for new products;
+    if it isn't given, the documents are removed from all the other
+    shards."""
+    if not cls.isSharded():
+      return cls.getIndexes(index_name)[0].put(documents)
+    index_name = index_name or cls.getLiveIndexName()
+    positions = {}
+    for i, doc in enumerate(documents):
+      key = cls._shardKey(doc.doc_id, cls(doc).getCategory())
+      positions.setdefault(key, []).append(i)
+    pending = []
+    for key, shard_positions in positions.iteritems():
+      index = cls._shardIndex(key, index_name)
+      pending.append((shard_positions, index.put_async(
+          [documents[i] for i in shard_positions])))
+    stale = []
+    if config.PRODUCT_INDEX_SHARDING == 'category':
+      moved = {}  # shard key -> ids of the documents that have left it
+      for key, shard_positions in positions.iteritems():
+        for i in shard_positions:
+          doc_id = documents[i].doc_id
+          if old_categories is None:
+            old_keys = cls._shardKeys()
+          elif old_categories.get(doc_id) is not None:
+            old_keys = [cls._shardKey(doc_id, old_categories[doc_id])]
+          else:
+            continue
+          for old_key in old_keys:
+            if old_key != key:
+              moved.setdefault(old_key, []).append(doc_id)
+      stale = [cls._shardIndex(key, index_name).delete_async(doc_ids)
+               for key, doc_ids in moved.iteritems()]
+    results = [None] * len(documents)
+    for shard_positions, future in pending:
+      for i, result in zip(shard_positions, future.get_result()):
+        results[i] = result
+    for future in stale:
+      try:
+        future.get_result()
+      except search.Error:
+        logging.exception('Error removing documents from their old shards.')
+    return results
 
   @classmethod
   def getSortMenu(cls):
@@ -221,14 +782,228 @@ class Product(BaseDocumentManager):
   @classmethod
   def getDocFromPid(cls, pid):
     """Given a pid, get its doc. We're using the pid as the doc id, so we can
-    do this via a direct fetch."""
-    return cls.getDoc(pid)
+    do this via a direct fetch (or from the document cache; see
+    getDocsFromPids)."""
+    return cls.getDocsFromPids([pid]).get(pid)
+
+  @classmethod
+  def getDocsFromPids(cls, pids):
+    """Given a list of pids, return a dict mapping each to its doc (or to
+    None, if it has none).  The docs are read through a cache: those not
+    cached are fetched in parallel, and cached, as are the pids with no doc.
+    The cache is updated whenever products are indexed (see add), and
+    invalidated when they are removed."""
+    keys = dict((pid, cls._docCacheKey(pid)) for pid in set(pids) if pid)
+    cached = cls._DOC_CACHE.getMulti(keys.values())
+    res = {}
+    missing = []
+    for pid in set(pids):
+      value = cached.get(keys.get(pid))
+      if not pid or value == cls._DOC_NOT_FOUND:
+        res[pid] = None
+      elif value is None:
+        missing.append(pid)
+      else:
+        res[pid] = pickle.loads(value)
+    if missing:
+      fetched = cls.getDocs(missing)
+      # add rather than set, so as not to overwrite a doc indexed meanwhile
+      cls._DOC_CACHE.setMulti(
+          dict((keys[pid], cls._serializeDoc(doc))
+               for pid, doc in fetched.iteritems()),
+          add=True)
+      res.update(fetched)
+    return res
+
+  @classmethod
+  def _docCacheKey(cls, pid):
+    now = time.time()
+    local = cls._DOC_CACHE_PREFIX
+    if local and now - local[1] < config.PRODUCT_DOC_CACHE_LOCAL_SECS:
+      prefix = local[0]
+    else:
+      prefix = '%s|%s' % (cls.getLiveIndexName(),
+                          cache.getVersion(cls._DOC_CACHE_VERSION))
+      cls._DOC_CACHE_PREFIX = (prefix, now)
+    return '%s|%s' % (prefix, pid)
+
+  @classmethod
+  def _serializeDoc(cls, doc):
+    if doc is None:
+      return cls._DOC_NOT_FOUND
+    return pickle.dumps(doc, pickle.HIGHEST_PROTOCOL)
+
+  @classmethod
+  def add(cls, documents, index_name=None, old_categories=None,
+          building=None):
+    """Add the documents to the product index (by default, the live one), as
+    BaseDocumentManager.add does.  The documents added to the live index
+    replace those in the document cache, and are applied to this instance's
+    autocomplete prefix index; if the add fails, they are removed from the
+    cache.  old_categories maps the doc ids to the categories their products
+    had before (see _put).  If the name of the index being built by a
+    rebuild is given (building), the documents are first added to it too
+    (see _writeIndexNames); if that fails, None is returned, and the other
+    index is left as it was."""
+    if isinstance(documents, search.Document):
+      documents = [documents]
+    if building:
+      # the index being built isn't searched yet, so its generation isn't
+      # bumped
+      try:
+        cls._put(documents, building, old_categories=old_categories)
+      except search.Error:
+        logging.exception('Error adding documents to index %s.', building)
+        return None
+    results, generation = super(Product, cls)._add(
+        documents, index_name, old_categories=old_categories)
+    if not index_name or index_name == cls.getLiveIndexName():
+      keys = [cls._docCacheKey(doc.doc_id) for doc in documents]
+      if results is None:
+        for key in keys:
+          cls._DOC_CACHE.delete(key)
+      else:
+        cls._DOC_CACHE.setMulti(dict(
+            (key, cls._serializeDoc(doc))
+            for key, doc in zip(keys, documents)))
+        cls._updateSuggestSnapshot(generation, docs=documents)
+    return results
+
+  @classmethod
+  def deleteAllInIndex(cls, callback=None, index_name=None, keep=None):
+    """Delete all the docs in the product index (by default, the live one),
+    except those whose ids are in keep, if given.  Purging the live index
+    invalidates the document cache."""
+    try:
+      return super(Product, cls).deleteAllInIndex(callback, index_name, keep)
+    finally:
+      if not index_name or index_name == cls.getLiveIndexName():
+        cache.bumpVersion(cls._DOC_CACHE_VERSION)
+        cls._DOC_CACHE_PREFIX = None
 
   @classmethod
   def removeProductDocByPid(cls, pid):
-    """Given a doc's pid, remove the doc matching it from the product
-    index."""
-    cls.removeDocById(pid)
+    """Given a doc's pid, remove the doc matching it from the product index,
+    and from the index being built to replace it, if any."""
+    live, building = cls._writeIndexNames()
+    if building:
+      cls._deleteDoc(pid, building)
+    generation = cls.removeDocById(pid, live)
+    cls._DOC_CACHE.delete(cls._docCacheKey(pid))
+    if generation is not None:
+      cls._updateSuggestSnapshot(generation, removed=[pid])
+
+  @classmethod
+  def getSuggestIndex(cls):
+    """Return the prefix index over the product names and brands used for
+    autocompletion, or None if this instance has none yet.  Like
+    Store.getSnapshot, the index is tagged with the index generation it was
+    built from, but the generation is only checked every
+    config.AUTOCOMPLETE_CHECK_SECS, to save a memcache call per keystroke.
+    The index is never rebuilt from the product index on the request path:
+    if it is stale, it is rebuilt from the names shared in memcache for the
+    current generation, or if there are none yet, a deferred task is started
+    to read them (see refreshSuggestIndex), and the stale index is returned
+    meanwhile."""
+    snapshot = cls._SUGGEST_SNAPSHOT
+    now = time.time()
+    if snapshot and now - snapshot[2] < config.AUTOCOMPLETE_CHECK_SECS:
+      return snapshot[1]
+    generation = cls.getGeneration()
+    if snapshot and snapshot[0] == generation:
+      cls._SUGGEST_SNAPSHOT = (generation, snapshot[1], now)
+      return snapshot[1]
+    products = cls._loadSuggestProducts(generation)
+    if products is not None:
+      import prefix_index  # only needed for autocompletion
+      pindex = prefix_index.PrefixIndex(products)
+      cls._SUGGEST_SNAPSHOT = (generation, pindex, now)
+      return pindex
+    _deferRefresh(cls.refreshSuggestIndex, 'suggest')
+    if snapshot:
+      cls._SUGGEST_SNAPSHOT = (snapshot[0], snapshot[1], now)
+      return snapshot[1]
+    cls._SUGGEST_SNAPSHOT = (None, None, now)
+    return None
+
+  @classmethod
+  def _loadSuggestProducts(cls, generation):
+    """Return the dict of product names and brands shared in memcache for
+    the generation (see _publishSuggestProducts), or None if there is none."""
+    count = memcache.get(str(generation), namespace=cls._SUGGEST_NAMESPACE)
+    if count is None:
+      return None
+    keys = ['%s:%d' % (generation, i) for i in xrange(count)]
+    chunks = memcache.get_multi(keys, namespace=cls._SUGGEST_NAMESPACE)
+    if len(chunks) != count:
+      return None
+    return pickle.loads(zlib.decompress(''.join(chunks[k] for k in keys)))
+
+  @classmethod
+  def _publishSuggestProducts(cls, generation, products):
+    """Share the dict of product names and brands in memcache for the
+    generation.  The chunk count is written last, so that the chunks are all
+    there once it can be read."""
+    data = zlib.compress(pickle.dumps(products, pickle.HIGHEST_PROTOCOL))
+    size = cls._SUGGEST_CHUNK_SIZE
+    chunks = dict(('%s:%d' % (generation, i // size), data[i:i + size])
+                  for i in xrange(0, len(data), size))
+    if memcache.set_multi(chunks, namespace=cls._SUGGEST_NAMESPACE):
+      logging.warn('Could not share the autocomplete product names')
+      return
+    memcache.set(str(generation), len(chunks),
+                 namespace=cls._SUGGEST_NAMESPACE)
+
+  @classmethod
+  def refreshSuggestIndex(cls):
+    """Rebuild the autocomplete prefix index from the documents in the product
+    index, share the product names it is built from with the other instances
+    (see getSuggestIndex), and return it (or None on error).  This reads
+    every document, so it is run in a deferred task, or at warmup.  The
+    generation is read first, so that if the index changes while it is being
+    read, the prefix index will be stale."""
+    generation = cls.getGeneration()
+    products = {}
+    try:
+      for index in cls.getIndexes():
+        start_id = None
+        while True:
+          response = index.get_range(
+              start_id=start_id, include_start_object=False, limit=1000)
+          if not response.results:
+            break
+          for doc in response.results:
+            pdoc = cls(doc)
+            products[doc.doc_id] = (pdoc.getName(), pdoc.getBrand())
+          start_id = response.results[-1].doc_id
+    except search.Error:
+      logging.exception('Error reading the product names:')
+      return None
+    cls._publishSuggestProducts(generation, products)
+    import prefix_index  # only needed for autocompletion
+    pindex = prefix_index.PrefixIndex(products)
+    cls._SUGGEST_SNAPSHOT = (generation, pindex, time.time())
+    return pindex
+
+  @classmethod
+  def _updateSuggestSnapshot(cls, generation, docs=(), removed=()):
+    """Apply a successful change made by this instance to the product index
+    to its autocomplete prefix index.  Each change bumps the index generation
+    once, and the generation given is the one this change bumped it to: if
+    that is one more than the generation of the prefix index, no other change
+    has been made since it was built, and the updated prefix index is
+    current.  Otherwise it is left to be rebuilt."""
+    snapshot = cls._SUGGEST_SNAPSHOT
+    if not snapshot or snapshot[1] is None or generation is None:
+      return
+    if generation != snapshot[0] + 1:
+      return
+    products = {}
+    for doc in docs:
+      pdoc = cls(doc)
+      products[doc.doc_id] = (pdoc.getName(), pdoc.getBrand())
+    cls._SUGGEST_SNAPSHOT = (
+        generation, snapshot[1].withProducts(products, removed), time.time())
 
   
 
@@ -246,6 +1021,11 @@ class Product(BaseDocumentManager):
     """Get the value of the 'description' field of a Product doc."""
     return self.getFieldVal(self.DESCRIPTION)
 
+  def getBrand(self):
+    """Get the value of the 'brand' field of a Product doc, or None if it has
+    none."""
+    return self.getFieldVal(self.BRAND)
+
   def getCategory(self):
     """Get the value of the 'cat' field of a Product doc."""
     return self.getFieldVal(self.CATEGORY)
@@ -258,8 +1038,23 @@ class Product(BaseDocumentManager):
     """Get the value of the 'price' field of a Product doc."""
     return self.getFieldVal(self.PRICE)
 
-  
-  
+  def getUpdated(self):
+    """Get the value of the 'modified' field of a Product doc."""
+    return self.getFieldVal(self.UPDATED)
+
+  def getDescriptionSnippet(self):
+    """Get the description snippet returned with a search result, or the
+    'description' field if there is none (snippeting is not supported on the
+    dev app server)."""
+    snippet = self.getExpressionVal(self.DESCRIPTION)
+    if snippet is None:
+      return self.getDescription()
+    return snippet
+
+  def getAdjustedPrice(self):
+    """Get the 'adjusted_price' expression returned with a search result,
+    or None if there is none."""
+    return self.getExpressionVal(self.ADJUSTED_PRICE)
 
   @classmethod
   def _buildCoreProductFields(
@@ -340,6 +1135,17 @@ class Product(BaseDocumentManager):
           params['category_name'])
     return fields
 
+  @classmethod
+  def _buildProductFacets(cls, category, price, brand=None):
+    """Construct the facets of a product document, whose value counts are
+    returned with search results for faceted navigation (see
+    handlers.ProductSearchHandler._buildQuery)."""
+    facets = [search.AtomFacet(name=cls.CATEGORY, value=category),
+              search.NumberFacet(name=cls.PRICE, value=price)]
+    if brand:
+      facets.append(search.AtomFacet(name=cls.BRAND, value=brand))
+    return facets
+
   @classmethod
   def _createDocument(
       cls, pid=None, category=None, name=None, description=None,
@@ -360,7 +1166,9 @@ class Product(BaseDocumentManager):
       # build and index the document.  Use the pid (product id) as the doc id.
       # (If we did not do this, and left the doc_id unspecified, an id would be
       # auto-generated.)
-      d = search.Document(doc_id=pid, fields=resfields)
+      d = search.Document(doc_id=pid, fields=resfields,
+                          facets=cls._buildProductFacets(
+                              category, price, params.get(cls.BRAND)))
       return d
     else:
       raise errors.OperationFailedError('Missing parameter.')
@@ -391,32 +1199,109 @@ class Product(BaseDocumentManager):
       raise errors.OperationFailedError(e2.error_message)
 
   @classmethod
-  def buildProductBatch(cls, rows):
-    """Build product documents and their related datastore entities, in batch,
-    given a list of params dicts.  Should be used for new products, as does not
-    handle updates of existing product entities. This method does not require
-    that the doc ids be tied to the product ids, and obtains the doc ids from
-    the results of the document add."""
+  def newImportCounts(cls):
+    """Return the dict counting the rows of an import that were written,
+    skipped because the product was unchanged, or failed."""
+    return {'written': 0, 'skipped': 0, 'failed': 0}
 
-    docs = []
-    dbps = []
+  @classmethod
+  def _count(cls, counts, key, n):
+    # the stages of a pipelined import update the counts from their own
+    # threads.
+    with _IMPORT_COUNTS_LOCK:
+      counts[key] += n
+
+  @classmethod
+  def _changedParams(cls, rows, counts, index_name=None):
+    """Normalize a list of params dicts, and fetch the entities of their
+    products with one get_multi.  Returns a list of (params, entity) pairs
+    for the products that are new (with an entity of None) or have changed
+    since they were last built (see models.Product.contentHash); the others
+    are counted as skipped.  Products are only skipped if they were last
+    written to the given product index (by default, the live one), so that
+    those missing from it are rewritten.  If a pid appears in more than one
+    row, the last row wins.  Rows that can't be normalized are logged and
+    counted as failed."""
+    by_pid = {}
     for row in rows:
       try:
         params = cls._normalizeParams(row)
-        doc = cls._createDocument(**params)
-        docs.append(doc)
-        # create product entity, sans doc_id
-        dbp = models.Product(
-            id=params['pid'], price=params['price'],
-            category=params['category'])
-        dbps.append(dbp)
+        by_pid[params['pid']] = params
       except errors.OperationFailedError:
         logging.error('error creating document from data: %s', row)
+        cls._count(counts, 'failed', 1)
+    index_name = index_name or cls.getLiveIndexName()
+    pids = by_pid.keys()
+    prods = ndb.get_multi([ndb.Key(models.Product, pid) for pid in pids])
+    changed = []
+    for pid, prod in zip(pids, prods):
+      params = by_pid[pid]
+      if (prod and prod.content_hash == models.Product.contentHash(params)
+          and prod.index_name == index_name):
+        continue
+      changed.append((params, prod))
+    cls._count(counts, 'skipped', len(pids) - len(changed))
+    return changed
+
+  @classmethod
+  def _createDocuments(cls, changed, counts):
+    """Build the documents for a list of (params, entity) pairs, as returned
+    by _changedParams.  Returns a list of (params, entity, document) tuples;
+    the rows whose document can't be built are logged and counted as
+    failed."""
+    res = []
+    for params, prod in changed:
+      try:
+        res.append((params, prod, cls._createDocument(**params)))
+      except errors.OperationFailedError:
+        logging.error('error creating document from data: %s', params)
+        cls._count(counts, 'failed', 1)
+    return res
+
+  @classmethod
+  def _prepareProductBatch(cls, rows, counts, index_name=None):
+    """Normalize a list of params dicts, and build the product documents and
+    related datastore entities (sans doc ids) of the new and changed
+    products, for the given product index (by default, the live one).
+    Returns a (documents, entities, old categories, counts) tuple; the old
+    categories map the doc ids to those of the existing entities (see
+    _put)."""
+
+    docs = []
+    dbps = []
+    old_categories = {}
+    for params, prod, doc in cls._createDocuments(
+        cls._changedParams(rows, counts, index_name), counts):
+      docs.append(doc)
+      old_categories[doc.doc_id] = prod.category if prod else None
+      # create product entity, sans doc_id
+      dbp = models.Product(
+          id=params['pid'], price=params['price'],
+          category=params['category'],
+          content_hash=models.Product.contentHash(params))
+      dbps.append(dbp)
+    return docs, dbps, old_categories, counts
+
+  @classmethod
+  def _indexProductBatch(cls, batch, index_name=None, building=None):
+    """Index the documents of a batch built by _prepareProductBatch into the
+    given product index (by default, the live one), and the index being
+    built to replace it, if given (see add), and set the resulting doc ids on
+    its entities.  Returns an (entities, counts) pair, or None if there was
+    nothing to index or indexing failed."""
+
+    docs, dbps, old_categories, counts = batch
+    if not docs:
+      return None
     try:
-      add_results = cls.add(docs)
+      add_results = cls.add(docs, index_name=index_name,
+                            old_categories=old_categories, building=building)
     except search.Error:
       logging.exception('Add failed')
-      return
+      add_results = None
+    if add_results is None:  # the error has been logged
+      cls._count(counts, 'failed', len(docs))
+      return None
     if len(add_results) != len(dbps):
       # this case should not be reached; if there was an issue,
       # search.Error should have been thrown, above.
@@ -424,10 +1309,108 @@ class Product(BaseDocumentManager):
           'Error: wrong number of results returned from indexing operation')
     # now set the entities with the doc ids, the list of which are returned in
     # the same order as the list of docs given to the indexers
+    target = building or index_name or cls.getLiveIndexName()
     for i, dbp in enumerate(dbps):
       dbp.doc_id = add_results[i].id
-    # persist the entities
+      dbp.index_name = target
+    return dbps, counts
+
+  @classmethod
+  def _putProductBatch(cls, batch):
+    """Persist the entities of a batch indexed by _indexProductBatch."""
+    dbps, counts = batch
     ndb.put_multi(dbps)
+    cls._count(counts, 'written', len(dbps))
+
+  @classmethod
+  def buildProductBatch(cls, rows, index_name=None):
+    """Build product documents and their related datastore entities, in batch,
+    given a list of params dicts, for new products and for existing ones that
+    have changed.  Their entities are created afresh rather than updated, as
+    upsertProductBatch and buildProduct do, so the other properties of an
+    existing entity (such as active) are reset.  This method does not
+    require that the doc ids be tied to the product ids, and obtains the doc
+    ids from the results of the document add.  Products that are unchanged
+    since they were last built into the index are skipped.  The documents are
+    added to the given product index (by default, the live one, and while a
+    rebuild runs, the index being built too; see _writeIndexNames).  Returns
+    the import counts (see newImportCounts)."""
+
+    counts = cls.newImportCounts()
+    building = None
+    if not index_name:
+      index_name, building = cls._writeIndexNames()
+    batch = cls._indexProductBatch(
+        cls._prepareProductBatch(rows, counts, building or index_name),
+        index_name, building)
+    if batch:
+      cls._putProductBatch(batch)
+    return counts
+
+  @classmethod
+  def buildProductBatches(cls, row_batches, index_name=None):
+    """Build the products for a sequence of batches of params dicts, as
+    buildProductBatch does for each batch, but pipelined: while the entities
+    of batch N-1 are being written to the datastore and the documents of batch
+    N are being indexed, batch N+1 is parsed and normalized.  At most
+    config.IMPORT_PIPELINE_DEPTH batches wait between stages, so a slow stage
+    holds back the parsing of new rows rather than buffering them all.
+    Returns the import counts for all the batches."""
+
+    counts = cls.newImportCounts()
+    building = None
+    if not index_name:
+      index_name, building = cls._writeIndexNames()
+    utils.runPipeline(
+        (cls._prepareProductBatch(rows, counts, building or index_name)
+         for rows in row_batches),
+        [lambda batch: cls._indexProductBatch(batch, index_name, building),
+         cls._putProductBatch],
+        depth=config.IMPORT_PIPELINE_DEPTH)
+    return counts
+
+  @classmethod
+  def upsertProductBatch(cls, rows, index_name=None):
+    """Create or update the products for a list of params dicts, in batch: the
+    related entities are fetched with one get_multi, the documents of the new
+    and changed products are (re)indexed with one index put, and their
+    entities are created or updated and written with one put_multi.  Unlike
+    buildProduct, the entities are not updated in a transaction, so this is
+    meant for bulk updates.  The documents are added to the given product index
+    (by default, the live one, and while a rebuild runs, the index being built
+    too; see _writeIndexNames).  Returns the import counts (see
+    newImportCounts)."""
+
+    counts = cls.newImportCounts()
+    building = None
+    if not index_name:
+      index_name, building = cls._writeIndexNames()
+    target = building or index_name
+    changed = cls._createDocuments(
+        cls._changedParams(rows, counts, target), counts)
+    if not changed:
+      return counts
+    docs = [doc for _, _, doc in changed]
+    add_results = cls.add(docs, index_name=index_name, old_categories=dict(
+        (doc.doc_id, prod.category if prod else None)
+        for _, prod, doc in changed), building=building)
+    if add_results is None:  # the error has been logged by add()
+      cls._count(counts, 'failed', len(docs))
+      return counts
+    prods = []
+    for (params, prod, _), add_result in zip(changed, add_results):
+      if prod:
+        prod.update_core(params, add_result.id, target)
+      else:
+        prod = models.Product(
+            id=params['pid'], price=params['price'],
+            category=params['category'], doc_id=add_result.id,
+            content_hash=models.Product.contentHash(params),
+            index_name=target)
+      prods.append(prod)
+    ndb.put_multi(prods)
+    cls._count(counts, 'written', len(prods))
+    return counts
 
   @classmethod
   def buildProduct(cls, params):
@@ -435,20 +1418,24 @@ class Product(BaseDocumentManager):
     product id and the field values are taken from the params dict.
     """
     params = cls._normalizeParams(params)
-    # check to see if doc already exists.  We do this because we need to retain
-    # some information from the existing doc.  We could skip the fetch if this
-    # were not the case.
-   """ curr_doc = cls.getDocFromPid(params['pid'])
+    live, building = cls._writeIndexNames()
+    # while a rebuild runs, the product is written to the new index too, and
+    # its entity stamped with it
+    index_name = building or live
+    prod = models.Product.get_by_id(params['pid'])
+    if (prod and prod.content_hash == models.Product.contentHash(params)
+        and prod.index_name == index_name):
+      # nothing has changed since the product was last built into the index
+      logging.debug('product %s is unchanged', params['pid'])
+      return prod
     d = cls._createDocument(**params)
-    if curr_doc:  #  retain ratings info from existing doc
-      avg_rating = cls(curr_doc).getAvgRating()
-      cls(d).setAvgRating(avg_rating)"""
 
     # This will reindex if a doc with that doc id already exists
-    doc_ids = cls.add(d)
+    doc_ids = cls.add(d, index_name=live, old_categories={
+        d.doc_id: prod.category if prod else None}, building=building)
     try:
       doc_id = doc_ids[0].id
-    except IndexError:
+    except (IndexError, TypeError):  # no result, or the add failed
       doc_id = None
       raise errors.OperationFailedError('could not index document')
     logging.debug('got new doc id %s for product: %s', doc_id, params['pid'])
@@ -459,9 +1446,9 @@ class Product(BaseDocumentManager):
       # from the params, but preserve its ratings-related info.
       prod = models.Product.get_by_id(params['pid'])
       if prod:  #update
-        prod.update_core(params, doc_id)
+        prod.update_core(params, doc_id, index_name)
       else:   # create new entity
-        prod = models.Product.create(params, doc_id)
+        prod = models.Product.create(params, doc_id, index_name)
       prod.put()
       return prod
     prod = ndb.transaction(_tx)
@@ -14,22 +14,28 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-"""Contains the non-admin ('user-facing') request handlers for the app."""
+"""Contains the non-admin ('user-facing') request handlers for the app.
 
+Every route here needs the docs module; the modules that only some of the
+handlers use are imported by the code that uses them (see main.py).
+"""
 
+
+import datetime
+import hashlib
 import logging
+import os
+import re
 import urllib
+import uuid
 import wsgiref
 
 from base_handler import BaseHandler
 import config
 import docs
-import models
 import utils
 
 from google.appengine.api import search
-from google.appengine.api import users
-from google.appengine.ext.deferred import defer
 from google.appengine.ext import ndb
 
 
@@ -37,6 +43,7 @@ class IndexHandler(BaseHandler):
   """Displays the 'home' page."""
 
   def get(self):
+    import models
     cat_info = models.Category.getCategoryInfo()
     sort_info = docs.Product.getSortMenu()
     template_values = {
@@ -46,8 +53,20 @@ class IndexHandler(BaseHandler):
     self.render_template('index.html', template_values)
 
 
+class WarmupHandler(BaseHandler):
+  """Handles warmup requests, building the instance's cached state (see
+  warmup.run) before it receives user requests."""
+
+  def get(self):
+    import warmup
+    self.render_json(warmup.run(self.jinja2.environment))
+
+
 class ShowProductHandler(BaseHandler):
-  """Display product details."""
+  """Display product details.  The page has an ETag and a Last-Modified
+  date, so that a browser or the edge cache revalidating its copy gets a 304,
+  without the page being rendered, until the product changes.  Pages for
+  anonymous users may be cached for config.PRODUCT_PAGE_MAX_AGE seconds."""
 
   def parseParams(self):
     """Filter the param set to the expected params."""
@@ -86,6 +105,17 @@ class ShowProductHandler(BaseHandler):
       return self.abort(404, error_message)
       logging.error(error_message)
     pdoc = docs.Product(doc)
+    user = self.current_user
+    if user:
+      # the page shows the user's login and admin links
+      self.response.headers['Cache-Control'] = 'private, no-cache'
+    else:
+      self.response.headers['Cache-Control'] = (
+          'public, max-age=%d' % config.PRODUCT_PAGE_MAX_AGE)
+    self.response.headers['Vary'] = 'Cookie'
+    if self.notModified(self._etag(doc, user),
+                        self._lastModified(pdoc.getUpdated())):
+      return
     pname = pdoc.getName()
     app_url = wsgiref.util.application_uri(self.request.environ)
     #rlink = '/reviews?' + urllib.urlencode({'pid': pid, 'pname': pname})
@@ -99,18 +129,100 @@ class ShowProductHandler(BaseHandler):
         'category': pdoc.getCategory(),
         'prod_doc': doc,
         # for this demo, 'admin' status simply equates to being logged in
-        'user_is_admin': users.get_current_user()}
+        'user_is_admin': user}
     self.render_template('product.html', template_values)
 
+  @classmethod
+  def _etag(cls, doc, user):
+    """Return the ETag of the page for the document: a hash of its fields,
+    the user it is shown to, and the app version, whose templates render
+    it."""
+    digest = hashlib.md5()
+    digest.update('%s|%s|%s' % (
+        os.environ.get('CURRENT_VERSION_ID', ''),
+        user.user_id() if user else '', doc.doc_id))
+    for field in doc.fields:
+      digest.update('|%s=%r' % (field.name, field.value))
+    return digest.hexdigest()
+
+  @classmethod
+  def _lastModified(cls, updated):
+    """Return the Last-Modified time of the page for a document with the
+    given 'modified' date (see docs.Product._buildCoreProductFields).  As the
+    date doesn't tell when in the day the document was modified, this is the
+    end of that day, or the current time if that is earlier: a page served
+    before the day is over may then be superseded by a later change that day,
+    and is revalidated by its ETag only."""
+    if updated is None:
+      return None
+    # the search service returns a DateField's value as a datetime, at
+    # midnight of the date
+    if isinstance(updated, datetime.datetime):
+      updated = updated.date()
+    updated = datetime.datetime.combine(updated, datetime.time())
+    updated += datetime.timedelta(days=1)
+    return min(updated, datetime.datetime.utcnow()).replace(microsecond=0)
+
+
+
+
+
+class ProductsHandler(BaseHandler):
+  """Returns the documents of several products as JSON, given their product
+  ids as a comma-separated 'pids' param.  The documents are fetched in
+  parallel (see docs.Product.getDocsFromPids)."""
 
+  def get(self):
+    pids = [pid.strip() for pid in self.request.get('pids').split(',')]
+    pids = [pid for pid in pids if pid]
+    if len(pids) > config.MAX_BATCH_PIDS:
+      self.abort(400, 'At most %d pids may be requested at once.' %
+                 config.MAX_BATCH_PIDS)
+    pdocs = docs.Product.getDocsFromPids(pids)
+    products = []
+    missing = []
+    for pid in pids:
+      doc = pdocs.get(pid)
+      if doc:
+        products.append(docs.Product(doc).asDict())
+      else:
+        missing.append(pid)
+    self.render_json({'products': products, 'missing': missing})
 
 
+class AutocompleteHandler(BaseHandler):
+  """Suggests product names and brands starting with the given prefix, as
+  JSON, from an in-memory prefix index (see docs.Product.getSuggestIndex)."""
+
+  def get(self):
+    prefix = self.request.get('prefix', '')
+    try:
+      limit = int(self.request.get('limit', config.AUTOCOMPLETE_MAX_RESULTS))
+    except ValueError:
+      limit = config.AUTOCOMPLETE_MAX_RESULTS
+    limit = utils.intClamp(limit, 1, config.AUTOCOMPLETE_MAX_RESULTS)
+    pindex = docs.Product.getSuggestIndex()
+    suggestions = []
+    if pindex is not None:
+      suggestions = [{'type': kind, 'text': text, 'pid': pid}
+                     for kind, text, pid in pindex.lookup(prefix, limit)]
+    self.render_json({'prefix': prefix, 'suggestions': suggestions})
+
 
 class ProductSearchHandler(BaseHandler):
   """The handler for doing a product search."""
 
   _DEFAULT_DOC_LIMIT = 3  #default number of search results to display per page.
   _OFFSET_LIMIT = 1000
+  _CURSOR_STACK_NAMESPACE = 'cursorstack'
+  # the label of a number facet range, e.g. '[100.0,250.0)'
+  _RANGE_LABEL_RE = re.compile(r'^\[([^,]*),([^)]*)\)$')
+  # the params that are reset when a facet value is selected
+  _PAGING_PARAMS = ('offset', 'cursor', 'page', 'cstack')
+
+  # search results, keyed on the normalized query and the index generation
+  # (see _resultCache).
+  _RESULT_CACHE = None
 
   def parseParams(self):
     """Filter the param set to the expected params."""
@@ -118,8 +230,15 @@ class ProductSearchHandler(BaseHandler):
         'qtype': '',
         'query': '',
         'category': '',
+        # facet refinements, e.g. brand=Acme&price=100-250
+        'brand': '',
+        'price': '',
         'sort': '',
-        'offset': '0'
+        'offset': '0',
+        # used in cursor pagination mode (see config.PAGINATION_MODE)
+        'cursor': '',
+        'page': '0',
+        'cstack': ''
     }
     for k, v in params.iteritems():
       # Possibly replace default values.
@@ -140,6 +259,9 @@ class ProductSearchHandler(BaseHandler):
       logging.error('DOC_LIMIT not properly set in config file; using default.')
     return doc_limit
 
+  # toplevel waits for the RPCs that the request starts without waiting for
+  # their results (the cursor stack update), before the request ends.
+  @ndb.toplevel
   def get(self):
     """Handle a product search request."""
 
@@ -147,32 +269,55 @@ class ProductSearchHandler(BaseHandler):
     self.doProductSearch(params)
 
   def doProductSearch(self, params):
-    """Perform a product search and display the results."""
+    """Perform a product search and display the results.  The lookups that
+    the page needs don't wait for each other: the category menu, the index
+    generation and the cursor stack are read from memcache together, the
+    search is started as soon as it is known not to be cached, and the user
+    service is called for the sidebar links while the search runs."""
 
+    import models
     # the defined product categories
-    cat_info = models.Category.getCategoryInfo()
+    cat_future = models.Category.getCategoryInfoAsync()
     # the product fields that we can sort on from the UI, and their mappings to
     # search.SortExpression parameters
     sort_info = docs.Product.getSortMenu()
     sort_dict = docs.Product.getSortDict()
-    query = params.get('query', '')
-    user_query = query
+    user_query = params.get('query', '')
     doc_limit = self._getDocLimit()
-
     categoryq = params.get('category')
-    if categoryq:
-      # add specification of the category to the query
-      # Because the category field is atomic, put the category string
-      # in quotes for the search.
-      query += ' %s:"%s"' % (docs.Product.CATEGORY, categoryq)
+    query = self._buildQueryString(params)
 
     sortq = params.get('sort')
-    try:
-      offsetval = int(params.get('offset', 0))
-    except ValueError:
-      offsetval = 0
-
-    
+    websafe_cursor = None
+    if self._usesCursors():
+      # The cursor param determines where the page starts; the page number
+      # is only used to display the result range and to navigate the
+      # cursor stack.
+      websafe_cursor = params.get('cursor', '')
+      offsetval = self._getPageNumber(params) * doc_limit
+    else:
+      try:
+        offsetval = int(params.get('offset', 0))
+      except ValueError:
+        offsetval = 0
+
+    stack_future = None
+    if self._usesCursors():
+      stack_future = self._getCursorStackAsync(params)
+    # this waits for the memcache lookups, which run concurrently, and
+    # leaves the search, if any, in progress.
+    key, search_results, pending = self._startSearchAsync(
+        query, sortq, sort_dict, doc_limit, offsetval, websafe_cursor,
+        category=categoryq).get_result()
+    # build the sidebar links (a user service call) while the search runs
+    sidebar = self.sidebar_links
+    cat_info = cat_future.get_result()
+    if search_results is None:
+      search_results = self._finishSearch(key, pending)
+    if search_results is None:
+      logging.error('Search failed for query %s', query)
+      search_results = search.SearchResults(number_found=0)
+    returned_count = len(search_results.results)
 
     # cat_name = models.Category.getCategoryName(categoryq)
     psearch_response = []
@@ -180,19 +325,14 @@ class ProductSearchHandler(BaseHandler):
     for doc in search_results:
       # logging.info("doc: %s ", doc)
       pdoc = docs.Product(doc)
-      # use the description field as the default description snippet, since
-      # snippeting is not supported on the dev app server.
-      description_snippet = pdoc.getDescription()
+      # the description field is used as the default description snippet,
+      # since snippeting is not supported on the dev app server.
+      description_snippet = pdoc.getDescriptionSnippet()
       price = pdoc.getPrice()
-      # on the dev app server, the doc.expressions property won't be populated.
-      for expr in doc.expressions:
-        if expr.name == docs.Product.DESCRIPTION:
-          description_snippet = expr.value
-        # uncomment to use 'adjusted price', which should be
-        # defined in returned_expressions in _buildQuery() below, as the
-        # displayed price.
-        # elif expr.name == 'adjusted_price':
-          # price = expr.value
+      # uncomment to use 'adjusted price', which is defined in
+      # returned_expressions in _buildQuery() below, as the displayed price.
+      # On the dev app server, the returned expressions won't be populated.
+      # price = pdoc.getAdjustedPrice() or price
 
       # get field information from the returned doc
       pid = pdoc.getPID()
@@ -212,7 +352,8 @@ class ProductSearchHandler(BaseHandler):
     # Build the next/previous pagination links for the result set.
     (prev_link, next_link) = self._generatePaginationLinks(
         offsetval, returned_count,
-        search_results.number_found, params)
+        search_results.number_found, params, search_results.cursor,
+        stack_future)
 
     logging.debug('returned_count: %s', returned_count)
     # construct the template values
@@ -225,66 +366,283 @@ class ProductSearchHandler(BaseHandler):
         'returned_count': returned_count,
         'number_found': search_results.number_found,
         'search_response': psearch_response,
+        'facets': self._buildFacetInfo(search_results, params),
         'cat_info': cat_info, 'sort_info': sort_info}
+    template_values.update(sidebar)
     # render the result page.
     self.render_template('index.html', template_values)
 
-  def _buildQuery(self, query, sortq, sort_dict, doc_limit, offsetval):
-    """Build and return a search query object."""
+  @classmethod
+  def _buildQueryString(cls, params):
+    """Build the search query string for the request params: the user's
+    query, restricted to the selected category, brand and price range."""
+    query = params.get('query', '')
+    categoryq = params.get('category')
+    if categoryq:
+      # add specification of the category to the query
+      # Because the category field is atomic, put the category string
+      # in quotes for the search.
+      query += ' %s:"%s"' % (docs.Product.CATEGORY, categoryq)
+    brandq = params.get('brand')
+    if brandq:
+      query += ' %s:"%s"' % (docs.Product.BRAND, brandq.replace('"', ''))
+    price_range = cls._parsePriceParam(params.get('price'))
+    if price_range:
+      start, end = price_range
+      if start is not None:
+        query += ' %s >= %s' % (docs.Product.PRICE, start)
+      if end is not None:
+        query += ' %s < %s' % (docs.Product.PRICE, end)
+    return query
+
+  @classmethod
+  def _formatPriceParam(cls, start, end):
+    """Format a price range as the value of the 'price' param, e.g.
+    '100-250', or '1000-' for an open end."""
+    return '%s-%s' % ('' if start is None else '%g' % start,
+                      '' if end is None else '%g' % end)
+
+  @classmethod
+  def _parsePriceParam(cls, value):
+    """Return the (start, end) price range of a 'price' param value, with
+    None for an open end, or None if the value isn't a price range."""
+    if not value or '-' not in value:
+      return None
+    try:
+      start, end = [float(v) if v else None for v in value.split('-', 1)]
+    except ValueError:
+      return None
+    return start, end
+
+  @classmethod
+  def _parseRangeLabel(cls, label):
+    """Return the (start, end) range of a number facet range label, with None
+    for an open end, or None if the label isn't a range."""
+    m = cls._RANGE_LABEL_RE.match(label)
+    if not m:
+      return None
+    bounds = []
+    for text in m.groups():
+      try:
+        value = float(text)
+      except ValueError:
+        value = None
+      bounds.append(value if value not in (float('inf'), float('-inf'))
+                    else None)
+    return tuple(bounds)
+
+  @classmethod
+  def _priceRangeText(cls, start, end):
+    if start is None:
+      return 'under $%g' % end
+    if end is None:
+      return '$%g and over' % start
+    return '$%g - $%g' % (start, end)
+
+  def _buildFacetInfo(self, search_results, params):
+    """Build the facet block for the template from the facet counts returned
+    with the search results: for each facet, its name and a list of dicts
+    with the label, count and link (which selects that facet value) of each
+    value."""
+    res = []
+    for facet in getattr(search_results, 'facets', None) or []:
+      values = []
+      for fvalue in facet.values:
+        label = fvalue.label
+        if facet.name == docs.Product.PRICE:
+          price_range = self._parseRangeLabel(label)
+          if price_range is None:
+            continue
+          pvalue = self._formatPriceParam(*price_range)
+          label = self._priceRangeText(*price_range)
+        else:
+          pvalue = fvalue.label
+        pcopy = dict((k, v) for k, v in params.iteritems()
+                     if k not in self._PAGING_PARAMS)
+        pcopy[facet.name] = pvalue
+        values.append({
+            'label': label, 'count': fvalue.count,
+            'selected': params.get(facet.name) == pvalue,
+            'link': '/psearch?' + urllib.urlencode(
+                dict((k, unicode(v).encode('utf-8'))
+                     for k, v in pcopy.iteritems()))})
+      res.append({'name': facet.name, 'values': values})
+    return res
+
+  @classmethod
+  def _usesCursors(cls):
+    return config.PAGINATION_MODE == 'cursor'
+
+  @classmethod
+  def _getPageNumber(cls, params):
+    """Return the (zero-based) page number for cursor pagination.  A page
+    without a cursor is always the first page."""
+    if not params.get('cursor'):
+      return 0
+    try:
+      return max(int(params.get('page', 0)), 0)
+    except ValueError:
+      return 0
+
+  @classmethod
+  def _resultCache(cls):
+    """Return the search result cache, creating it on first use.  It is
+    shared by the subclasses (see SearchApiHandler)."""
+    if ProductSearchHandler._RESULT_CACHE is None:
+      import cache
+      ProductSearchHandler._RESULT_CACHE = cache.TwoTierCache(
+          'psearch', config.SEARCH_CACHE_SIZE, config.SEARCH_CACHE_TIME)
+    return ProductSearchHandler._RESULT_CACHE
+
+  @classmethod
+  def _searchCacheKey(cls, query, sortq, doc_limit, offsetval,
+                      websafe_cursor=None, returned_fields=None,
+                      generation=None):
+    """Build the result cache key for a query.  The query string is
+    normalized so that queries differing only in whitespace share an entry, and
+    the index generation is included so that entries are invalidated whenever
+    the index changes.  So is the live index name: until an instance sees a
+    rebuild's switch to a new index, it searches the old one, and its results
+    mustn't be cached for the new one.  The generation may be given if the
+    caller has already read it."""
+    if websafe_cursor is not None:
+      # in cursor mode, the page is determined by the cursor alone.
+      offsetval = 'c:' + websafe_cursor
+    if generation is None:
+      generation = docs.Product.getGeneration()
+    key = '%s|%s|%s|%s|%s|%s' % (
+        docs.Product.getLiveIndexName(), generation, ' '.join(query.split()),
+        sortq, doc_limit, offsetval)
+    if returned_fields is not None:
+      key += '|' + ','.join(returned_fields)
+    return key
+
+  def _getSearchResults(self, query, sortq, sort_dict, doc_limit, offsetval,
+                        websafe_cursor=None, category=None,
+                        returned_fields=None, key=None):
+    """Return the search results for the query, from the result cache if
+    possible.  Returns None if the search failed.  If the query is restricted
+    to a category, it is given, so that only that category's index shard is
+    searched (see docs.Product.search).  The cache key may be given if the
+    caller has already built it."""
+    key, search_results, pending = self._startSearchAsync(
+        query, sortq, sort_dict, doc_limit, offsetval, websafe_cursor,
+        category, returned_fields, key).get_result()
+    if search_results is None:
+      search_results = self._finishSearch(key, pending)
+    return search_results
+
+  @ndb.tasklet
+  def _startSearchAsync(self, query, sortq, sort_dict, doc_limit, offsetval,
+                        websafe_cursor=None, category=None,
+                        returned_fields=None, key=None):
+    """Look the query up in the result cache, and if it isn't there, start
+    the search, without waiting for it (see _getSearchResults for the args).
+    Returns a future for a (key, search results, pending search) tuple: the
+    result cache key, and either the cached results, or the search in
+    progress, which _finishSearch completes.  The pending search is None if
+    the search couldn't be started."""
+    if key is None:
+      generation = yield docs.Product.getGenerationAsync()
+      key = self._searchCacheKey(
+          query, sortq, doc_limit, offsetval, websafe_cursor, returned_fields,
+          generation=generation)
+    search_results = yield self._resultCache().getAsync(key)
+    if search_results is not None:
+      raise ndb.Return((key, search_results, None))
+    search_query = self._buildQuery(
+        query, sortq, sort_dict, doc_limit, offsetval, websafe_cursor,
+        returned_fields)
+    try:
+      pending = docs.Product.searchAsync(search_query, category=category)
+    except search.Error:
+      logging.exception('Search failed')
+      pending = None
+    raise ndb.Return((key, None, pending))
+
+  def _finishSearch(self, key, pending):
+    """Wait for a search started by _startSearchAsync, cache its results
+    under key, and return them.  Returns None if the search failed."""
+    if pending is None:
+      return None
+    try:
+      search_results = pending.get_result()
+    except search.Error:
+      logging.exception('Search failed')
+      return None
+    self._resultCache().set(key, search_results)
+    return search_results
+
+  @classmethod
+  def _buildQuery(cls, query, sortq, sort_dict, doc_limit, offsetval,
+                  websafe_cursor=None, returned_fields=None):
+    """Build and return a search query object.  If websafe_cursor is not
+    None, the query requests a cursor for the next page and starts from the
+    given cursor (or from the first result, if it is empty) instead of using
+    the offset.  The fields returned with the results may be given;
+    by default, the core fields shown on the results page are returned."""
 
     # computed and returned fields examples.  Their use is not required
     # for the application to function correctly.
-    computed_expr = search.FieldExpression(name='adjusted_price',
+    computed_expr = search.FieldExpression(name=docs.Product.ADJUSTED_PRICE,
         expression='price * 1.08')
-    returned_fields = [docs.Product.PID, docs.Product.DESCRIPTION,
-                docs.Product.CATEGORY,docs.Product.PRICE, docs.Product.PRODUCT_NAME]
+    if returned_fields is None:
+      returned_fields = [docs.Product.PID, docs.Product.DESCRIPTION,
+                         docs.Product.CATEGORY, docs.Product.PRICE,
+                         docs.Product.PRODUCT_NAME]
 
     if sortq == 'relevance':
       # If sorting on 'relevance', use the Match scorer.
       sortopts = search.SortOptions(match_scorer=search.MatchScorer())
-      search_query = search.Query(
-          query_string=query.strip(),
-          options=search.QueryOptions(
-              limit=doc_limit,
-              offset=offsetval,
-              sort_options=sortopts,
-              snippeted_fields=[docs.Product.DESCRIPTION],
-              returned_expressions=[computed_expr],
-              returned_fields=returned_fields
-              ))
-    """else:
+    else:
       # Otherwise (not sorting on relevance), use the selected field as the
-      # first dimension of the sort expression, and the average rating as the
-      # second dimension, unless we're sorting on rating, in which case price
-      # is the second sort dimension.
-      # We get the sort direction and default from the 'sort_dict' var.
-      if sortq == docs.Product.AVG_RATING:
-        expr_list = [sort_dict.get(sortq), sort_dict.get(docs.Product.PRICE)]
-      else:
-        expr_list = [sort_dict.get(sortq), sort_dict.get(
-              docs.Product.AVG_RATING)]
+      # sort expression.  We get the sort direction and default from the
+      # 'sort_dict' var.  If no sort was selected, the default order is used.
+      expr_list = []
+      if sortq in sort_dict:
+        expr_list.append(sort_dict[sortq])
       sortopts = search.SortOptions(expressions=expr_list)
-      # logging.info("sortopts: %s", sortopts)
-      search_query = search.Query(
-          query_string=query.strip(),
-          options=search.QueryOptions(
-              limit=doc_limit,
-              offset=offsetval,
-              sort_options=sortopts,
-              snippeted_fields=[docs.Product.DESCRIPTION],
-              returned_expressions=[computed_expr],
-              returned_fields=returned_fields
-              ))"""
+    if websafe_cursor is None:
+      paging = {'offset': offsetval}
+    else:
+      # An offset can't be combined with a cursor, and a cursor created
+      # without a web-safe string requests the cursor for the first page.
+      paging = {'cursor': search.Cursor(web_safe_string=websafe_cursor or None)}
+    # the facet counts are returned with the results, rather than needing a
+    # search per facet value.
+    facet_requests = [
+        search.FacetRequest(docs.Product.CATEGORY,
+                            value_limit=config.FACET_VALUE_LIMIT),
+        search.FacetRequest(docs.Product.BRAND,
+                            value_limit=config.FACET_VALUE_LIMIT),
+        search.FacetRequest(docs.Product.PRICE, ranges=[
+            search.FacetRange(start=start, end=end)
+            for start, end in config.PRICE_FACET_RANGES])]
+    search_query = search.Query(
+        query_string=query.strip(),
+        return_facets=facet_requests,
+        options=search.QueryOptions(
+            limit=doc_limit,
+            sort_options=sortopts,
+            snippeted_fields=[docs.Product.DESCRIPTION],
+            returned_expressions=[computed_expr],
+            returned_fields=returned_fields,
+            **paging
+            ))
     return search_query
 
   
 
   def _generatePaginationLinks(
-        self, offsetval, returned_count, number_found, params):
+        self, offsetval, returned_count, number_found, params,
+        search_cursor=None, stack_future=None):
     """Generate the next/prev pagination links for the query.  Detect when we're
     out of results in a given direction and don't generate the link in that
     case."""
 
+    if self._usesCursors():
+      return self._generateCursorPaginationLinks(
+          returned_count, params, search_cursor, stack_future)
     doc_limit = self._getDocLimit()
     pcopy = params.copy()
     if offsetval - doc_limit >= 0:
@@ -301,12 +659,189 @@ class ProductSearchHandler(BaseHandler):
       next_link = None
     return (prev_link, next_link)
 
+  def _getCursorStackAsync(self, params):
+    """Start reading the cursor stack identified by the 'cstack' param (see
+    _generateCursorPaginationLinks), and return a future for it, whose result
+    is None if there is none."""
+    token = params.get('cstack')
+    if not token:
+      future = ndb.Future()
+      future.set_result(None)
+      return future
+    return ndb.get_context().memcache_get(
+        token, namespace=self._CURSOR_STACK_NAMESPACE)
+
+  def _generateCursorPaginationLinks(self, returned_count, params,
+                                     search_cursor, stack_future=None):
+    """Generate the next/prev pagination links for cursor pagination.  The
+    next link carries the cursor returned with the search results.  The start
+    cursors of the pages visited so far are kept in a short-lived 'cursor
+    stack' in memcache, identified by the 'cstack' param, from which the prev
+    link is built.  If the stack has expired, the prev link goes back to the
+    first page.  The stack may already have been requested (see
+    _getCursorStackAsync).  Its update isn't waited for: the handler method
+    must be an ndb.toplevel."""
+
+    doc_limit = self._getDocLimit()
+    page = self._getPageNumber(params)
+    pcopy = params.copy()
+    pcopy.pop('offset', None)
+    token = pcopy.get('cstack') or uuid.uuid4().hex
+    pcopy['cstack'] = token
+
+    # the stack maps page numbers to their start cursors.  Only the most
+    # recent pages are kept, to bound its size.
+    if stack_future is None:
+      stack_future = self._getCursorStackAsync(params)
+    stack = stack_future.get_result() or {}
+    stack[page] = pcopy.get('cursor', '')
+    for p in stack.keys():
+      if p > page or p <= page - config.CURSOR_STACK_DEPTH:
+        del stack[p]
+    ndb.get_context().memcache_set(
+        token, stack, time=config.CURSOR_STACK_TIME,
+        namespace=self._CURSOR_STACK_NAMESPACE)
+
+    if page > 0:
+      prev_cursor = stack.get(page - 1)
+      if prev_cursor or page == 1:
+        pcopy.update({'page': page - 1, 'cursor': prev_cursor or ''})
+      else:
+        pcopy.update({'page': 0, 'cursor': ''})
+      prev_link = '/psearch?' + urllib.urlencode(pcopy)
+    else:
+      prev_link = None
+    # the search service only returns a cursor if there are more results.
+    if search_cursor and returned_count == doc_limit:
+      pcopy.update({'page': page + 1, 'cursor': search_cursor.web_safe_string})
+      next_link = '/psearch?' + urllib.urlencode(pcopy)
+    else:
+      next_link = None
+    return (prev_link, next_link)
+
+
+
+class SearchApiHandler(ProductSearchHandler):
+  """Returns a page of product search results as JSON.  Takes the same query,
+  refinement, sort and paging params as the search page, and optionally the
+  page size ('limit') and a comma-separated list of the fields to return
+  with each result ('fields').  Only the requested fields are fetched from
+  the index.
+
+  The response has an ETag derived from the index generation and the
+  request, so a client revalidating a page with If-None-Match gets a 304
+  until the index changes, without a search being made."""
+
+  # a document field name
+  _FIELD_NAME_RE = re.compile(r'^[A-Za-z][A-Za-z0-9_]*$')
+
+  def parseParams(self):
+    params = super(SearchApiHandler, self).parseParams()
+    params['fields'] = self.request.get('fields', '')
+    params['limit'] = self.request.get('limit', '')
+    return params
+
+  def _getReturnedFields(self, params):
+    """Return the requested field names, or the core product fields if
+    there are none."""
+    if not params['fields']:
+      return [docs.Product.PID, docs.Product.PRODUCT_NAME,
+              docs.Product.CATEGORY, docs.Product.PRICE,
+              docs.Product.DESCRIPTION]
+    fields = []
+    for name in params['fields'].split(','):
+      name = name.strip()
+      if not self._FIELD_NAME_RE.match(name):
+        self.abort(400, 'Invalid field name %r.' % name)
+      if name not in fields:
+        fields.append(name)
+    return fields
+
+  def _getPageSize(self, params):
+    try:
+      limit = int(params['limit'] or config.API_SEARCH_DEFAULT_LIMIT)
+    except ValueError:
+      limit = config.API_SEARCH_DEFAULT_LIMIT
+    return utils.intClamp(limit, 1, config.API_SEARCH_MAX_LIMIT)
+
+  def get(self):
+    params = self.parseParams()
+    query = self._buildQueryString(params)
+    sortq = params['sort']
+    returned_fields = self._getReturnedFields(params)
+    doc_limit = self._getPageSize(params)
+    websafe_cursor = None
+    offsetval = 0
+    if self._usesCursors():
+      websafe_cursor = params['cursor']
+    else:
+      try:
+        offsetval = utils.intClamp(int(params['offset']), 0,
+                                   self._OFFSET_LIMIT)
+      except ValueError:
+        offsetval = 0
+
+    # the result cache key identifies the page of results, and includes the
+    # index generation, so it also serves as the ETag (with the JSONP
+    # callback, which is part of the response).
+    key = self._searchCacheKey(query, sortq, doc_limit, offsetval,
+                               websafe_cursor, returned_fields)
+    etag = hashlib.md5(('%s|%s' % (
+        key, self.request.GET.get('callback', ''))).encode('utf-8')).hexdigest()
+    # clients may keep the response, but must revalidate it
+    self.response.headers['Cache-Control'] = 'no-cache'
+    if self.notModified(etag):
+      return
+
+    search_results = self._getSearchResults(
+        query, sortq, docs.Product.getSortDict(), doc_limit, offsetval,
+        websafe_cursor, category=params['category'],
+        returned_fields=returned_fields, key=key)
+    if search_results is None:
+      self.abort(503, 'The search failed.')
+
+    results = []
+    for doc in search_results.results:
+      pdoc = docs.Product(doc)
+      result = pdoc.asDict()
+      result['doc_id'] = doc.doc_id
+      if docs.Product.DESCRIPTION in returned_fields:
+        result['snippet'] = pdoc.getDescriptionSnippet()
+      results.append(result)
+    response = {
+        'query': params['query'],
+        'number_found': search_results.number_found,
+        'returned_count': len(results),
+        'results': results,
+        'facets': [
+            {'name': facet.name,
+             'values': [{'label': value.label, 'count': value.count}
+                        for value in facet.values]}
+            for facet in getattr(search_results, 'facets', None) or []]}
+    if websafe_cursor is not None:
+      response['next_cursor'] = (search_results.cursor.web_safe_string
+                                 if search_results.cursor else None)
+    else:
+      next_offset = offsetval + len(results)
+      response['offset'] = offsetval
+      response['next_offset'] = (
+          next_offset if (next_offset < search_results.number_found and
+                          len(results) == doc_limit and
+                          next_offset <= self._OFFSET_LIMIT) else None)
+    self.render_json(response)
 
 
 class StoreLocationHandler(BaseHandler):
   """Show the reviews for a given product.  This information is pulled from the
   datastore Review entities."""
 
+  # the location query from the client will have this form:
+  # distance(store_location, geopoint(37.7899528, -122.3908226)) < 40000
+  _LOCATION_QUERY_RE = re.compile(
+      r'^\s*distance\(\s*store_location\s*,\s*geopoint\(\s*([-+\d.]+)\s*,'
+      r'\s*([-+\d.]+)\s*\)\s*\)\s*<=?\s*([\d.]+)\s*$')
+  _MAX_RESULTS = 20  # the search API's default query limit
+
   def get(self):
     """Show a list of reviews for the product indicated by the 'pid' request
     parameter."""
@@ -314,11 +849,17 @@ class StoreLocationHandler(BaseHandler):
     query = self.request.get('location_query')
     lat = self.request.get('latitude')
     lon = self.request.get('longitude')
-    # the location query from the client will have this form:
-    # distance(store_location, geopoint(37.7899528, -122.3908226)) < 40000
     # logging.info('location query: %s, lat %s, lon %s', query, lat, lon)
+    # Answer from the in-memory snapshot of the store locations if it is
+    # current, and only fall back to the search index otherwise.
+    grid = docs.Store.getSnapshot()
+    if grid is not None:
+      response = self._searchSnapshot(grid, query, lat, lon)
+      if response is not None:
+        self.render_json(response)
+        return
     try:
-      index = search.Index(config.STORE_INDEX_NAME)
+      index = docs.Store.getIndex()
       # search using simply the query string:
       # results = index.search(query)
       # alternately: sort results by distance
@@ -348,3 +889,35 @@ class StoreLocationHandler(BaseHandler):
       response_obj2.append(resp)
     logging.info("resp: %s", response_obj2)
     self.render_json(response_obj2)
+    if grid is None:
+      # rebuild the stale snapshot, for subsequent requests.
+      docs.Store.startSnapshotRefresh()
+
+  def _searchSnapshot(self, grid, query, lat, lon):
+    """Answer the location query from the snapshot GeoGrid.  Results are
+    ordered by distance from the given latitude/longitude.  If the 'nearest'
+    param is set, at most that many stores are returned.  Returns None if the
+    query is not of the expected form, so that the search index is used."""
+    m = self._LOCATION_QUERY_RE.match(query)
+    if not m:
+      return None
+    qlat, qlon, meters = [float(v) for v in m.groups()]
+    try:
+      lat, lon = float(lat), float(lon)
+    except ValueError:
+      lat, lon = qlat, qlon
+    try:
+      k = utils.intClamp(int(self.request.get('nearest') or self._MAX_RESULTS),
+                         1, self._MAX_RESULTS)
+    except ValueError:
+      k = self._MAX_RESULTS
+    if (qlat, qlon) == (lat, lon):
+      matches = grid.nearest(lat, lon, k, max_meters=meters)
+    else:
+      # filter around the query's point, but order by distance from the
+      # given one.
+      within = [store for _, store in grid.withinRadius(qlat, qlon, meters)]
+      import spatial
+      sgrid = spatial.GeoGrid((s['lat'], s['lon'], s) for s in within)
+      matches = sgrid.nearest(lat, lon, k)
+    return [store for _, store in matches]
@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+#
+# Copyright 2012 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Import-time profile of the app's routes.
+
+For each route of the user-facing (main.py) and admin (admin.py) applications,
+a fresh interpreter imports the application module and then the route's
+handler, as a cold instance does when serving its first request to that
+route.  The time taken, and the modules imported with the (inclusive) time of
+each, are reported as JSON, so that startup cost can be compared across
+commits.
+
+Example:
+  python import_profile.py --sdk_path=/path/to/google_appengine \
+      --output=imports.json
+"""
+
+import __builtin__
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+import benchmark
+
+
+APPS = ['main', 'admin']
+
+
+class ImportTimer(object):
+  """Records the inclusive time of the first import of each module, by
+  wrapping the __import__ builtin while active."""
+
+  def __init__(self):
+    self.times = {}
+    self._orig_import = None
+
+  def _import(self, name, *args, **kwargs):
+    if name in sys.modules:
+      return self._orig_import(name, *args, **kwargs)
+    start = time.time()
+    try:
+      return self._orig_import(name, *args, **kwargs)
+    finally:
+      if name in sys.modules and name not in self.times:
+        self.times[name] = time.time() - start
+
+  def __enter__(self):
+    self._orig_import = __builtin__.__import__
+    __builtin__.__import__ = self._import
+    return self
+
+  def __exit__(self, *exc_info):
+    __builtin__.__import__ = self._orig_import
+
+
+def _timedImport(load):
+  """Call load under an ImportTimer, and return a dict of the time it took
+  and the modules it imported, slowest first."""
+  before = set(sys.modules)
+  start = time.time()
+  with ImportTimer() as timer:
+    load()
+  secs = time.time() - start
+  loaded = set(sys.modules) - before
+  return {
+      'ms': secs * 1000,
+      'module_count': len([m for m in loaded if sys.modules[m] is not None]),
+      'modules': sorted(
+          ([name, ms * 1000] for name, ms in timer.times.iteritems()),
+          key=lambda pair: -pair[1]),
+  }
+
+
+def _webapp(module):
+  """Return the webapp2.WSGIApplication of an application module, unwrapping
+  the middleware around it (see stats.StatsMiddleware)."""
+  app = module.application
+  while not hasattr(app, 'router'):
+    app = app.app
+  return app
+
+
+def listRoutes(app_name):
+  """Return the route templates of the named application module."""
+  app = _webapp(__import__(app_name))
+  return [route.template for route in app.router.match_routes]
+
+
+def profileRoute(app_name, template):
+  """Profile, in this interpreter, the import of the named application module
+  and of the handler of its route with the given template."""
+  import webapp2
+  report = {'app': app_name, 'route': template}
+  report['app_import'] = _timedImport(lambda: __import__(app_name))
+  app = _webapp(sys.modules[app_name])
+  route = [r for r in app.router.match_routes if r.template == template][0]
+  handler = route.handler
+  report['handler'] = (handler if isinstance(handler, basestring)
+                       else '%s.%s' % (handler.__module__, handler.__name__))
+  if isinstance(handler, basestring):
+    report['handler_import'] = _timedImport(
+        lambda: webapp2.import_string(handler))
+  else:  # imported along with the application module
+    report['handler_import'] = {'ms': 0.0, 'module_count': 0, 'modules': []}
+  report['total_ms'] = (report['app_import']['ms'] +
+                        report['handler_import']['ms'])
+  return report
+
+
+def main(argv):
+  parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+  parser.add_argument('--sdk_path', default=os.environ.get('APPENGINE_SDK'),
+                      help='path to the App Engine SDK')
+  parser.add_argument('--top', type=int, default=15,
+                      help='number of slowest modules reported per import')
+  parser.add_argument('--output', help='write the JSON report to this file')
+  # used to run each profile in a fresh interpreter
+  parser.add_argument('--app', help=argparse.SUPPRESS)
+  parser.add_argument('--route', help=argparse.SUPPRESS)
+  args = parser.parse_args(argv)
+
+  benchmark.setupSdk(args.sdk_path)
+  if args.route:
+    report = profileRoute(args.app, args.route)
+    for key in ('app_import', 'handler_import'):
+      report[key]['modules'] = report[key]['modules'][:args.top]
+    print json.dumps(report)
+    return
+
+  routes = []
+  for app_name in APPS:
+    for template in listRoutes(app_name):
+      cmd = [sys.executable, os.path.abspath(__file__), '--app', app_name,
+             '--route', template, '--top', str(args.top)]
+      if args.sdk_path:
+        cmd += ['--sdk_path', args.sdk_path]
+      routes.append(json.loads(subprocess.check_output(cmd)))
+  report = {'revision': benchmark.gitRevision(), 'routes': routes}
+
+  out = json.dumps(report, indent=2, sort_keys=True)
+  if args.output:
+    with open(args.output, 'w') as f:
+      f.write(out + '\n')
+  print out
+
+
+if __name__ == '__main__':
+  main(sys.argv[1:])
@@ -15,18 +15,28 @@
 # limitations under the License.
 
 """Defines the routing for the app's non-admin handlers.
+Handlers are given by name, so that webapp2 imports handlers.py only when a
+request is first routed to it, rather than at instance startup.  All these
+routes share handlers.py, so the modules that only some of them need (the
+store locator, sharding and autocomplete helpers, warmup) are imported by
+the code that uses them (see import_profile.py).  Requests are timed by
+stats.StatsMiddleware.
 """
 
 
-from handlers import *
 import webapp2
 
+import stats
+
 application = webapp2.WSGIApplication(
-    [('/', IndexHandler),
-     ('/psearch', ProductSearchHandler),
-     ('/product', ShowProductHandler),
-     ('/get_store_locations', StoreLocationHandler)
+    [('/', 'handlers.IndexHandler'),
+     ('/psearch', 'handlers.ProductSearchHandler'),
+     ('/product', 'handlers.ShowProductHandler'),
+     ('/products', 'handlers.ProductsHandler'),
+     ('/autocomplete', 'handlers.AutocompleteHandler'),
+     ('/api/search', 'handlers.SearchApiHandler'),
+     ('/get_store_locations', 'handlers.StoreLocationHandler'),
+     ('/_ah/warmup', 'handlers.WarmupHandler')
     ],
     debug=True)
-
-
+application = stats.StatsMiddleware(application, 'main')
@@ -0,0 +1,1473 @@
+#!/usr/bin/env python
+#
+# Copyright 2012 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" A pure-Python, in-memory search backend implementing the subset of the
+search.Index API that the app uses, so that the app can be run and load-tested
+without the App Engine search service.  Select it by setting
+config.SEARCH_BACKEND to 'memory' (see docs.BaseDocumentManager.getIndex).
+
+Documents, queries and results are the search API's own classes, so the rest
+of the app can't tell the difference.  Supported are:
+  - put/delete/get/get_range/search, and their _async variants;
+  - Text, Html, Atom, Number, Date and Geo fields;
+  - bare and quoted terms, field:value and field:"value" restrictions,
+    field:(a OR b) groups, <, <=, >, >= comparisons on number and date fields,
+    distance(field, geopoint(lat, lon)) < meters, AND/OR/NOT and parentheses;
+  - sort expressions on field names, _score and distance(...), with a
+    MatchScorer counting the query terms each result matches;
+  - offset/limit, cursors, returned_fields, snippeted_fields, and arithmetic
+    returned_expressions (e.g. 'price * 1.08');
+  - number_found;
+  - Atom and Number facets, with return_facets requests for the value counts
+    of an atom facet or the counts of number facet ranges (facet discovery and
+    refinements are not supported).
+Quoted phrases match documents containing all of the phrase's words, in any
+order; stemming and real snippeting are not supported.
+
+Each index stores its documents by column, rather than as search.Document
+objects: one column per field and facet name, with number and date values in
+arrays of doubles, atom values as codes into a table of the distinct values,
+and text as UTF-8 strings.  Documents are rebuilt only for the results a
+search returns.  An inverted index maps each (field, token) to an ascending
+array of document ordinals; for sorting and number and date comparisons, each
+field also gets a sort index, of its documents ordered by value, built on the
+first search that needs it and rebuilt once enough documents have been added
+after it.  Writes are serialized by a lock, and each publishes a snapshot that
+later writes leave unchanged; searches read the latest one without taking a
+lock, so they run concurrently with each other and with writes.
+
+A search costs time in proportion to the documents it matches (and, for its
+facets, memory too), rather than to the size of the index: with a million
+products, a query on a category and a common word takes under a second on
+one CPU, most of it spent counting facets over the documents it matches (the
+first search sorting on a field takes a few seconds more, to build its sort
+index), and the index takes about 2 KB of memory per product.
+"""
+
+import array
+import base64
+import bisect
+import datetime
+import heapq
+import itertools
+import re
+import threading
+import uuid
+
+import utils
+
+from google.appengine.api import search
+
+
+# all in-memory indexes, by (namespace, name), shared by every Index object
+# opened with the same name.
+_INDEXES = {}
+_INDEXES_LOCK = threading.Lock()
+
+_TEXT, _ATOM, _NUMBER, _DATE, _GEO = range(5)
+
+# compact the postings once this many deleted or replaced documents have
+# accumulated, and they outnumber the live ones.
+_COMPACT_THRESHOLD = 10000
+
+# rebuild a field's sort index once the documents added since it was built
+# outnumber this, and an eighth of those it holds.
+_SORT_TAIL_LIMIT = 4096
+# count the values of an atom facet one at a time if it has more than this
+# many distinct values, rather than counting each value's occurrences (and
+# likewise sort the values of a number facet if its ranges have this many
+# bounds, rather than counting the values between each pair of them).
+_COUNT_BY_VALUE_LIMIT = 64
+
+_DEFAULT_LIMIT = 20
+_SNIPPET_LENGTH = 300
+
+_WORD_RE = re.compile(r'\w+', re.UNICODE)
+_TAG_RE = re.compile(r'<[^>]*?>')
+_DISTANCE_RE = re.compile(
+    r'distance\(\s*(\w+)\s*,\s*geopoint\(\s*([-+\d.]+)\s*,\s*([-+\d.]+)\s*\)'
+    r'\s*\)')
+_GEO_RESTRICTION_RE = re.compile(
+    _DISTANCE_RE.pattern + r'\s*(<=|>=|<|>)\s*([\d.]+)')
+_GEO_PLACEHOLDER_RE = re.compile(r'^__geo(\d+)__$')
+_QUERY_TOKEN_RE = re.compile(
+    r'\s*(?:(\()|(\))|"((?:[^"\\]|\\.)*)"|(<=|>=|<|>|=|:)|([^\s()"<>=:]+))',
+    re.UNICODE)
+_EXPR_TOKEN_RE = re.compile(r'\s*(?:(\d+\.?\d*|\.\d+)|(\w+)|(\S))')
+
+_NAN = float('nan')
+
+
+def clearAll():
+  """Drop all in-memory indexes."""
+  with _INDEXES_LOCK:
+    _INDEXES.clear()
+
+
+def _tokenize(text):
+  return _WORD_RE.findall(_TAG_RE.sub(' ', text).lower())
+
+
+def _fieldKind(field):
+  if isinstance(field, (search.TextField, search.HtmlField)):
+    return _TEXT
+  if isinstance(field, search.AtomField):
+    return _ATOM
+  if isinstance(field, search.NumberField):
+    return _NUMBER
+  if isinstance(field, search.DateField):
+    return _DATE
+  if isinstance(field, search.GeoField):
+    return _GEO
+  return None
+
+
+def _facetKind(facet):
+  return _NUMBER if isinstance(facet, search.NumberFacet) else _ATOM
+
+
+def _utf8(value):
+  """Encode unicode strings, so that they compare with the UTF-8 strings the
+  text columns hold."""
+  return value.encode('utf-8') if isinstance(value, unicode) else value
+
+
+def _descending(value):
+  """Return a sort key ordering the value in descending order."""
+  if isinstance(value, (int, long, float)):
+    return -value
+  return utils.Descending(value)
+
+
+def _dateNumber(value):
+  """Convert a date or datetime to a number of days, so that dates can be
+  compared with each other and with numeric sort defaults."""
+  if isinstance(value, datetime.datetime):
+    return (value.toordinal() + value.hour / 24.0 + value.minute / 1440.0 +
+            value.second / 86400.0)
+  return float(value.toordinal())
+
+
+def _numberDate(number):
+  """The inverse of _dateNumber: a date for a whole number of days, and
+  otherwise a datetime."""
+  days = int(number)
+  if days == number:
+    return datetime.date.fromordinal(days)
+  return (datetime.datetime.fromordinal(days) +
+          datetime.timedelta(seconds=int(round((number - days) * 86400))))
+
+
+def _parseDate(text):
+  try:
+    return _dateNumber(datetime.datetime.strptime(text, '%Y-%m-%d'))
+  except ValueError:
+    return None
+
+
+def _compare(value, op, target):
+  if op in (':', '='):
+    return value == target
+  if op == '<':
+    return value < target
+  if op == '<=':
+    return value <= target
+  if op == '>':
+    return value > target
+  return value >= target
+
+
+def _inRange(value, start, end):
+  return ((start is None or value >= start) and
+          (end is None or value < end))
+
+
+def rangeLabel(start, end):
+  """Return the label of a number facet range, as the search service formats
+  it: '[start,end)', with 'inf' for an open end."""
+  return '[%s,%s)' % (
+      float(start) if start is not None else '-inf',
+      float(end) if end is not None else 'inf')
+
+
+def _encodeCursor(offset, per_result=False):
+  return '%s:%s' % (per_result,
+                    base64.urlsafe_b64encode('offset:%d' % offset))
+
+
+def _intersect(small, large):
+  """Return the ordinals in both of the ascending ordinal arrays, in order.
+  Each ordinal of the smaller array is looked up in the larger one by binary
+  search, starting from the position of the previous one."""
+  res = []
+  lo = 0
+  n = len(large)
+  for o in small:
+    lo = bisect.bisect_left(large, o, lo)
+    if lo == n:
+      break
+    if large[lo] == o:
+      res.append(o)
+  return res
+
+
+def _decodeCursor(cursor):
+  try:
+    internal = cursor.web_safe_string.split(':', 1)[1]
+    return int(base64.urlsafe_b64decode(str(internal)).split(':', 1)[1])
+  except (IndexError, TypeError, ValueError):
+    raise search.InvalidRequest('Invalid cursor %s' % cursor.web_safe_string)
+
+
+def _splitValues(columns, items, kind_of):
+  """Split the fields, or facets, of a document into the first value of each
+  name, by name; the names that have no column yet, in order; and the rest:
+  repeated names, values of another class than their column's, and fields
+  of unknown classes."""
+  firsts = {}
+  new = []
+  rest = []
+  for item in items:
+    if item.value is None:
+      continue
+    name = item.name
+    column = columns.get(name)
+    if (kind_of(item) is None or name in firsts or
+        (column is not None and column.cls is not item.__class__)):
+      rest.append(item)
+      continue
+    firsts[name] = item
+    if column is None:
+      new.append(name)
+  return firsts, new, rest
+
+
+def _appendColumns(columns, names, firsts, new, ordinal, kind_of):
+  """Append a document's values (see _splitValues) to the columns, and
+  return the columns and their names, with columns for the new names.  These
+  are added to copies, so that snapshots holding the old ones don't see them
+  change."""
+  for name, column in columns.iteritems():
+    item = firsts.get(name)
+    column.append(item.value if item is not None else None)
+  if new:
+    columns = dict(columns)
+    for name in new:
+      item = firsts[name]
+      column = columns[name] = _Column(kind_of(item), item.__class__, ordinal)
+      column.append(item.value)
+    names += tuple(new)
+  return columns, names
+
+
+def _hasOr(node):
+  if node is None or node[0] in ('term', 'cmp', 'geo'):
+    return False
+  if node[0] == 'or':
+    return True
+  if node[0] == 'not':
+    return _hasOr(node[1])
+  return any(_hasOr(n) for n in node[1])
+
+
+class _QueryParser(object):
+  """Parses a query string into a tree of tuples:
+    ('and', [nodes]), ('or', [nodes]), ('not', node),
+    ('term', field or None, text), ('cmp', field, op, text),
+    ('geo', field, lat, lon, op, meters).
+  The parser is lenient: stray operators and unbalanced parentheses are
+  ignored rather than reported."""
+
+  def __init__(self, query_string):
+    self._geo = []
+    query_string = _GEO_RESTRICTION_RE.sub(self._saveGeo, query_string or '')
+    self._tokens = []
+    for m in _QUERY_TOKEN_RE.finditer(query_string):
+      lparen, rparen, quoted, op, word = m.groups()
+      if lparen:
+        self._tokens.append(('(', lparen))
+      elif rparen:
+        self._tokens.append((')', rparen))
+      elif quoted is not None:
+        self._tokens.append(('QUOTED', quoted.replace('\\"', '"')))
+      elif op:
+        self._tokens.append(('OP', op))
+      elif word:
+        self._tokens.append(('WORD', word))
+    self._pos = 0
+
+  def _saveGeo(self, m):
+    field, lat, lon, op, meters = m.groups()
+    self._geo.append((field, float(lat), float(lon), op, float(meters)))
+    return ' __geo%d__ ' % (len(self._geo) - 1)
+
+  def _peek(self):
+    if self._pos < len(self._tokens):
+      return self._tokens[self._pos]
+    return None
+
+  def _next(self):
+    tok = self._peek()
+    self._pos += 1
+    return tok
+
+  def parse(self):
+    """Return the query tree, or None for an empty query."""
+    nodes = []
+    while self._peek() is not None:
+      nodes.append(self._parseOr(None))
+      # skip any unbalanced closing parenthesis
+      if self._peek() is not None:
+        self._next()
+    nodes = [n for n in nodes if n is not None]
+    if len(nodes) > 1:
+      return ('and', nodes)
+    return nodes[0] if nodes else None
+
+  def _parseOr(self, field):
+    nodes = [self._parseAnd(field)]
+    while self._peek() == ('WORD', 'OR'):
+      self._next()
+      nodes.append(self._parseAnd(field))
+    nodes = [n for n in nodes if n is not None]
+    if len(nodes) > 1:
+      return ('or', nodes)
+    return nodes[0] if nodes else None
+
+  def _parseAnd(self, field):
+    nodes = []
+    while True:
+      tok = self._peek()
+      if tok is None or tok[0] == ')' or tok == ('WORD', 'OR'):
+        break
+      if tok == ('WORD', 'AND'):
+        self._next()
+        continue
+      nodes.append(self._parseUnary(field))
+    nodes = [n for n in nodes if n is not None]
+    if len(nodes) > 1:
+      return ('and', nodes)
+    return nodes[0] if nodes else None
+
+  def _parseUnary(self, field):
+    tok = self._peek()
+    if tok == ('WORD', 'NOT'):
+      self._next()
+      node = self._parseUnary(field)
+      return ('not', node) if node is not None else None
+    if tok[0] == 'WORD' and len(tok[1]) > 1 and tok[1].startswith('-'):
+      self._next()
+      return ('not', ('term', field, tok[1][1:]))
+    return self._parsePrimary(field)
+
+  def _parsePrimary(self, field):
+    tok = self._next()
+    if tok[0] == '(':
+      node = self._parseOr(field)
+      if self._peek() is not None and self._peek()[0] == ')':
+        self._next()
+      return node
+    if tok[0] == 'OP':
+      return None
+    if tok[0] == 'QUOTED':
+      return ('term', field, tok[1])
+    m = _GEO_PLACEHOLDER_RE.match(tok[1])
+    if m:
+      return ('geo',) + self._geo[int(m.group(1))]
+    op_tok = self._peek()
+    if field is not None or op_tok is None or op_tok[0] != 'OP':
+      return ('term', field, tok[1])
+    # a restriction on the field named by this word
+    self._next()
+    op = op_tok[1]
+    value_tok = self._peek()
+    if value_tok is None:
+      return None
+    if value_tok[0] == '(' and op in (':', '='):
+      self._next()
+      node = self._parseOr(tok[1])
+      if self._peek() is not None and self._peek()[0] == ')':
+        self._next()
+      return node
+    if value_tok[0] not in ('WORD', 'QUOTED'):
+      return None
+    self._next()
+    if op in (':', '='):
+      return ('term', tok[1], value_tok[1])
+    return ('cmp', tok[1], op, value_tok[1])
+
+
+class _ExpressionEvaluator(object):
+  """Evaluates an arithmetic returned expression, such as 'price * 1.08',
+  over the number fields of a document."""
+
+  def __init__(self, expression, lookup):
+    self._tokens = [m.groups() for m in _EXPR_TOKEN_RE.finditer(expression)]
+    self._pos = 0
+    self._lookup = lookup
+
+  def evaluate(self):
+    """Return the value of the expression, or None if it can't be
+    evaluated (e.g. it references a field the document doesn't have)."""
+    try:
+      value = self._sum()
+    except (ArithmeticError, IndexError, KeyError, TypeError, ValueError):
+      return None
+    if self._pos != len(self._tokens):
+      return None
+    return value
+
+  def _isOp(self, ops):
+    return (self._pos < len(self._tokens) and
+            self._tokens[self._pos][2] in ops)
+
+  def _sum(self):
+    value = self._product()
+    while self._isOp('+-'):
+      op = self._tokens[self._pos][2]
+      self._pos += 1
+      if op == '+':
+        value += self._product()
+      else:
+        value -= self._product()
+    return value
+
+  def _product(self):
+    value = self._factor()
+    while self._isOp('*/'):
+      op = self._tokens[self._pos][2]
+      self._pos += 1
+      if op == '*':
+        value *= self._factor()
+      else:
+        value /= self._factor()
+    return value
+
+  def _factor(self):
+    number, name, op = self._tokens[self._pos]
+    self._pos += 1
+    if number:
+      return float(number)
+    if name:
+      return self._lookup(name)
+    if op == '-':
+      return -self._factor()
+    if op == '(':
+      value = self._sum()
+      if not self._isOp(')'):
+        raise ValueError('unbalanced parentheses')
+      self._pos += 1
+      return value
+    raise ValueError('unexpected %s' % op)
+
+
+class _Result(object):
+  """A completed stand-in for the search API's asynchronous RPC results."""
+
+  def __init__(self, fn, *args, **kwargs):
+    self._value = self._error = None
+    try:
+      self._value = fn(*args, **kwargs)
+    except search.Error as e:
+      self._error = e
+
+  def get_result(self):
+    if self._error is not None:
+      raise self._error
+    return self._value
+
+
+class _Complement(object):
+  """The result of a negation: all the documents but the excluded ones.  It
+  is kept as such, rather than as the set of all the other ordinals, so that
+  a NOT doesn't cost a pass over the whole index."""
+
+  __slots__ = ('excluded',)
+
+  def __init__(self, excluded):
+    self.excluded = excluded
+
+
+class _UniformScores(object):
+  """The match scores of a query without OR: each of its results matches all
+  of its terms, so they all have the same score."""
+
+  def __init__(self, score):
+    self._score = score
+
+  def get(self, ordinal, default=None):
+    return self._score
+
+
+class _Column(object):
+  """The values of one field, or facet, of all the documents of an index, by
+  ordinal: numbers and dates (as day numbers) in an array of doubles,
+  geopoints as pairs of doubles, atoms as codes into a table of their
+  distinct values, and text as UTF-8 strings.  A document without the field
+  has a missing value: NaN, code 0 or None.  Values are only ever appended,
+  so searches can read a column while it grows."""
+
+  def __init__(self, kind, cls, size):
+    """Args:
+      kind: the kind of the values (_TEXT, _ATOM, ...).
+      cls: the search API class of the fields, or facets, to return.
+      size: the number of documents already in the index, which are given
+        missing values.
+    """
+    self.kind = kind
+    self.cls = cls
+    if kind == _ATOM:
+      self.values = array.array('I', [0]) * size
+      self._table = [None]  # code -> value
+      self._sort_table = [None]  # code -> value as a sort key
+      self._codes = {}  # value -> code
+    elif kind == _TEXT:
+      self.values = [None] * size
+    else:
+      width = 2 if kind == _GEO else 1
+      self.values = array.array('d', [_NAN]) * (width * size)
+
+  def append(self, value):
+    """Append the value of the next document, or None if it has none."""
+    kind = self.kind
+    if kind == _ATOM:
+      self.values.append(0 if value is None else self._code(value))
+    elif kind == _TEXT:
+      self.values.append(None if value is None else _utf8(value))
+    elif kind == _GEO:
+      if value is None:
+        self.values.extend((_NAN, _NAN))
+      else:
+        self.values.extend((value.latitude, value.longitude))
+    elif value is None:
+      self.values.append(_NAN)
+    elif kind == _DATE:
+      self.values.append(_dateNumber(value))
+    else:
+      self.values.append(float(value))
+
+  def _code(self, value):
+    code = self._codes.get(value)
+    if code is None:
+      code = len(self._table)
+      self._table.append(value)
+      self._sort_table.append(_utf8(value))
+      self._codes[value] = code
+    return code
+
+  def value(self, ordinal):
+    """Return the value of a document, as given to a field, or None."""
+    kind = self.kind
+    if kind == _ATOM:
+      return self._table[self.values[ordinal]]
+    if kind == _TEXT:
+      value = self.values[ordinal]
+      return None if value is None else value.decode('utf-8')
+    if kind == _GEO:
+      point = self.point(ordinal)
+      return None if point is None else search.GeoPoint(*point)
+    value = self.values[ordinal]
+    if value != value:
+      return None
+    return _numberDate(value) if kind == _DATE else value
+
+  def sortValue(self, ordinal):
+    """Return the value of a document as a sort key (a UTF-8 string, or a day
+    number for a date), or None."""
+    kind = self.kind
+    if kind == _ATOM:
+      return self._sort_table[self.values[ordinal]]
+    if kind == _TEXT:
+      return self.values[ordinal]
+    if kind == _GEO:
+      return None
+    value = self.values[ordinal]
+    return None if value != value else value
+
+  def point(self, ordinal):
+    """Return the (latitude, longitude) of a document, or None."""
+    lat = self.values[2 * ordinal]
+    return None if lat != lat else (lat, self.values[2 * ordinal + 1])
+
+  def countValues(self, ordinals):
+    """Return a dict of the number of the documents with the given ordinals
+    having each atom value."""
+    table = self._table
+    codes = itertools.imap(self.values.__getitem__, ordinals)
+    if len(table) <= _COUNT_BY_VALUE_LIMIT:
+      # few distinct values: count the occurrences of each of their codes,
+      # as bytes, in C
+      codes = array.array('B', codes).tostring()
+      counts = ((table[code], codes.count(chr(code)))
+                for code in xrange(1, len(table)))
+      return dict((value, n) for value, n in counts if n)
+    counts = {}
+    for code in codes:
+      counts[code] = counts.get(code, 0) + 1
+    counts.pop(0, None)
+    return dict((table[code], n) for code, n in counts.iteritems())
+
+
+class _SortIndex(object):
+  """The ordinals, below size, of the documents having a value for a column,
+  ordered by that value, with the values in the same order (so that ranges
+  of them can be found by bisection), and the ordinals of the documents
+  without one."""
+
+  def __init__(self, column, size):
+    if column.kind in (_NUMBER, _DATE):
+      values = column.values
+      ordinals = [o for o in xrange(size) if values[o] == values[o]]
+      ordinals.sort(key=values.__getitem__)
+      self.values = array.array('d', itertools.imap(values.__getitem__,
+                                                    ordinals))
+    else:
+      sort_value = column.sortValue
+      ordinals = [o for o in xrange(size) if sort_value(o) is not None]
+      ordinals.sort(key=sort_value)
+      self.values = map(sort_value, ordinals)
+    self.size = size
+    self.ordinals = array.array('I', ordinals)
+    present = set(ordinals)
+    self.missing = array.array(
+        'I', (o for o in xrange(size) if o not in present))
+
+
+def _tiesNewestFirst(values, ordinals):
+  """Iterate over the (value, -ordinal) pairs of a sort index, ordered by
+  value, and each run of equal values newest (highest ordinal) first."""
+  lo = 0
+  end = len(values)
+  while lo < end:
+    value = values[lo]
+    hi = bisect.bisect_right(values, value, lo)
+    for o in reversed(ordinals[lo:hi]):
+      yield value, -o
+    lo = hi
+
+
+class _Store(object):
+  """The documents and postings of an index, as written.  Only the index's
+  writer, holding its lock, changes them; searches read them through a
+  _Snapshot."""
+
+  def __init__(self):
+    self.doc_ids = []  # ordinal -> doc_id
+    self.ranks = array.array('l')  # ordinal -> rank, or -1 if it had none
+    self.languages = _Column(_ATOM, None, 0)
+    # ordinal -> the generation that removed the document, or 0
+    self.removed = array.array('L')
+    self.ordinals = {}  # doc_id -> ordinal, for the live documents
+    self.postings = {}  # term -> array of ordinals, in ascending order
+    # The field and facet columns by name, and their names in the order they
+    # were first seen.  These are replaced rather than changed when a new
+    # name is seen, so that a snapshot can keep those it was made with.
+    self.columns = {}
+    self.field_names = ()
+    self.facet_columns = {}
+    self.facet_names = ()
+    # ordinal -> the (fields, facets) of the document that have no column:
+    # repeated names, and values of another class than their column's
+    self.extras = {}
+    self.extra_facet_names = set()
+    self.sorts = {}  # field name -> _SortIndex, built on demand
+    self.sorts_lock = threading.Lock()
+    self.sorted_ids = None  # the live doc ids in order, built on demand
+    self.dead = 0
+
+
+class _Snapshot(object):
+  """A view of an index as of one write: the documents with ordinals below
+  size that had not been removed by the write's generation.  Later writes
+  only append to the store, and mark the documents they remove with their
+  own generation, so a snapshot is read without a lock."""
+
+  def __init__(self, store, generation):
+    self.store = store
+    self.generation = generation
+    self.size = len(store.doc_ids)
+    self.live = len(store.ordinals)
+    self.dead = store.dead
+    self.columns = store.columns
+    self.field_names = store.field_names
+    self.facet_columns = store.facet_columns
+    self.facet_names = store.facet_names
+    self._facet_cache = {}  # the facet results over all the documents
+
+  def visible(self, ordinal):
+    if ordinal >= self.size:
+      return False
+    removed = self.store.removed[ordinal]
+    return not removed or removed > self.generation
+
+  def _visibleSet(self, ordinals):
+    """Return the set of the ordinals the snapshot can see."""
+    if not ordinals or (not self.dead and max(ordinals) < self.size):
+      return ordinals
+    removed = self.store.removed
+    size = self.size
+    generation = self.generation
+    return set(o for o in ordinals
+               if o < size and not 0 < removed[o] <= generation)
+
+  def _accepts(self, candidates):
+    """Return a predicate for the ordinals of the candidates: a set of
+    ordinals, a _Complement, or None for all the documents."""
+    if isinstance(candidates, set):
+      return candidates.__contains__
+    visible = self.visible
+    if candidates is None:
+      return visible
+    excluded = candidates.excluded
+    return lambda o: o not in excluded and visible(o)
+
+  def _ascending(self, candidates):
+    """Return an iterable of the ordinals of the candidates."""
+    if isinstance(candidates, set):
+      return candidates
+    if candidates is None and not self.dead:
+      return xrange(self.size)
+    accepts = self._accepts(candidates)
+    return (o for o in xrange(self.size) if accepts(o))
+
+  def _newestFirst(self, candidates):
+    accepts = self._accepts(candidates)
+    for o in xrange(self.size - 1, -1, -1):
+      if accepts(o):
+        yield o
+
+  # Documents
+
+  def fields(self, ordinal, names=None):
+    """Return the fields of a document, limited to the given names (by
+    default, all of them)."""
+    every = names is None
+    if every:
+      names = self.field_names
+    fields = []
+    for name in names:
+      column = self.columns[name]
+      value = column.value(ordinal)
+      if value is not None:
+        fields.append(column.cls(name=name, value=value))
+    extra = self.store.extras.get(ordinal)
+    if extra:
+      fields.extend(f for f in extra[0] if every or f.name in names)
+    return fields
+
+  def facets(self, ordinal):
+    facets = []
+    for name in self.facet_names:
+      column = self.facet_columns[name]
+      value = column.value(ordinal)
+      if value is not None:
+        facets.append(column.cls(name=name, value=value))
+    extra = self.store.extras.get(ordinal)
+    if extra:
+      facets.extend(extra[1])
+    return facets
+
+  def document(self, ordinal):
+    """Return the search.Document with the ordinal, as it was put."""
+    store = self.store
+    rank = store.ranks[ordinal]
+    return search.Document(
+        doc_id=store.doc_ids[ordinal], fields=self.fields(ordinal),
+        facets=self.facets(ordinal),
+        language=store.languages.value(ordinal),
+        rank=rank if rank >= 0 else None)
+
+  def _fieldValue(self, ordinal, name):
+    column = self.columns.get(name)
+    return column.value(ordinal) if column is not None else None
+
+  def _number(self, ordinal, name):
+    """Return the value of a document's number field, for the returned
+    expressions; a KeyError if it has none."""
+    column = self.columns[name]
+    if column.kind != _NUMBER or column.sortValue(ordinal) is None:
+      raise KeyError(name)
+    return column.values[ordinal]
+
+  def scoredDocument(self, ordinal, options, scores, cursor=None):
+    store = self.store
+    fields = None
+    if not options.ids_only:
+      names = None
+      if options.returned_fields:
+        returned = set(options.returned_fields)
+        names = [name for name in self.field_names if name in returned]
+      fields = self.fields(ordinal, names)
+    expressions = []
+    for name in options.snippeted_fields or []:
+      value = self._fieldValue(ordinal, name)
+      if value and isinstance(value, basestring):
+        expressions.append(
+            search.HtmlField(name=name, value=value[:_SNIPPET_LENGTH]))
+    for field_expr in options.returned_expressions or []:
+      value = _ExpressionEvaluator(
+          field_expr.expression,
+          lambda name: self._number(ordinal, name)).evaluate()
+      if value is not None:
+        expressions.append(search.NumberField(name=field_expr.name,
+                                              value=value))
+    sort_scores = []
+    if (options.sort_options is not None and
+        options.sort_options.match_scorer is not None):
+      sort_scores.append(scores.get(ordinal, 0))
+    rank = store.ranks[ordinal]
+    return search.ScoredDocument(
+        doc_id=store.doc_ids[ordinal], fields=fields,
+        language=store.languages.value(ordinal), sort_scores=sort_scores,
+        expressions=expressions, cursor=cursor,
+        rank=rank if rank >= 0 else None)
+
+  # Query evaluation
+
+  def matches(self, tree):
+    """Return the documents matching the query tree: None for all of them, a
+    set of their ordinals, or a _Complement."""
+    if tree is None:
+      return None
+    result = self._evaluate(tree)
+    if isinstance(result, _Complement):
+      return result
+    return self._visibleSet(result)
+
+  def count(self, candidates):
+    if candidates is None:
+      return self.live
+    if isinstance(candidates, _Complement):
+      return self.live - len(self._visibleSet(candidates.excluded))
+    return len(candidates)
+
+  def _posting(self, term):
+    posting = self.store.postings.get(term)
+    return set(posting) if posting else set()
+
+  def _evaluate(self, node):
+    """Return the ordinals matching the query tree, as a set or a
+    _Complement.  Either may include ordinals the snapshot can't see; the
+    caller filters those."""
+    kind = node[0]
+    if kind in ('and', 'or'):
+      results = [self._evaluate(n) for n in node[1]]
+      sets = [r for r in results if not isinstance(r, _Complement)]
+      excluded = [r.excluded for r in results if isinstance(r, _Complement)]
+      if kind == 'and':
+        if not sets:
+          return _Complement(set().union(*excluded))
+        sets.sort(key=len)
+        result = sets[0]
+        for other in sets[1:]:
+          result &= other
+        for other in excluded:
+          result -= other
+        return result
+      if not excluded:
+        return set().union(*sets)
+      # a OR NOT b OR NOT c is NOT ((b AND c) - a)
+      excluded.sort(key=len)
+      result = excluded[0]
+      for other in excluded[1:]:
+        result &= other
+      for other in sets:
+        result -= other
+      return _Complement(result)
+    if kind == 'not':
+      result = self._evaluate(node[1])
+      if isinstance(result, _Complement):
+        return result.excluded
+      return _Complement(result)
+    if kind == 'term':
+      return self._evaluateTerm(node[1], node[2])
+    if kind == 'cmp':
+      return self._evaluateComparison(node[1], node[2], node[3])
+    return self._evaluateDistance(*node[1:])
+
+  def _matchTokens(self, field, tokens):
+    """Return the set of ordinals whose field contains all the tokens.  The
+    postings are intersected as arrays, smallest first, so that only the
+    result is made a set."""
+    postings = [self.store.postings.get('%s:%s' % (field, tok))
+                for tok in tokens]
+    if not postings or not all(postings):
+      return set()
+    postings.sort(key=len)
+    result = postings[0]
+    for other in postings[1:]:
+      result = _intersect(result, other)
+      if not result:
+        break
+    return set(result)
+
+  def _evaluateTerm(self, field, text):
+    if field is None:
+      # An unrestricted term matches any text field containing its words, or
+      # any atom field equal to it.
+      tokens = _tokenize(text)
+      result = set()
+      for name in self.field_names:
+        kind = self.columns[name].kind
+        if kind == _TEXT:
+          result |= self._matchTokens(name, tokens)
+        elif kind == _ATOM:
+          result |= self._posting('%s=%s' % (name, text.lower()))
+      return result
+    column = self.columns.get(field)
+    kind = column.kind if column is not None else None
+    if kind == _TEXT:
+      return self._matchTokens(field, _tokenize(text))
+    if kind == _ATOM:
+      return self._posting('%s=%s' % (field, text.lower()))
+    if kind in (_NUMBER, _DATE):
+      return self._evaluateComparison(field, '=', text)
+    return set()
+
+  def _evaluateComparison(self, field, op, text):
+    """Return the ordinals whose number or date field compares as given to
+    the text's value, found by bisecting the field's sort index."""
+    column = self.columns.get(field)
+    if column is None:
+      return set()
+    if column.kind == _NUMBER:
+      try:
+        target = float(text)
+      except ValueError:
+        return set()
+    elif column.kind == _DATE:
+      target = _parseDate(text)
+      if target is None:
+        return set()
+    else:
+      return set()
+    index = self._sortIndex(field)
+    values = index.values
+    lo, hi = 0, len(values)
+    if op in (':', '=', '>='):
+      lo = bisect.bisect_left(values, target)
+    elif op == '>':
+      lo = bisect.bisect_right(values, target)
+    if op in (':', '=', '<='):
+      hi = bisect.bisect_right(values, target)
+    elif op == '<':
+      hi = bisect.bisect_left(values, target)
+    result = set(index.ordinals[lo:hi])
+    for o in xrange(index.size, self.size):
+      value = column.sortValue(o)
+      if value is not None and _compare(value, op, target):
+        result.add(o)
+    return result
+
+  def _evaluateDistance(self, field, lat, lon, op, meters):
+    column = self.columns.get(field)
+    if column is None or column.kind != _GEO:
+      return set()
+    result = set()
+    for o in xrange(self.size):
+      point = column.point(o)
+      if point is not None and _compare(
+          utils.haversineDistance(lat, lon, point[0], point[1]), op, meters):
+        result.add(o)
+    return result
+
+  def _queryTerms(self, node):
+    """Return the (field, text) of the non-negated terms in the query tree."""
+    if node is None or node[0] == 'not':
+      return []
+    if node[0] in ('and', 'or'):
+      terms = []
+      for n in node[1]:
+        terms.extend(self._queryTerms(n))
+      return terms
+    if node[0] == 'term':
+      return [node[1:]]
+    return []
+
+  def _scores(self, candidates, tree):
+    """Score each candidate by the number of query terms it matches."""
+    if candidates is None:
+      return _UniformScores(0)
+    terms = self._queryTerms(tree)
+    if not _hasOr(tree):
+      return _UniformScores(len(terms))
+    accepts = self._accepts(candidates)
+    scores = {}
+    for field, text in terms:
+      for o in self._evaluateTerm(field, text):
+        if accepts(o):
+          scores[o] = scores.get(o, 0) + 1
+    return scores
+
+  # Sorting
+
+  def _sortIndex(self, name):
+    """Return the _SortIndex of a field, rebuilding it if enough documents
+    have been added since it was built.  Those added since are sorted by
+    each search that uses it."""
+    store = self.store
+    index = store.sorts.get(name)
+    if index is None or self._outgrown(index):
+      with store.sorts_lock:
+        index = store.sorts.get(name)
+        if index is None or self._outgrown(index):
+          index = store.sorts[name] = _SortIndex(self.columns[name],
+                                                 self.size)
+    return index
+
+  def _outgrown(self, index):
+    return self.size - index.size > max(_SORT_TAIL_LIMIT, index.size // 8)
+
+  def _sortKey(self, sort_expr, scores):
+    """Return a function computing the sort key of an ordinal for the given
+    search.SortExpression."""
+    expression = sort_expr.expression.strip()
+    default = sort_expr.default_value
+    if expression == '_score':
+      lookup = lambda o: scores.get(o, 0)
+    elif _DISTANCE_RE.match(expression):
+      field, lat, lon = _DISTANCE_RE.match(expression).groups()
+      lat, lon = float(lat), float(lon)
+      column = self.columns.get(field)
+      if column is None or column.kind != _GEO:
+        lookup = lambda o: None
+      else:
+        def lookup(o):
+          point = column.point(o)
+          if point is None:
+            return None
+          return utils.haversineDistance(lat, lon, point[0], point[1])
+    else:
+      column = self.columns.get(expression)
+      lookup = column.sortValue if column is not None else lambda o: None
+      default = _utf8(default)
+    if sort_expr.direction == search.SortExpression.DESCENDING:
+      default = _descending(default)
+      def key(o):
+        v = lookup(o)
+        return default if v is None else _descending(v)
+    else:
+      def key(o):
+        v = lookup(o)
+        return default if v is None else v
+    return key
+
+  def _sortedStream(self, sort_expr):
+    """Return an iterator over the ordinals in the order of a sort expression
+    naming a field, ties newest first (including ordinals the snapshot can't
+    see), merging the field's sort index, the documents added since it was
+    built, and the documents without the field; or None if the expression
+    doesn't name a field."""
+    name = sort_expr.expression.strip()
+    column = self.columns.get(name)
+    if column is None or column.kind == _GEO:
+      return None
+    index = self._sortIndex(name)
+    descending = sort_expr.direction == search.SortExpression.DESCENDING
+    tail = []
+    missing = []
+    for o in xrange(self.size - 1, index.size - 1, -1):
+      value = column.sortValue(o)
+      if value is None:
+        missing.append(-o)
+      else:
+        tail.append((_descending(value) if descending else value, -o))
+    tail.sort()
+    # the streams are of (sort key, -ordinal), so that ties merge newest first
+    missing = itertools.chain(missing, (-o for o in reversed(index.missing)))
+    default = _utf8(sort_expr.default_value)
+    if descending:
+      default = _descending(default)
+      indexed = ((_descending(v), -o) for v, o in itertools.izip(
+          reversed(index.values), reversed(index.ordinals)))
+    else:
+      indexed = _tiesNewestFirst(index.values, index.ordinals)
+    streams = [indexed, iter(tail), ((default, o) for o in missing)]
+    return (-o for _, o in heapq.merge(*streams))
+
+  def _firstInStream(self, stream, candidates, k, primary, key):
+    """Return the first k candidates in sort order, given a stream of the
+    ordinals in order of the primary sort key, ties newest first.  If there
+    are other sort keys (key orders by all of them), the stream is read
+    until k candidates are found, and then to the end of the last one's ties
+    on the primary key, which the other sort keys then order; if not
+    (primary is None), it is already in sort order."""
+    accepts = self._accepts(candidates)
+    if primary is None:
+      return list(itertools.islice(itertools.ifilter(accepts, stream), k))
+    res = []
+    last = None
+    for o in stream:
+      if not accepts(o):
+        continue
+      value = primary(o)
+      if len(res) >= k and not value == last:
+        break
+      res.append(o)
+      last = value
+    res.sort(key=key)
+    return res[:k]
+
+  def order(self, candidates, tree, sort_options, k):
+    """Return the first k of the candidates in sort order, and the match
+    scores of the candidates (empty if the query isn't sorted).  Ties, and
+    unsorted queries, are ordered newest first, as the search service orders
+    by document rank by default.  A query sorted on a field walks the field's
+    sort index, unless it matches so few documents that sorting them is
+    cheaper."""
+    expressions = []
+    scorer = None
+    if sort_options is not None:
+      expressions = list(sort_options.expressions or [])
+      scorer = sort_options.match_scorer
+    scores = {}
+    if expressions or scorer is not None:
+      scores = self._scores(candidates, tree)
+    keyfuncs = [self._sortKey(e, scores) for e in expressions]
+    if scorer is not None and not isinstance(scores, _UniformScores):
+      keyfuncs.append(lambda o: -scores.get(o, 0))
+    if not keyfuncs:
+      if isinstance(candidates, set):
+        return heapq.nlargest(k, candidates), scores
+      return list(itertools.islice(self._newestFirst(candidates), k)), scores
+    keyfuncs.append(lambda o: -o)
+    key = lambda o: tuple(f(o) for f in keyfuncs)
+    stream = self._sortedStream(expressions[0]) if expressions else None
+    if stream is not None and (not isinstance(candidates, set) or
+                               len(candidates) ** 2 > k * self.size):
+      primary = keyfuncs[0] if len(keyfuncs) > 2 else None
+      return self._firstInStream(
+          stream, candidates, k, primary, key), scores
+    return heapq.nsmallest(k, self._ascending(candidates), key=key), scores
+
+  # Facets
+
+  def facetResult(self, request, candidates):
+    """Return the search.FacetResult for a search.FacetRequest over the
+    candidates: the counts of each of the request's ranges, or else the
+    value_limit most frequent values.  The results over all the documents
+    are kept with the snapshot, as every match-all search asks for them."""
+    cache_key = None
+    if candidates is None:
+      cache_key = (request.name, request.value_limit,
+                   tuple(request.values or ()),
+                   tuple((r.start, r.end) for r in request.ranges or ()))
+      result = self._facet_cache.get(cache_key)
+      if result is not None:
+        return result
+    result = self._countFacet(request, candidates)
+    if cache_key is not None:
+      self._facet_cache[cache_key] = result
+    return result
+
+  def _facetValueLists(self, name, column, ordinals):
+    """Yield the list of the values of the facet of each of the ordinals that
+    has any."""
+    extras = self.store.extras
+    for o in ordinals:
+      values = []
+      if column is not None:
+        value = column.value(o)
+        if value is not None:
+          values.append(value)
+      extra = extras.get(o)
+      if extra:
+        values.extend(float(f.value) if isinstance(f, search.NumberFacet)
+                      else f.value for f in extra[1] if f.name == name)
+      if values:
+        yield values
+
+  def _countFacet(self, request, candidates):
+    name = request.name
+    column = self.facet_columns.get(name)
+    ordinals = self._ascending(candidates)
+    # the values of single-valued facets are counted from their columns
+    single = (column is not None and
+              name not in self.store.extra_facet_names)
+    res = []
+    if request.ranges:
+      bounds = sorted(set(
+          bound for frange in request.ranges
+          for bound in (frange.start, frange.end) if bound is not None))
+      if (single and column.kind == _NUMBER and
+          len(bounds) < _COUNT_BY_VALUE_LIMIT):
+        # count the documents between each pair of consecutive bounds, by
+        # bisecting for each value (in C) rather than sorting them; NaN, the
+        # missing value, falls after the infinite bound, which no facet
+        # value reaches
+        bounds.append(float('inf'))
+        buckets = array.array('B', itertools.imap(
+            bisect.bisect_right, itertools.repeat(bounds),
+            itertools.imap(column.values.__getitem__, ordinals))).tostring()
+        counts = [buckets.count(chr(i)) for i in xrange(len(bounds))]
+        def count(start, end):
+          lo = 0 if start is None else bisect.bisect_right(bounds, start)
+          hi = (len(counts) if end is None
+                else bisect.bisect_right(bounds, end))
+          return sum(counts[lo:hi])
+      elif single and column.kind == _NUMBER:
+        values = array.array('d', itertools.imap(column.values.__getitem__,
+                                                 ordinals))
+        values = [v for v in values if v == v]
+        values.sort()
+        def count(start, end):
+          lo = 0 if start is None else bisect.bisect_left(values, start)
+          hi = (len(values) if end is None
+                else bisect.bisect_left(values, end))
+          return max(hi - lo, 0)
+      else:
+        value_lists = list(self._facetValueLists(name, column, ordinals))
+        def count(start, end):
+          return sum(1 for values in value_lists
+                     if any(_inRange(v, start, end) for v in values))
+      for frange in request.ranges:
+        n = count(frange.start, frange.end)
+        if n:
+          res.append(search.FacetResultValue(
+              rangeLabel(frange.start, frange.end), n,
+              search.FacetRefinement(name, facet_range=frange)))
+    else:
+      if single and column.kind == _ATOM:
+        counts = column.countValues(ordinals)
+      else:
+        counts = {}
+        for values in self._facetValueLists(name, column, ordinals):
+          for value in set(values):
+            counts[value] = counts.get(value, 0) + 1
+      if request.values:
+        wanted = set(request.values)
+        counts = dict((v, n) for v, n in counts.iteritems() if v in wanted)
+      top = heapq.nsmallest(request.value_limit, counts.iteritems(),
+                            key=lambda pair: (-pair[1], pair[0]))
+      for value, n in top:
+        label = value if isinstance(value, basestring) else repr(value)
+        res.append(search.FacetResultValue(
+            label, n, search.FacetRefinement(name, value=label)))
+    return search.FacetResult(name, values=res)
+
+
+class _IndexData(object):
+  """The documents of one in-memory index.  The app is threadsafe, so writes
+  are serialized by a lock, and each publishes a new _Snapshot; searches read
+  the latest snapshot, without waiting for writes in progress."""
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._snapshot = _Snapshot(_Store(), 0)
+
+  # Updates
+
+  def put(self, documents):
+    if isinstance(documents, search.Document):
+      documents = [documents]
+    results = []
+    with self._lock:
+      store = self._snapshot.store
+      generation = self._snapshot.generation + 1
+      for doc in documents:
+        if not doc.doc_id:
+          doc = search.Document(
+              doc_id=uuid.uuid4().hex, fields=doc.fields,
+              facets=doc.facets, language=doc.language, rank=doc.rank)
+        self._remove(store, doc.doc_id, generation)
+        self._add(store, doc)
+        results.append(search.PutResult(
+            code=search.OperationResult.OK, id=doc.doc_id))
+      self._publish(store, generation)
+    return results
+
+  def delete(self, doc_ids):
+    if isinstance(doc_ids, basestring):
+      doc_ids = [doc_ids]
+    with self._lock:
+      store = self._snapshot.store
+      generation = self._snapshot.generation + 1
+      for doc_id in doc_ids:
+        self._remove(store, doc_id, generation)
+      self._publish(store, generation)
+
+  def _add(self, store, doc):
+    ordinal = len(store.doc_ids)
+    fields, new_fields, extra_fields = _splitValues(
+        store.columns, doc.fields, _fieldKind)
+    facets, new_facets, extra_facets = _splitValues(
+        store.facet_columns, doc.facets or [], _facetKind)
+    store.columns, store.field_names = _appendColumns(
+        store.columns, store.field_names, fields, new_fields, ordinal,
+        _fieldKind)
+    store.facet_columns, store.facet_names = _appendColumns(
+        store.facet_columns, store.facet_names, facets, new_facets, ordinal,
+        _facetKind)
+    if extra_fields or extra_facets:
+      store.extras[ordinal] = (extra_fields, extra_facets)
+      store.extra_facet_names.update(f.name for f in extra_facets)
+    store.languages.append(doc.language)
+    store.ranks.append(-1 if doc.rank is None else doc.rank)
+    store.removed.append(0)
+    store.doc_ids.append(doc.doc_id)
+    store.ordinals[doc.doc_id] = ordinal
+    store.sorted_ids = None
+    terms = set()
+    for field in doc.fields:
+      kind = _fieldKind(field)
+      if field.value is None:
+        continue
+      if kind == _TEXT:
+        terms.update('%s:%s' % (field.name, tok)
+                     for tok in _tokenize(field.value))
+      elif kind == _ATOM:
+        terms.add('%s=%s' % (field.name, field.value.lower()))
+    for term in terms:
+      posting = store.postings.get(term)
+      if posting is None:
+        posting = store.postings[term] = array.array('I')
+      posting.append(ordinal)
+
+  def _remove(self, store, doc_id, generation):
+    ordinal = store.ordinals.pop(doc_id, None)
+    if ordinal is None:
+      return
+    # The document's values and postings stay in place, for the snapshots
+    # that can still see it; they are dropped when the store is compacted.
+    store.removed[ordinal] = generation
+    store.sorted_ids = None
+    store.dead += 1
+
+  def _publish(self, store, generation):
+    """Make the writes of a generation visible to searches, first compacting
+    the store if enough of its documents have been removed."""
+    if store.dead > _COMPACT_THRESHOLD and store.dead > len(store.ordinals):
+      snapshot = _Snapshot(store, generation)
+      store = _Store()
+      for ordinal in sorted(snapshot.store.ordinals.itervalues()):
+        self._add(store, snapshot.document(ordinal))
+    self._snapshot = _Snapshot(store, generation)
+
+  # Lookups
+
+  def get(self, doc_id):
+    snapshot = self._snapshot
+    ordinal = snapshot.store.ordinals.get(doc_id)
+    if ordinal is not None and snapshot.visible(ordinal):
+      return snapshot.document(ordinal)
+    # the document may be being replaced by a write in progress
+    with self._lock:
+      snapshot = self._snapshot
+      ordinal = snapshot.store.ordinals.get(doc_id)
+      return snapshot.document(ordinal) if ordinal is not None else None
+
+  def getRange(self, start_id=None, include_start_object=True, limit=100,
+               ids_only=False):
+    with self._lock:
+      snapshot = self._snapshot
+      store = snapshot.store
+      if store.sorted_ids is None:
+        store.sorted_ids = sorted(store.ordinals)
+      ids = store.sorted_ids
+      i = bisect.bisect_left(ids, start_id) if start_id else 0
+      if (start_id and not include_start_object and i < len(ids)
+          and ids[i] == start_id):
+        i += 1
+      page = ids[i:i + limit]
+      if ids_only:
+        results = [search.Document(doc_id=doc_id) for doc_id in page]
+      else:
+        results = [snapshot.document(store.ordinals[doc_id])
+                   for doc_id in page]
+    return search.GetResponse(results=results)
+
+  def search(self, query):
+    if isinstance(query, basestring):
+      query = search.Query(query_string=query)
+    options = query.options or search.QueryOptions()
+    limit = options.limit or _DEFAULT_LIMIT
+    offset = options.offset or 0
+    if options.cursor is not None and options.cursor.web_safe_string:
+      offset = _decodeCursor(options.cursor)
+    tree = _QueryParser(query.query_string).parse()
+    snapshot = self._snapshot
+    candidates = snapshot.matches(tree)
+    number_found = snapshot.count(candidates)
+    ordered, scores = snapshot.order(
+        candidates, tree, options.sort_options, offset + limit)
+    per_result = options.cursor is not None and options.cursor.per_result
+    results = []
+    for i, o in enumerate(ordered[offset:offset + limit]):
+      result_cursor = None
+      if per_result:
+        result_cursor = search.Cursor(web_safe_string=_encodeCursor(
+            offset + i + 1, per_result=True))
+      results.append(
+          snapshot.scoredDocument(o, options, scores, result_cursor))
+    facets = [snapshot.facetResult(request, candidates)
+              for request in query.return_facets or []]
+    cursor = None
+    if options.cursor is not None and offset + len(results) < number_found:
+      cursor = search.Cursor(web_safe_string=_encodeCursor(
+          offset + len(results)))
+    return search.SearchResults(
+        number_found=number_found, results=results, cursor=cursor,
+        facets=facets)
+
+
+class Index(object):
+  """An in-memory stand-in for search.Index.  All Index objects opened with
+  the same name and namespace share the same documents."""
+
+  def __init__(self, name, namespace=''):
+    self._name = name
+    self._namespace = namespace
+    with _INDEXES_LOCK:
+      self._data = _INDEXES.setdefault((namespace, name), _IndexData())
+
+  @property
+  def name(self):
+    return self._name
+
+  @property
+  def namespace(self):
+    return self._namespace
+
+  def put(self, documents):
+    return self._data.put(documents)
+
+  def delete(self, document_ids):
+    self._data.delete(document_ids)
+
+  def get(self, doc_id):
+    return self._data.get(doc_id)
+
+  def get_range(self, start_id=None, include_start_object=True, limit=100,
+                ids_only=False):
+    return self._data.getRange(start_id, include_start_object, limit,
+                               ids_only)
+
+  def search(self, query):
+    return self._data.search(query)
+
+  def put_async(self, documents):
+    return _Result(self.put, documents)
+
+  def delete_async(self, document_ids):
+    return _Result(self.delete, document_ids)
+
+  def get_range_async(self, start_id=None, include_start_object=True,
+                      limit=100, ids_only=False):
+    return _Result(self.get_range, start_id, include_start_object, limit,
+                   ids_only)
+
+  def search_async(self, query):
+    return _Result(self.search, query)
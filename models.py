@@ -23,12 +23,16 @@ are not part of the same entity group, thus avoiding contention in
 scenarios where a large number of product reviews might be edited/added at once.
 """
 
+import hashlib
+import json
 import logging
+import time
 
+import cache
 import categories
-import docs
+import category_tree
+import config
 
-from google.appengine.api import memcache
 from google.appengine.ext import ndb
 
 
@@ -36,10 +40,12 @@ class Category(ndb.Model):
   """The model class for product category information.  Supports building a
   category tree."""
 
-  _CATEGORY_INFO = None
-  _CATEGORY_DICT = None
-  _RCATEGORY_DICT = None
   _ROOT = 'root'  # the 'root' category of the category tree
+  # The category tree is versioned; the snapshot for each version is cached
+  # in memcache, and in _TREE as (version, CategoryTree, time last checked).
+  _TREE_VERSION = 'category_tree'
+  _TREE_NAMESPACE = 'category_tree'
+  _TREE = None
 
   parent_category = ndb.KeyProperty()
 
@@ -66,13 +72,15 @@ class Category(ndb.Model):
       return
     cname = category_data.get('name')
     if not cname:
-      logging.warn('no category name for %s', category)
+      logging.warn('no category name for %s', category_data)
       return
     if parent_key:
       cat = cls(id=cname, parent_category=parent_key)
     else:
       cat = cls(id=cname)
     cat.put()
+    # the category tree has changed: invalidate all cached snapshots.
+    cache.bumpVersion(cls._TREE_VERSION)
 
     children = category_data.get('children')
     # if there are any children, build them using their parent key
@@ -85,17 +93,64 @@ class Category(ndb.Model):
     for cat in children:
       cls.buildCategory(cat, parent_key)
 
+  @classmethod
+  def getCategoryTree(cls):
+    """Return the current category_tree.CategoryTree.  The tree is cached per
+    instance, and in memcache keyed by the tree version, which is bumped
+    whenever a category is written, so that edits propagate to all instances.
+    An instance checks the version at most every
+    config.CATEGORY_TREE_CHECK_SECS seconds, and only reads the Category
+    entities if no instance has cached the current version."""
+    return cls.getCategoryTreeAsync().get_result()
+
+  @classmethod
+  @ndb.tasklet
+  def getCategoryTreeAsync(cls):
+    """The asynchronous form of getCategoryTree: returns a future, so that
+    the version check can run alongside the other lookups of a request."""
+    now = time.time()
+    local = cls._TREE
+    if local and now - local[2] < config.CATEGORY_TREE_CHECK_SECS:
+      raise ndb.Return(local[1])
+    version = yield cache.getVersionAsync(cls._TREE_VERSION)
+    if local and local[0] == version:
+      cls._TREE = (version, local[1], now)
+      raise ndb.Return(local[1])
+    ctx = ndb.get_context()
+    parents = yield ctx.memcache_get(str(version),
+                                     namespace=cls._TREE_NAMESPACE)
+    if parents is None:
+      parents = yield cls._loadParentsAsync()
+      yield ctx.memcache_set(str(version), parents,
+                             namespace=cls._TREE_NAMESPACE)
+    tree = category_tree.CategoryTree(parents, root=cls._ROOT)
+    cls._TREE = (version, tree, now)
+    raise ndb.Return(tree)
+
+  @classmethod
+  @ndb.tasklet
+  def _loadParentsAsync(cls):
+    """Read the category entities (building them first from the data file,
+    if required), and return a future for a dict mapping each category name
+    to its parent's name."""
+    cls.buildAllCategories()
+    entities = yield cls.query().fetch_async()
+    raise ndb.Return(dict(
+        (c.key.id(), c.parent_category.id() if c.parent_category else None)
+        for c in entities))
+
   @classmethod
   def getCategoryInfo(cls):
-    """Build and cache a list of category id/name correspondences.  This info is
+    """Return a list of category id/name correspondences.  This info is
     used to populate html select menus."""
-    if not cls._CATEGORY_INFO:
-      cls.buildAllCategories()  #first build categories from data file
-          # if required
-      cats = cls.query().fetch()
-      cls._CATEGORY_INFO = [(c.key.id(), c.key.id()) for c in cats
-            if c.key.id() != cls._ROOT]
-    return cls._CATEGORY_INFO
+    return cls.getCategoryInfoAsync().get_result()
+
+  @classmethod
+  @ndb.tasklet
+  def getCategoryInfoAsync(cls):
+    """The asynchronous form of getCategoryInfo: returns a future."""
+    tree = yield cls.getCategoryTreeAsync()
+    raise ndb.Return(tree.menuInfo())
 
 class Product(ndb.Model):
   """Model for Product data. A Product entity will be built for each product,
@@ -107,26 +162,75 @@ class Product(ndb.Model):
   price = ndb.FloatProperty()
   category = ndb.StringProperty()
   active = ndb.BooleanProperty(default=True)
+  # a hash of the params the product was last built from (see contentHash)
+  content_hash = ndb.StringProperty(indexed=False)
+  # the product index the product's document was last written to (see
+  # docs.Product.switchToIndex)
+  index_name = ndb.StringProperty()
 
   @property
   def pid(self):
     return self.key.id()
 
+  @classmethod
+  def contentHash(cls, params):
+    """Return a hash of the given (normalized) product params dict.  It is
+    stored with the entity, so that an import can tell whether a product has
+    changed since it was last built, without fetching its document."""
+    return hashlib.sha1(json.dumps(params, sort_keys=True)).hexdigest()
+
  
   @classmethod
-  def create(cls, params, doc_id):
+  def create(cls, params, doc_id, index_name=None):
     """Create a new product entity from a subset of the given params dict
-    values, and the given doc_id."""
+    values, and the given doc_id and the name of the index it's in."""
     prod = cls(
         id=params['pid'], price=params['price'],
-        category=params['category'], doc_id=doc_id)
+        category=params['category'], doc_id=doc_id,
+        content_hash=cls.contentHash(params), index_name=index_name)
     prod.put()
     return prod
 
-  def update_core(self, params, doc_id):
-    """Update 'core' values from the given params dict and doc_id."""
+  def update_core(self, params, doc_id, index_name=None):
+    """Update 'core' values from the given params dict, doc_id and index
+    name."""
     self.populate(
         price=params['price'], category=params['category'],
-        doc_id=doc_id)
-
-  
+        doc_id=doc_id, content_hash=self.contentHash(params),
+        index_name=index_name)
+
+
+class IndexAlias(ndb.Model):
+  """Points an index alias, the key name, at the live index, and at the index
+  being built to replace it, if any (see docs.Product.getLiveIndexName)."""
+
+  live = ndb.StringProperty(indexed=False)
+  building = ndb.StringProperty(indexed=False)
+  updated = ndb.DateTimeProperty(auto_now=True)
+
+
+class ReinitJob(ndb.Model):
+  """Tracks the progress of a sharded reinitialization of the app's data (see
+  reinit.py).  Each phase runs as a set of named shards, each in its own
+  deferred task; a shard's counts are added when it completes, and once all
+  the shards of a phase are done, the next phase is started."""
+
+  started = ndb.DateTimeProperty(auto_now_add=True)
+  updated = ndb.DateTimeProperty(auto_now=True)
+  finished = ndb.DateTimeProperty()
+  phase = ndb.StringProperty(indexed=False)
+  phase_started = ndb.DateTimeProperty(indexed=False)
+  # the shards of the current phase, and the shards done in all phases
+  shards = ndb.StringProperty(repeated=True, indexed=False)
+  done_shards = ndb.StringProperty(repeated=True, indexed=False)
+  deleted = ndb.IntegerProperty(default=0, indexed=False)
+  written = ndb.IntegerProperty(default=0, indexed=False)
+  skipped = ndb.IntegerProperty(default=0, indexed=False)
+  failed = ndb.IntegerProperty(default=0, indexed=False)
+  # the sizes of the csv data to import, and of the part imported so far
+  total_bytes = ndb.IntegerProperty(default=0, indexed=False)
+  done_bytes = ndb.IntegerProperty(default=0, indexed=False)
+  # the product index being built, which replaces the live one at the end
+  index_name = ndb.StringProperty(indexed=False)
+  # why the new index did not replace the live one, if it didn't
+  error = ndb.StringProperty(indexed=False)
@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+#
+# Copyright 2012 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" An in-memory prefix index over product names and brands, used to answer
+autocomplete queries without a search request.
+"""
+
+import bisect
+import re
+
+
+_TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+NAME = 'name'
+BRAND = 'brand'
+
+
+def normalize(text):
+  """Lower-case the text, and reduce it to its words separated by single
+  spaces."""
+  return u' '.join(_TOKEN_RE.findall(text.lower()))
+
+
+def _entries(pid, name, brand):
+  """Return the sorted (key, kind, text, pid) entries for a product: one for
+  each word of its name onwards, so that 'gal' matches 'Samsung Galaxy', and
+  one for its brand."""
+  entries = []
+  words = normalize(name or u'').split(u' ')
+  for i in xrange(len(words)):
+    key = u' '.join(words[i:])
+    if key:
+      entries.append((key, NAME, name, pid))
+  if brand:
+    entries.append((normalize(brand), BRAND, brand, pid))
+  entries.sort()
+  return entries
+
+
+def _arrays(entries):
+  entries.sort()
+  return [e[0] for e in entries], [e[1:] for e in entries]
+
+
+def _scan(keys, items, prefix, limit, skip=()):
+  """Return up to limit (key, kind, text, pid) entries with distinct (kind,
+  text), whose key starts with prefix, in key order; entries for the product
+  ids in skip are ignored."""
+  res = []
+  seen = set()
+  i = bisect.bisect_left(keys, prefix)
+  while (len(res) < limit and i < len(keys) and
+         keys[i].startswith(prefix)):
+    kind, text, pid = items[i]
+    if pid not in skip and (kind, text) not in seen:
+      seen.add((kind, text))
+      res.append((keys[i], kind, text, pid))
+    i += 1
+  return res
+
+
+class PrefixIndex(object):
+  """Sorted arrays of normalized keys, searched with bisect.  The index is
+  immutable, so it can be shared between threads; withProducts returns an
+  updated copy.
+
+  So that an update doesn't cost a copy of all the entries, the entries are
+  split between a large base, which is shared by the copies, and a small delta
+  holding those of the products changed since the base was built, whose base
+  entries are skipped.  Once the delta reaches an eighth of the base, the two
+  are merged into a new base."""
+
+  __slots__ = ('_products', '_base', '_delta', '_changed')
+
+  # the minimum delta size that triggers a merge
+  _MIN_MERGE_SIZE = 1000
+
+  def __init__(self, products=None):
+    """Args:
+      products: dict mapping each product id to its (name, brand) pair.
+    """
+    self._products = dict(products or {})
+    entries = []
+    for pid, (name, brand) in self._products.iteritems():
+      entries.extend(_entries(pid, name, brand))
+    self._base = _arrays(entries)
+    self._delta = ([], [])
+    self._changed = frozenset()
+
+  def __len__(self):
+    return len(self._products)
+
+  def withProducts(self, products=None, removed=()):
+    """Return a copy of the index with the given products added or replaced,
+    and the products with the given ids removed.
+    Args:
+      products: dict mapping each product id to its (name, brand) pair.
+      removed: product ids.
+    """
+    products = products or {}
+    merged = dict(self._products)
+    for pid in removed:
+      merged.pop(pid, None)
+    merged.update(products)
+    changed = self._changed.union(products, removed)
+    delta_size = len(self._delta[0]) + 6 * len(products)
+    if delta_size >= max(self._MIN_MERGE_SIZE, len(self._base[0]) // 8):
+      return PrefixIndex(merged)
+    # the delta holds the current entries of all the changed products
+    updated = set(products).union(removed)
+    keys, items = self._delta
+    entries = [(keys[i],) + items[i] for i in xrange(len(keys))
+               if items[i][2] not in updated]
+    for pid, (name, brand) in products.iteritems():
+      entries.extend(_entries(pid, name, brand))
+    res = PrefixIndex.__new__(PrefixIndex)
+    res._products = merged
+    res._base = self._base
+    res._delta = _arrays(entries)
+    res._changed = changed
+    return res
+
+  def lookup(self, prefix, limit=10):
+    """Return up to limit distinct (kind, text, pid) suggestions whose key
+    starts with the normalized prefix, in key order.  kind is NAME or
+    BRAND."""
+    prefix = normalize(prefix)
+    if not prefix:
+      return []
+    base = _scan(self._base[0], self._base[1], prefix, limit, self._changed)
+    if self._changed:
+      delta = _scan(self._delta[0], self._delta[1], prefix, limit)
+      base = sorted(base + delta)
+    res = []
+    seen = set()
+    for _, kind, text, pid in base:
+      if (kind, text) not in seen:
+        seen.add((kind, text))
+        res.append((kind, text, pid))
+        if len(res) == limit:
+          break
+    return res
@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+#
+# Copyright 2012 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Bulk deletion of all the documents in a search index, or all the entities
+of a datastore model.  Both are paged with cursors, so memory use is bounded by
+the page size regardless of how much is deleted, and deletes are issued
+asynchronously in maximum-size batches, with several requests in flight at
+once.  Progress (items deleted and items/sec) is logged as the purge runs.
+"""
+
+import collections
+import logging
+import time
+
+import config
+
+from google.appengine.api import search
+from google.appengine.ext import ndb
+
+
+# the maximum number of documents per get_range and per delete call
+INDEX_PAGE_SIZE = 1000
+INDEX_DELETE_BATCH_SIZE = 200
+# the number of keys fetched, and deleted, per datastore call
+DATASTORE_PAGE_SIZE = 500
+
+
+class PurgeProgress(object):
+  """Counts the items deleted by a purge, and logs the count and rate at most
+  every log_interval seconds."""
+
+  def __init__(self, name, log_interval=10, callback=None):
+    """Args:
+      name: describes what is being purged, for the log messages.
+      log_interval: the minimum number of seconds between progress messages.
+      callback: if given, called with the summary dict after each batch.
+    """
+    self.name = name
+    self.deleted = 0
+    self.start = time.time()
+    self._log_interval = log_interval
+    self._last_log = self.start
+    self._callback = callback
+
+  def add(self, count):
+    self.deleted += count
+    now = time.time()
+    if now - self._last_log >= self._log_interval:
+      self._last_log = now
+      logging.info('Purging %s: %d deleted, %.1f/sec', self.name,
+                   self.deleted, self.rate())
+    if self._callback:
+      self._callback(self.summary())
+
+  def rate(self):
+    elapsed = time.time() - self.start
+    return self.deleted / elapsed if elapsed > 0 else 0.0
+
+  def summary(self):
+    return {'name': self.name, 'deleted': self.deleted,
+            'secs': time.time() - self.start, 'per_sec': self.rate()}
+
+  def finish(self):
+    logging.info('Purged %s: %d deleted in %.1f secs, %.1f/sec', self.name,
+                 self.deleted, time.time() - self.start, self.rate())
+    return self.summary()
+
+
+def purgeIndex(index, max_in_flight=None, callback=None, keep=None):
+  """Delete all the documents in the given search index, except those whose
+  ids are in keep, if given.  Document ids are read a page at a time,
+  starting after the last id of the previous page, and deleted in batches of
+  INDEX_DELETE_BATCH_SIZE, with up to max_in_flight delete calls outstanding.
+  Search errors are logged, and end the purge.  Returns the progress summary
+  dict."""
+  max_in_flight = max_in_flight or config.PURGE_MAX_IN_FLIGHT
+  progress = PurgeProgress('index %s' % index.name, callback=callback)
+  in_flight = collections.deque()
+  start_id = None
+  try:
+    while True:
+      response = index.get_range(
+          start_id=start_id, include_start_object=False,
+          limit=INDEX_PAGE_SIZE, ids_only=True)
+      doc_ids = [document.doc_id for document in response.results]
+      if not doc_ids:
+        break
+      start_id = doc_ids[-1]
+      if keep:
+        doc_ids = [doc_id for doc_id in doc_ids if doc_id not in keep]
+      for i in xrange(0, len(doc_ids), INDEX_DELETE_BATCH_SIZE):
+        batch = doc_ids[i:i + INDEX_DELETE_BATCH_SIZE]
+        if len(in_flight) >= max_in_flight:
+          _finishIndexDelete(in_flight.popleft(), progress)
+        in_flight.append((index.delete_async(batch), len(batch)))
+    while in_flight:
+      _finishIndexDelete(in_flight.popleft(), progress)
+  except search.Error:
+    logging.exception('Error removing documents from index %s:', index.name)
+  return progress.finish()
+
+
+def _finishIndexDelete(pending, progress):
+  future, count = pending
+  future.get_result()
+  progress.add(count)
+
+
+def purgeModel(model_class, max_in_flight=None, callback=None, where=None):
+  """Delete all the entities of the given ndb model class, or if where is
+  given, those for which where(entity) is true (the entities are then
+  fetched whole, rather than just their keys).  Keys are fetched a page at a
+  time with a query cursor, and each page is deleted asynchronously while the
+  next is fetched, with up to max_in_flight pages being deleted at once.
+  Returns the progress summary dict."""
+  max_in_flight = max_in_flight or config.PURGE_MAX_IN_FLIGHT
+  progress = PurgeProgress(
+      'model %s' % model_class._get_kind(), callback=callback)
+  in_flight = collections.deque()
+  query = model_class.query()
+  cursor = None
+  more = True
+  while more:
+    results, cursor, more = query.fetch_page(
+        DATASTORE_PAGE_SIZE, start_cursor=cursor, keys_only=where is None)
+    if not results:
+      break
+    if where is None:
+      keys = results
+    else:
+      keys = [entity.key for entity in results if where(entity)]
+      if not keys:
+        continue
+    if len(in_flight) >= max_in_flight:
+      _finishModelDelete(in_flight.popleft(), progress)
+    in_flight.append((ndb.delete_multi_async(keys), len(keys)))
+  while in_flight:
+    _finishModelDelete(in_flight.popleft(), progress)
+  return progress.finish()
+
+
+def _finishModelDelete(pending, progress):
+  futures, count = pending
+  for future in futures:
+    future.get_result()
+  progress.add(count)
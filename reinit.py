@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+#
+# Copyright 2012 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Sharded reinitialization of the app's data: the work done by
+admin_handlers.reinitAll, split into shards that run in parallel, each in its
+own deferred task, so that a large reset isn't limited to one task's deadline
+or one instance.
+
+The products are indexed into a new product index, which replaces the live
+one at the end (see docs.Product.startRebuild), so that searches are served
+throughout; the product entities and store documents are replaced in place.
+The work is done in three phases.  In the 'purge' phase, a single shard
+purges anything left in the new product index by an unfinished rebuild.  In
+the 'import' phase, each sample data file is imported by shards of
+config.REINIT_SHARD_BYTES byte ranges, and the store locations are loaded by
+another shard.  In the 'switch' phase, a single shard checks the new index
+against the import's counts and makes it live, and the products no longer in
+the data are deleted (see docs.Product.switchToIndex).  Progress is tracked
+in a models.ReinitJob entity: as each shard completes, its counts are added
+and it is marked done, in a transaction, and the last shard of a phase
+starts the next one.
+
+Shards that are done are never rerun, and the others can safely be rerun: a
+failed shard is retried by the task queue, and resume() reruns all of the
+current phase's unfinished shards.  Rerunning an import shard only rewrites
+the products that aren't already current in the new index (see
+docs.Product._changedParams).
+"""
+
+import csv
+import datetime
+import logging
+import os
+
+import admin_handlers
+import config
+import docs
+import models
+
+from google.appengine.ext.deferred import defer
+from google.appengine.ext import ndb
+
+
+PURGE = 'purge'
+IMPORT = 'import'
+SWITCH = 'switch'
+DONE = 'done'
+
+# the shards of the purge phase
+_PURGE_SHARDS = ['purge:product_index']
+_STORES_SHARD = 'stores'
+_SWITCH_SHARD = 'switch'
+
+
+def _dataFiles():
+  """Return the paths of the sample data files, and their columns."""
+  return [
+      (os.path.join('data', config.SAMPLE_DATA_SMARTPHONE),
+       admin_handlers.SMARTPHONE_FIELDS),
+      (os.path.join('data', config.SAMPLE_DATA_LAPTOP),
+       admin_handlers.LAPTOP_FIELDS)]
+
+
+def _importShards():
+  """Return the names of the shards of the import phase, and the total size
+  of the data files.  An import shard is named
+  'import:<file index>:<start>:<end>', for a byte range of a data file."""
+  shards = []
+  total = 0
+  for i, (path, _) in enumerate(_dataFiles()):
+    size = os.path.getsize(path)
+    total += size
+    for start in xrange(0, size, config.REINIT_SHARD_BYTES):
+      shards.append('%s:%d:%d:%d' % (
+          IMPORT, i, start, min(start + config.REINIT_SHARD_BYTES, size)))
+  shards.append(_STORES_SHARD)
+  return shards, total
+
+
+def _readLines(path, start, end):
+  """Yield the lines of the file that start within the byte range [start,
+  end).  (This assumes that no csv record spans more than one line.)"""
+  with open(path, 'rb') as f:
+    if start > 0:
+      # skip the line that straddles start, which belongs to the shard before
+      f.seek(start - 1)
+      f.readline()
+    while f.tell() < end:
+      line = f.readline()
+      if not line:
+        break
+      yield line
+
+
+def start():
+  """Start a reinitialization, and return its job id."""
+  job = models.ReinitJob(phase=PURGE, shards=_PURGE_SHARDS,
+                         phase_started=datetime.datetime.utcnow(),
+                         index_name=docs.Product.startRebuild())
+  job.put()
+  defer(_fanOut, job.key.id())
+  return job.key.id()
+
+
+def latestJob():
+  """Return the most recently started ReinitJob, or None."""
+  return models.ReinitJob.query().order(-models.ReinitJob.started).get()
+
+
+def resume(job_id=None):
+  """Rerun the unfinished shards of the current phase of the given job (by
+  default, the latest one)."""
+  job = models.ReinitJob.get_by_id(job_id) if job_id else latestJob()
+  if job and job.phase != DONE:
+    defer(_fanOut, job.key.id())
+
+
+def _fanOut(job_id):
+  """Enqueue a task for each unfinished shard of the job's current phase."""
+  job = models.ReinitJob.get_by_id(job_id)
+  if not job:
+    return
+  done = set(job.done_shards)
+  for shard in job.shards:
+    if shard not in done:
+      defer(_runShard, job_id, shard)
+
+
+def _runShard(job_id, shard):
+  job = models.ReinitJob.get_by_id(job_id)
+  if not job or shard in job.done_shards or shard not in job.shards:
+    return  # a duplicate or stale task
+  logging.info('Reinit job %s: running shard %s', job_id, shard)
+  counts = {}
+  if shard == 'purge:product_index':
+    counts['deleted'] = docs.Product.deleteAllInIndex(
+        index_name=job.index_name)['deleted']
+  elif shard == _STORES_SHARD:
+    admin_handlers.loadStoreLocationData()
+  elif shard == _SWITCH_SHARD:
+    counts['error'] = docs.Product.switchToIndex(
+        job.index_name, job.written + job.skipped)
+  else:
+    _, file_index, start, end = shard.split(':')
+    start, end = int(start), int(end)
+    path, fields = _dataFiles()[int(file_index)]
+    reader = csv.DictReader(_readLines(path, start, end), fields)
+    counts = admin_handlers.importData(reader, index_name=job.index_name)
+    counts['bytes'] = end - start
+  _markShardDone(job_id, shard, counts)
+
+
+# shards finishing at the same time contend for the job entity
+@ndb.transactional(retries=10)
+def _markShardDone(job_id, shard, counts):
+  """Add a finished shard's counts to the job, and start the next phase if
+  it was the last shard of the current one."""
+  job = models.ReinitJob.get_by_id(job_id)
+  if not job or shard in job.done_shards:
+    return
+  job.done_shards.append(shard)
+  job.deleted += counts.get('deleted', 0)
+  job.written += counts.get('written', 0)
+  job.skipped += counts.get('skipped', 0)
+  job.failed += counts.get('failed', 0)
+  job.done_bytes += counts.get('bytes', 0)
+  if counts.get('error'):
+    job.error = counts['error']
+  if set(job.shards).issubset(job.done_shards):
+    now = datetime.datetime.utcnow()
+    if job.phase == PURGE:
+      job.phase = IMPORT
+      job.shards, job.total_bytes = _importShards()
+      job.phase_started = now
+      # only a few tasks can be enqueued transactionally, so the shards are
+      # enqueued by a single task.
+      defer(_fanOut, job_id, _transactional=True)
+    elif job.phase == IMPORT:
+      # (phase_started is left as the start of the import, from which the
+      # import rate is measured.)
+      job.phase = SWITCH
+      job.shards = [_SWITCH_SHARD]
+      defer(_fanOut, job_id, _transactional=True)
+    else:
+      job.phase = DONE
+      job.finished = now
+      if job.error:
+        logging.error('The product index was not replaced: %s', job.error)
+      logging.info('Re-initialization complete.')
+  job.put()
+
+
+def getStatus(job=None):
+  """Return a dict describing the progress of the given job (by default, the
+  latest one), or None if there is none: its phase, its shards done and
+  remaining, its counts, the new product index and the error that kept it
+  from replacing the live one, if any, and for the import phase, the rows
+  imported per second, and the bytes remaining and estimated seconds to
+  finish."""
+  job = job or latestJob()
+  if not job:
+    return None
+  end = job.finished or datetime.datetime.utcnow()
+  done = set(job.done_shards)
+  status = {
+      'job_id': job.key.id(),
+      'phase': job.phase,
+      'started': job.started.isoformat(),
+      'finished': job.finished.isoformat() if job.finished else None,
+      'elapsed_secs': (end - job.started).total_seconds(),
+      'shards_done': len([s for s in job.shards if s in done]),
+      'shards_remaining': [s for s in job.shards if s not in done],
+      'deleted': job.deleted, 'written': job.written,
+      'skipped': job.skipped, 'failed': job.failed,
+      'total_bytes': job.total_bytes,
+      'remaining_bytes': job.total_bytes - job.done_bytes,
+      'index_name': job.index_name,
+      'error': job.error,
+  }
+  if job.phase != PURGE and job.phase_started:
+    secs = (end - job.phase_started).total_seconds()
+    rows = job.written + job.skipped + job.failed
+    status['rows_per_sec'] = rows / secs if secs > 0 else None
+    bytes_per_sec = job.done_bytes / secs if secs > 0 else 0
+    status['eta_secs'] = (status['remaining_bytes'] / bytes_per_sec
+                          if bytes_per_sec else None)
+  return status
@@ -0,0 +1,261 @@
+#!/usr/bin/env python
+#
+# Copyright 2012 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Scatter-gather search over the shards of a sharded index (see
+docs.Product.search).  A query is run on all of the shards at once, and their
+results are merged in the query's sort order, so that the caller gets the
+same search.SearchResults as from a single index: number_found is the sum over
+the shards, and facet value counts are added up.
+
+Offset pages are built by fetching the first offset + limit results of every
+shard.  Cursor pages use a composite cursor, which holds the position of each
+shard: the per-result cursor of the last of its results that was merged into
+an earlier page.  Each page then fetches at most one page of results per
+shard, however deep it is.
+"""
+
+import base64
+import heapq
+import json
+
+import utils
+
+from google.appengine.api import search
+
+
+# the maximum number of results a single search can return (offset + limit)
+_MAX_RESULTS = 1000
+
+
+def _encodeCursor(positions):
+  # the 'False:' prefix is that of a web-safe string of a search.Cursor that
+  # isn't per-result, which search.Cursor requires.
+  return 'False:' + base64.urlsafe_b64encode(json.dumps(positions))
+
+
+def _decodeCursor(cursor):
+  """Return the dict mapping each shard's index name to its position (a
+  per-result web-safe cursor string, '' for its first result, or None once it
+  has no more results), from the composite search.Cursor."""
+  if cursor is None or not cursor.web_safe_string:
+    return {}
+  try:
+    internal = cursor.web_safe_string.split(':', 1)[1]
+    positions = json.loads(base64.urlsafe_b64decode(str(internal)))
+  except (IndexError, TypeError, ValueError):
+    raise search.InvalidRequest('Invalid cursor %s' % cursor.web_safe_string)
+  if not isinstance(positions, dict):
+    raise search.InvalidRequest('Invalid cursor %s' % cursor.web_safe_string)
+  return positions
+
+
+def _fieldValue(doc, name):
+  for field in doc.fields or []:
+    if field.name == name:
+      return field.value
+  return None
+
+
+def _sortKeyFunction(sort_options):
+  """Return a function computing the merge key of a search.ScoredDocument for
+  the given search.SortOptions.  Sort expressions that name a field are
+  evaluated from the document's fields; others use the document's sort
+  scores.  The match score comes last, and ties are ordered by document rank,
+  highest first, which is the default order of the search service."""
+  expressions = []
+  scorer = None
+  if sort_options is not None:
+    expressions = list(sort_options.expressions or [])
+    scorer = sort_options.match_scorer
+
+  def key(doc):
+    res = []
+    scores = getattr(doc, 'sort_scores', None) or []
+    for i, expr in enumerate(expressions):
+      value = _fieldValue(doc, expr.expression.strip())
+      if value is None and i < len(scores):
+        value = scores[i]
+      if value is None:
+        value = expr.default_value
+      if expr.direction == search.SortExpression.DESCENDING:
+        if isinstance(value, (int, long, float)):
+          value = -value
+        else:
+          value = utils.Descending(value)
+      res.append(value)
+    if scorer is not None:
+      res.append(-scores[-1] if scores else 0)
+    res.append(-(doc.rank or 0))
+    return tuple(res)
+  return key
+
+
+def _sortFields(sort_options):
+  """Return the names of the fields used by the sort expressions, which must
+  be returned with the results for them to be merged."""
+  if sort_options is None:
+    return []
+  return [expr.expression.strip() for expr in sort_options.expressions or []]
+
+
+def _shardQuery(query, **overrides):
+  """Return a copy of the search.Query, with the given query options
+  replaced."""
+  options = query.options or search.QueryOptions()
+  kwargs = {
+      'limit': options.limit, 'offset': options.offset,
+      'cursor': options.cursor,
+      'number_found_accuracy': options.number_found_accuracy,
+      'sort_options': options.sort_options,
+      'returned_fields': options.returned_fields,
+      'ids_only': options.ids_only,
+      'snippeted_fields': options.snippeted_fields,
+      'returned_expressions': options.returned_expressions}
+  kwargs.update(overrides)
+  if kwargs['returned_fields']:
+    returned = list(kwargs['returned_fields'])
+    returned.extend(name for name in _sortFields(options.sort_options)
+                    if name not in returned)
+    kwargs['returned_fields'] = returned
+  return search.Query(
+      query_string=query.query_string,
+      options=search.QueryOptions(**kwargs),
+      enable_facet_discovery=query.enable_facet_discovery,
+      return_facets=query.return_facets,
+      facet_options=query.facet_options,
+      facet_refinements=query.facet_refinements)
+
+
+def _mergeFacets(query, results):
+  """Add up the facet value counts of the shards' search results.  The values
+  of a range facet are ordered by range; those of a value facet by count,
+  highest first, and limited to the request's value_limit (the counts of a
+  value are only those of the shards where it was among the most frequent)."""
+  requests = dict((request.name, request)
+                  for request in query.return_facets or [])
+  names = []
+  merged = {}
+  for response in results:
+    for facet in getattr(response, 'facets', None) or []:
+      if facet.name not in merged:
+        names.append(facet.name)
+        merged[facet.name] = {}
+      counts = merged[facet.name]
+      for value in facet.values:
+        if value.label in counts:
+          count, refinement = counts[value.label]
+          counts[value.label] = (count + value.count, refinement)
+        else:
+          counts[value.label] = (value.count, value.refinement)
+  facets = []
+  for name in names:
+    request = requests.get(name)
+    items = merged[name].items()
+    if request is not None and request.ranges:
+      def rangeStart(item):
+        frange = getattr(item[1][1], 'facet_range', None)
+        start = frange.start if frange is not None else None
+        return (start is not None, start)
+      items.sort(key=rangeStart)
+    else:
+      items.sort(key=lambda item: (-item[1][0], item[0]))
+      if request is not None and request.value_limit:
+        items = items[:request.value_limit]
+    facets.append(search.FacetResult(name, values=[
+        search.FacetResultValue(label, count, refinement)
+        for label, (count, refinement) in items]))
+  return facets
+
+
+class _MergedSearch(object):
+  """A search in progress on all of the shards.  Like the future returned by
+  search.Index.search_async, its get_result method waits for the results."""
+
+  def __init__(self, merge):
+    self._merge = merge
+    self._result = None
+
+  def get_result(self):
+    if self._result is None:
+      self._result = self._merge()
+    return self._result
+
+
+def searchShardsAsync(indexes, query):
+  """Start the search on all of the indexes.  Returns an object whose
+  get_result method waits for the shards' results, and returns them merged
+  into a search.SearchResults."""
+  options = query.options or search.QueryOptions()
+  limit = options.limit or 20
+  key = _sortKeyFunction(options.sort_options)
+  cursor_mode = options.cursor is not None
+  if cursor_mode:
+    positions = _decodeCursor(options.cursor)
+    pending = []
+    for index in indexes:
+      position = positions.get(index.name, '')
+      if position is None:
+        continue  # the shard has no more results
+      pending.append((index, index.search_async(_shardQuery(
+          query, offset=None, limit=limit, cursor=search.Cursor(
+              web_safe_string=position or None, per_result=True)))))
+  else:
+    offset = options.offset or 0
+    shard_limit = min(offset + limit, _MAX_RESULTS)
+    pending = [(index, index.search_async(_shardQuery(
+        query, offset=0, limit=shard_limit, cursor=None)))
+               for index in indexes]
+
+  def getResult():
+    responses = [(index, future.get_result()) for index, future in pending]
+    number_found = sum(response.number_found for _, response in responses)
+    streams = [[(key(doc), i, j, doc)
+                for j, doc in enumerate(response.results)]
+               for i, (_, response) in enumerate(responses)]
+    merged = heapq.merge(*streams)
+    facets = _mergeFacets(query, [response for _, response in responses])
+    if not cursor_mode:
+      page = [entry[3] for entry in merged][offset:offset + limit]
+      return search.SearchResults(
+          number_found=number_found, results=page, facets=facets)
+    page = []
+    consumed = [0] * len(responses)
+    for _, i, j, doc in merged:
+      if len(page) == limit:
+        break
+      page.append(doc)
+      consumed[i] = j + 1
+    new_positions = dict(positions)
+    for i, (index, response) in enumerate(responses):
+      if consumed[i] == len(response.results) and len(response.results) < limit:
+        new_positions[index.name] = None
+      elif consumed[i]:
+        last_cursor = response.results[consumed[i] - 1].cursor
+        new_positions[index.name] = last_cursor.web_safe_string
+    next_cursor = None
+    if any(new_positions.get(index.name, '') is not None
+           for index in indexes):
+      next_cursor = search.Cursor(web_safe_string=_encodeCursor(new_positions))
+    return search.SearchResults(
+        number_found=number_found, results=page, cursor=next_cursor,
+        facets=facets)
+  return _MergedSearch(getResult)
+
+
+def searchShards(indexes, query):
+  """Run the search on all of the indexes, and return their merged
+  search.SearchResults."""
+  return searchShardsAsync(indexes, query).get_result()
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+#
+# Copyright 2012 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" An in-memory spatial index over points on the earth's surface, used to
+answer store locator queries without a search request.
+"""
+
+import math
+
+import utils
+
+
+# the length of one degree of latitude, in meters
+_METERS_PER_DEGREE = math.pi * utils.EARTH_RADIUS / 180.0
+
+
+class GeoGrid(object):
+  """Buckets points into a grid of cells of cell_degrees by cell_degrees of
+  latitude/longitude.  A radius query only computes the (haversine) distance
+  to the points in the cells overlapping the circle's bounding box.  The grid
+  is immutable once built, so it can be shared between threads."""
+
+  def __init__(self, points, cell_degrees=1.0):
+    """Args:
+      points: iterable of (latitude, longitude, item) tuples.
+      cell_degrees: the size of a grid cell, in degrees.
+    """
+    self._cell_degrees = float(cell_degrees)
+    self._lon_cells = int(math.ceil(360.0 / self._cell_degrees))
+    self._cells = {}
+    self._size = 0
+    for lat, lon, item in points:
+      self._cells.setdefault(self._cell(lat, lon), []).append((lat, lon, item))
+      self._size += 1
+
+  def __len__(self):
+    return self._size
+
+  def _cell(self, lat, lon):
+    return (int(math.floor(lat / self._cell_degrees)),
+            int(math.floor((lon + 180.0) / self._cell_degrees))
+            % self._lon_cells)
+
+  def _cellsWithin(self, lat, lon, meters):
+    """Yield the keys of the cells overlapping the bounding box of the circle
+    of the given radius around the given point."""
+    dlat = meters / _METERS_PER_DEGREE
+    lat_lo = max(lat - dlat, -90.0)
+    lat_hi = min(lat + dlat, 90.0)
+    max_cos = min(math.cos(math.radians(lat_lo)),
+                  math.cos(math.radians(lat_hi)))
+    if lat_lo <= -90.0 or lat_hi >= 90.0 or max_cos <= 0:
+      # the circle contains a pole: all longitudes
+      lon_range = xrange(self._lon_cells)
+    else:
+      dlon = dlat / max_cos
+      if dlon >= 180.0:
+        lon_range = xrange(self._lon_cells)
+      else:
+        first = self._cell(lat, lon - dlon)[1]
+        count = int(math.ceil(2 * dlon / self._cell_degrees)) + 1
+        lon_range = [(first + i) % self._lon_cells
+                     for i in xrange(min(count, self._lon_cells))]
+    for lat_cell in xrange(self._cell(lat_lo, 0)[0],
+                           self._cell(lat_hi, 0)[0] + 1):
+      for lon_cell in lon_range:
+        yield (lat_cell, lon_cell)
+
+  def withinRadius(self, lat, lon, meters):
+    """Return a list of (distance, item) pairs for the points within the
+    given number of meters of the given point, nearest first."""
+    res = []
+    for key in self._cellsWithin(lat, lon, meters):
+      for plat, plon, item in self._cells.get(key, ()):
+        dist = utils.haversineDistance(lat, lon, plat, plon)
+        if dist < meters:
+          res.append((dist, item))
+    res.sort(key=lambda pair: pair[0])
+    return res
+
+  def nearest(self, lat, lon, k, max_meters=None):
+    """Return a list of (distance, item) pairs for the k points nearest to the
+    given point (optionally, only those within max_meters), nearest first.
+    The search radius starts at one cell and doubles until k points are
+    found."""
+    limit = max_meters or math.pi * utils.EARTH_RADIUS + 1
+    meters = min(self._cell_degrees * _METERS_PER_DEGREE, limit)
+    while True:
+      res = self.withinRadius(lat, lon, meters)
+      if len(res) >= k or meters >= limit:
+        return res[:k]
+      meters = min(meters * 2, limit)
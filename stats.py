@@ -0,0 +1,304 @@
+#!/usr/bin/env python
+#
+# Copyright 2012 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Request timing statistics.
+StatsMiddleware wraps a WSGI application, and records the time taken by each
+request, per route, and by each API call (search, datastore, memcache, users,
+...) made while serving it, per RPC type, into histograms.  The histograms
+cover a window of config.STATS_WINDOW_SECS; at the end of each window the
+instance's histograms and slowest requests are flushed to memcache, where the
+last config.STATS_WINDOWS windows of every instance are kept.  getSummary
+merges these into percentiles for the admin stats page.
+"""
+
+import bisect
+import heapq
+import itertools
+import logging
+import os
+import threading
+import time
+import uuid
+
+import config
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import memcache
+
+
+# the upper bounds, in ms, of the histogram buckets: each is 25% larger than
+# the last, so a percentile is estimated to within 25%.
+_BOUNDS = tuple(0.5 * 1.25 ** i for i in xrange(64))
+
+_NAMESPACE = 'stats'
+_INSTANCES_KEY = 'instances'
+# the number of characters of the query string kept for the slowest requests
+_MAX_QUERY_LEN = 200
+
+_INSTANCE_ID = os.environ.get('INSTANCE_ID') or uuid.uuid4().hex
+
+# the request being served by the current thread, and the start times of the
+# API calls it has in flight, by id of their rpc object
+_local = threading.local()
+
+
+class Histogram(object):
+  """Counts timings into buckets of exponentially increasing size."""
+
+  __slots__ = ('counts', 'total_ms')
+
+  def __init__(self, counts=None, total_ms=0.0):
+    self.counts = counts or [0] * (len(_BOUNDS) + 1)
+    self.total_ms = total_ms
+
+  @property
+  def count(self):
+    return sum(self.counts)
+
+  def add(self, ms):
+    self.counts[bisect.bisect_left(_BOUNDS, ms)] += 1
+    self.total_ms += ms
+
+  def merge(self, other):
+    for i, n in enumerate(other.counts):
+      self.counts[i] += n
+    self.total_ms += other.total_ms
+
+  def percentile(self, q):
+    """Return the upper bound of the bucket holding the q'th percentile (0 to
+    100), or None if the histogram is empty."""
+    count = self.count
+    if not count:
+      return None
+    rank = q / 100.0 * count
+    seen = 0
+    for i, n in enumerate(self.counts):
+      seen += n
+      if n and seen >= rank:
+        return _BOUNDS[i] if i < len(_BOUNDS) else float('inf')
+    return None
+
+  def summary(self):
+    count = self.count
+    return {'count': count,
+            'mean_ms': self.total_ms / count if count else None,
+            'p50_ms': self.percentile(50),
+            'p95_ms': self.percentile(95),
+            'p99_ms': self.percentile(99)}
+
+  def toDict(self):
+    """Return the histogram in the (sparse) form it is stored in memcache."""
+    return {'counts': dict((i, n) for i, n in enumerate(self.counts) if n),
+            'total_ms': self.total_ms}
+
+  @classmethod
+  def fromDict(cls, data):
+    hist = cls(total_ms=data['total_ms'])
+    for i, n in data['counts'].iteritems():
+      hist.counts[i] = n
+    return hist
+
+
+class StatsCollector(object):
+  """Holds an instance's histograms and slowest requests for the current
+  window."""
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._hists = {}
+    self._slowest = []  # a heap of (ms, seq, record) tuples
+    self._seq = itertools.count()
+    self._window_start = time.time()
+
+  def record(self, key, ms):
+    with self._lock:
+      hist = self._hists.get(key)
+      if hist is None:
+        hist = self._hists[key] = Histogram()
+      hist.add(ms)
+
+  def recordRequest(self, request):
+    """Record a finished request dict (see StatsMiddleware)."""
+    self.record('route:' + request['route'], request['ms'])
+    entry = (request['ms'], next(self._seq), request)
+    with self._lock:
+      if len(self._slowest) < config.STATS_SLOWEST:
+        heapq.heappush(self._slowest, entry)
+      elif entry > self._slowest[0]:
+        heapq.heapreplace(self._slowest, entry)
+
+  def snapshot(self, reset=False):
+    """Return the current window as a dict, optionally starting a new one."""
+    with self._lock:
+      window = {
+          'start': self._window_start,
+          'end': time.time(),
+          'hists': dict((key, hist.toDict())
+                        for key, hist in self._hists.iteritems()),
+          'slowest': [record for _, _, record in self._slowest]}
+      if reset:
+        self._hists = {}
+        self._slowest = []
+        self._window_start = window['end']
+    return window
+
+  def maybeFlush(self):
+    """Flush the current window to memcache if it has ended."""
+    if time.time() - self._window_start < config.STATS_WINDOW_SECS:
+      return
+    with self._lock:
+      # another thread may have flushed meanwhile
+      if time.time() - self._window_start < config.STATS_WINDOW_SECS:
+        return
+    self._flush(self.snapshot(reset=True))
+
+  def _flush(self, window):
+    # Concurrent flushes from different instances may occasionally drop an
+    # instance from the list for a window; that's acceptable here.
+    try:
+      windows = memcache.get(_INSTANCE_ID, namespace=_NAMESPACE) or []
+      windows.insert(0, window)
+      memcache.set(_INSTANCE_ID, windows[:config.STATS_WINDOWS],
+                   namespace=_NAMESPACE)
+      instances = memcache.get(_INSTANCES_KEY, namespace=_NAMESPACE) or {}
+      instances[_INSTANCE_ID] = window['end']
+      horizon = (window['end'] -
+                 config.STATS_WINDOW_SECS * config.STATS_WINDOWS)
+      instances = dict((i, t) for i, t in instances.iteritems()
+                       if t >= horizon)
+      memcache.set(_INSTANCES_KEY, instances, namespace=_NAMESPACE)
+    except Exception:  # stats must never fail the request
+      logging.exception('Error flushing request stats')
+
+
+_COLLECTOR = StatsCollector()
+
+
+def record(key, ms):
+  """Record a timing, in ms, under the given key (e.g. 'render:index.html')
+  in this instance's histograms."""
+  _COLLECTOR.record(key, ms)
+
+
+_MAX_PENDING_RPCS = 10000
+
+
+def _pendingRpcs():
+  """The start times of the current thread's API calls in flight.  They are
+  reset for each request, so calls whose post-call hook never ran don't
+  accumulate."""
+  pending = getattr(_local, 'pending', None)
+  if pending is None:
+    pending = _local.pending = {}
+  return pending
+
+
+def _preCallHook(service, call, request, response, rpc):
+  pending = _pendingRpcs()
+  if len(pending) < _MAX_PENDING_RPCS:
+    pending[id(rpc)] = time.time()
+
+
+def _postCallHook(service, call, request, response, rpc, error):
+  start = _pendingRpcs().pop(id(rpc), None)
+  if start is None:
+    return
+  ms = (time.time() - start) * 1000
+  key = 'rpc:%s.%s' % (service, call)
+  _COLLECTOR.record(key, ms)
+  current = getattr(_local, 'request', None)
+  if current is not None:
+    count, total = current['rpcs'].get(key, (0, 0.0))
+    current['rpcs'][key] = (count + 1, total + ms)
+
+
+def installRpcHooks():
+  """Time every API call made by this instance.  May be called repeatedly."""
+  apiproxy = apiproxy_stub_map.apiproxy
+  apiproxy.GetPreCallHooks().Append('request_stats', _preCallHook)
+  apiproxy.GetPostCallHooks().Append('request_stats', _postCallHook)
+
+
+class StatsMiddleware(object):
+  """WSGI middleware recording the time taken by each request to the wrapped
+  application, and by the API calls made while serving it."""
+
+  def __init__(self, app, name):
+    """Args:
+      app: the WSGI application.
+      name: the application name, recorded with the slowest requests.
+    """
+    self.app = app
+    self.name = name
+    installRpcHooks()
+
+  def __call__(self, environ, start_response):
+    statuses = []
+
+    def recordingStartResponse(status, headers, exc_info=None):
+      statuses.append(status)
+      return start_response(status, headers, exc_info)
+
+    current = {'app': self.name,
+               'route': environ.get('PATH_INFO', ''),
+               'query': environ.get('QUERY_STRING', '')[:_MAX_QUERY_LEN],
+               'time': time.time(),
+               'rpcs': {}}
+    _local.request = current
+    _local.pending = {}
+    start = time.time()
+    try:
+      return self.app(environ, recordingStartResponse)
+    finally:
+      current['ms'] = (time.time() - start) * 1000
+      _local.request = None
+      _local.pending = None
+      current['status'] = int(statuses[-1].split()[0]) if statuses else 500
+      if current['status'] == 404:
+        # don't keep a histogram for every unknown path
+        current['route'] = '(not found)'
+      _COLLECTOR.recordRequest(current)
+      _COLLECTOR.maybeFlush()
+
+
+def getSummary():
+  """Merge the windows flushed by all instances, and this instance's current
+  window, into a dict with the count, mean and percentiles for each route and
+  RPC type, and the slowest recent requests."""
+  windows = [_COLLECTOR.snapshot()]
+  instances = memcache.get(_INSTANCES_KEY, namespace=_NAMESPACE) or {}
+  if instances:
+    flushed = memcache.get_multi(instances.keys(), namespace=_NAMESPACE)
+    for instance_windows in flushed.itervalues():
+      windows.extend(instance_windows)
+  hists = {}
+  slowest = []
+  for window in windows:
+    for key, data in window['hists'].iteritems():
+      hist = Histogram.fromDict(data)
+      if key in hists:
+        hists[key].merge(hist)
+      else:
+        hists[key] = hist
+    slowest.extend(window['slowest'])
+  slowest.sort(key=lambda r: -r['ms'])
+  return {
+      'instances': len(instances),
+      'since': min(w['start'] for w in windows),
+      'timings': dict((key, hist.summary())
+                      for key, hist in hists.iteritems()),
+      'slowest': slowest[:config.STATS_SLOWEST],
+  }
@@ -17,13 +17,10 @@
 """Contains utility functions."""
 
 import logging
-
-import config
-import docs
-import models
-
-from google.appengine.ext.deferred import defer
-from google.appengine.ext import ndb
+import math
+import Queue
+import sys
+import threading
 
 
 def intClamp(v, low, high):
@@ -35,4 +32,105 @@ def intClamp(v, low, high):
   Returns:
     An integer closest to v in the range [low, high].
   """
-  return max(int(low), min(int(v), int(high)))
\ No newline at end of file
+  return max(int(low), min(int(v), int(high)))
+
+
+def iterBatches(iterable, size):
+  """Yields the items of the iterable in lists of (at most) the given
+  size."""
+  batch = []
+  for item in iterable:
+    batch.append(item)
+    if len(batch) == size:
+      yield batch
+      batch = []
+  if batch:
+    yield batch
+
+
+# marks the end of the items passed between pipeline stages
+_PIPELINE_DONE = object()
+
+
+def runPipeline(source, stages, depth=2):
+  """Passes each item of the source iterable through the given stage
+  functions in turn, with each stage running in its own thread, so that the
+  stages work on consecutive items concurrently.  A stage's return value is
+  passed on to the next stage; if it returns None, the item is dropped.
+  The source is iterated in the calling thread.
+
+  Stages are connected by queues holding at most depth items, so a slow stage
+  applies backpressure to the stages before it.  If a stage raises an
+  exception, no further items are read from the source, and the exception is
+  re-raised once the pipeline has drained.
+  Args:
+    source: iterable of items to process.
+    stages: list of functions, each taking one item.
+    depth: the maximum number of items waiting before each stage.
+  """
+  queues = [Queue.Queue(maxsize=depth) for _ in stages]
+  errors = []
+
+  def work(i, stage):
+    outq = queues[i + 1] if i + 1 < len(queues) else None
+    while True:
+      item = queues[i].get()
+      if item is _PIPELINE_DONE:
+        if outq is not None:
+          outq.put(_PIPELINE_DONE)
+        return
+      if errors:  # drain the remaining items after a failure
+        continue
+      try:
+        result = stage(item)
+      except Exception:
+        logging.exception('Pipeline stage %s failed', stage.__name__)
+        errors.append(sys.exc_info())
+        continue
+      if outq is not None and result is not None:
+        outq.put(result)
+
+  threads = [threading.Thread(target=work, args=(i, stage))
+             for i, stage in enumerate(stages)]
+  for t in threads:
+    t.start()
+  try:
+    for item in source:
+      if errors:
+        break
+      queues[0].put(item)
+  finally:
+    queues[0].put(_PIPELINE_DONE)
+    for t in threads:
+      t.join()
+  if errors:
+    raise errors[0][0], errors[0][1], errors[0][2]
+
+
+# the mean radius of the earth, in meters
+EARTH_RADIUS = 6371010.0
+
+
+def haversineDistance(lat1, lon1, lat2, lon2):
+  """Returns the great-circle distance, in meters, between two points given by
+  their latitudes and longitudes in degrees."""
+  lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+  a = (math.sin((lat2 - lat1) / 2) ** 2 +
+       math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2)
+  return 2 * EARTH_RADIUS * math.asin(min(1.0, math.sqrt(a)))
+
+
+class Descending(object):
+  """Wraps a sort key so that it sorts in descending order, for keys that
+  can't simply be negated (such as strings)."""
+
+  __slots__ = ('value',)
+
+  def __init__(self, value):
+    self.value = value
+
+  def __lt__(self, other):
+    return other.value < self.value
+
+  def __eq__(self, other):
+    return self.value == other.value
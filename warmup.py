@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+#
+# Copyright 2012 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Builds the per-instance state that would otherwise be built by the first
+user requests to a new instance, in response to a warmup request (see
+'inbound_services' in app.yaml), and records how long each step took.  The
+most recent reports are kept in memcache, so that cold-start cost can be
+tracked over time.
+"""
+
+import importlib
+import logging
+import os
+import time
+
+from google.appengine.api import memcache
+
+
+# the modules imported by the handlers of both the user-facing and the admin
+# applications.
+MODULES = ['handlers', 'admin_handlers']
+# the templates rendered by the app's handlers.
+TEMPLATES = ['index.html', 'product.html', 'notification.html',
+             'admin.html', 'create_product.html']
+
+_REPORTS_KEY = 'warmup_reports'
+# the number of reports kept
+_REPORTS_KEPT = 50
+
+
+def _importModules():
+  for name in MODULES:
+    importlib.import_module(name)
+
+
+def _compileTemplates(jinja2_env):
+  for name in TEMPLATES:
+    jinja2_env.get_template(name)
+
+
+def _buildCategoryTree():
+  import models
+  models.Category.getCategoryTree()
+
+
+def _buildSortMenu():
+  import docs
+  docs.Product.getSortMenu()
+  docs.Product.getSortDict()
+
+
+def _openIndexes():
+  import docs
+  docs.Product.getIndexes()
+  docs.Store.getIndex()
+
+
+def _buildStoreSnapshot():
+  import docs
+  if docs.Store.getSnapshot() is None:
+    docs.Store.refreshSnapshot()
+
+
+def _buildSuggestIndex():
+  import docs
+  if docs.Product.getSuggestIndex() is None:
+    docs.Product.refreshSuggestIndex()
+
+
+def run(jinja2_env):
+  """Run each warmup step, timing it.  A failed step is logged and reported,
+  but doesn't stop the later ones.  Returns the report dict, which is also
+  recorded (see getReports).
+  Args:
+    jinja2_env: the jinja2.Environment used to render the app's templates.
+  """
+  steps = [
+      ('import_modules', _importModules),
+      ('compile_templates', lambda: _compileTemplates(jinja2_env)),
+      ('category_tree', _buildCategoryTree),
+      ('sort_menu', _buildSortMenu),
+      ('index_handles', _openIndexes),
+      ('store_snapshot', _buildStoreSnapshot),
+      ('suggest_index', _buildSuggestIndex),
+  ]
+  report = {'time': time.time(),
+            'instance': os.environ.get('INSTANCE_ID'),
+            'version': os.environ.get('CURRENT_VERSION_ID'),
+            'steps': []}
+  start = time.time()
+  for name, step in steps:
+    step_start = time.time()
+    error = None
+    try:
+      step()
+    except Exception as e:  # report the failure, and go on to the next step
+      logging.exception('Warmup step %s failed', name)
+      error = str(e)
+    report['steps'].append({'name': name, 'error': error,
+                            'ms': (time.time() - step_start) * 1000})
+  report['total_ms'] = (time.time() - start) * 1000
+  logging.info('Warmup took %.1f ms: %s', report['total_ms'],
+               ', '.join('%s %.1f ms' % (s['name'], s['ms'])
+                         for s in report['steps']))
+  _recordReport(report)
+  return report
+
+
+def _recordReport(report):
+  # Concurrent warmups may occasionally overwrite each other's reports; that's
+  # acceptable for this purpose.
+  reports = memcache.get(_REPORTS_KEY) or []
+  reports.insert(0, report)
+  memcache.set(_REPORTS_KEY, reports[:_REPORTS_KEPT])
+
+
+def getReports():
+  """Return the most recent warmup reports, newest first."""
+  return memcache.get(_REPORTS_KEY) or []